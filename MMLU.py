@@ -1,9 +1,14 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+from collections import defaultdict
+import torch
 from datasets import load_dataset
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import tqdm
-
-# Load the full MMLU test set (all subjects)
-mmlu = load_dataset("cais/mmlu", "all", split="test")
+from result_stream import ResultStream
 
 # Define the models to evaluate
 models_info = {
@@ -12,77 +17,164 @@ models_info = {
     "Falcon 3 7B Instruct": ""
 }
 
-# Loop over each model and evaluate
-for model_name, model_id in models_info.items():
+option_labels = ["A", "B", "C", "D"]
+correct_map = {0: 'A', 1: 'B', 2: 'C', 3: 'D'}
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', type=str, default='loglik', choices=['loglik', 'generate'],
+                        help="loglik: pick the option letter with the highest next-token score; generate: the original free-form decoding")
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--cache_dir', type=str, default='./results/mmlu_cache', help="Per-question predictions for resuming, one file per model path")
+    parser.add_argument('--output_path', type=str, default='', help="File the accuracy lines are appended to")
+    return parser.parse_args()
+
+def build_prompt(item):
+    # Format the prompt with answer options labeled A, B, C, D
+    prompt = f"Question: {item['question']}\n"
+    for label, choice in zip(option_labels, item["choices"]):
+        prompt += f"{label}. {choice}\n"
+    prompt += "Please directly select the correct option without any other words:"  # ask the model to provide the letter as answer
+    return prompt
+
+def encode_prompt(tokenizer, prompt, instruct):
+    if instruct:
+        # Use chat template for the instruct model
+        messages = [{"role": "user", "content": prompt}]
+        return tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)
+    # For base LLaMA and GPT-J, use standard prompting
+    return tokenizer(prompt)["input_ids"]
+
+def parse_letter(output_text, choices):
+    # Determine the first predicted letter (A, B, C, or D) from the output
+    for char in output_text:
+        if char.upper() in option_labels:
+            return char.upper()
+    # If no letter found, optionally check if the output contains one of the choice texts
+    for idx, choice in enumerate(choices):
+        if choice.lower() in output_text.lower():
+            return option_labels[idx]
+    return None
+
+def generate_prediction(model, tokenizer, item, instruct):
+    input_ids = encode_prompt(tokenizer, build_prompt(item), instruct)
+    inputs = {
+        "input_ids": torch.tensor([input_ids], device=model.device),
+        "attention_mask": torch.ones(1, len(input_ids), dtype=torch.long, device=model.device),
+    }
+    outputs = model.generate(**inputs, max_new_tokens=16)
+    # The generated sequence includes the prompt + completion; extract only new tokens
+    generated = outputs[0][len(input_ids):]
+    output_text = tokenizer.decode(generated, skip_special_tokens=True).strip()
+    return parse_letter(output_text, item["choices"])
+
+def option_token_ids(tokenizer):
+    # A letter can be emitted with or without a leading space depending on the template. Only
+    # spellings that are a single token can be read off one next-token distribution; a tokenizer
+    # that splits " A" into " " + "A" would otherwise have its space token scored as option A
+    ids = []
+    for label in option_labels:
+        variants = set()
+        for text in [label, f" {label}"]:
+            token_ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+            if len(token_ids) == 1:
+                variants.add(token_ids[0])
+        if not variants:
+            raise ValueError(f"Option {label} is not a single token for {tokenizer.name_or_path}, use --mode generate")
+        ids.append(sorted(variants))
+    if len({i for variants in ids for i in variants}) != sum(len(variants) for variants in ids):
+        raise ValueError(f"Options share tokens for {tokenizer.name_or_path}, use --mode generate")
+    return ids
+
+def get_cache_path(cache_dir, model_id, mode):
+    # Predictions belong to the weights, not the display name: keyed by the resolved model path or hub id
+    model_key = os.path.abspath(model_id) if os.path.exists(model_id) else model_id
+    digest = hashlib.sha256(model_key.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{re.sub(r'[^A-Za-z0-9.]+', '_', model_key).strip('_')[-80:]}-{digest}.{mode}.jsonl")
+
+def score_batch(model, tokenizer, batch_input_ids, option_ids):
+    # One forward pass per batch; only the logits at the last prompt position are materialised
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    width = max(len(ids) for ids in batch_input_ids)
+    input_ids = torch.tensor([[pad_id] * (width - len(ids)) + ids for ids in batch_input_ids], device=model.device)
+    attention_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in batch_input_ids], device=model.device)
+    with torch.no_grad():
+        logits = model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=(attention_mask.cumsum(-1) - 1).clamp(min=0),
+            logits_to_keep=1
+        ).logits[:, -1].float()
+    option_scores = torch.stack([logits[:, ids].max(dim=-1).values for ids in option_ids], dim=-1)
+    return [option_labels[i] for i in option_scores.argmax(dim=-1).tolist()]
+
+def evaluate_model(model_name, model_id, mmlu, mode, batch_size, cache_dir):
     print(f"Evaluating {model_name}...")
-    # Load tokenizer and model (using bfloat16 and device_map="auto" for efficiency if supported)
-    tokenizer = AutoTokenizer.from_pretrained(model_id)
-    model = AutoModelForCausalLM.from_pretrained(
-        model_id, device_map="auto", torch_dtype="auto"
-    )
-    model.eval()  # set to eval mode
-    model.generation_config.pad_token_id = tokenizer.eos_token_id
-    
-    correct = 0
-    total = len(mmlu)
-    for item in tqdm.tqdm(mmlu):
-        question = item["question"]
-        choices = item["choices"]
-        correct_answer = item["answer"]  # e.g. "C"
-        
-        # Format the prompt with answer options labeled A, B, C, D
-        prompt = f"Question: {question}\n"
-        option_labels = ["A", "B", "C", "D"]
-        for label, choice in zip(option_labels, choices):
-            prompt += f"{label}. {choice}\n"
-        prompt += "Please directly select the correct option without any other words:"  # ask the model to provide the letter as answer
-        
-        # Generate model's answer
-        if "Instruct" in model_name:
-            # Use chat template for the instruct model
-            messages = [{"role": "user", "content": prompt}]
-            # Format the chat prompt according to LLaMA 3.1's template
-            inputs = tokenizer.apply_chat_template(
-                messages, tokenize=True, add_generation_prompt=True, 
-                return_tensors="pt", return_dict=True
-            )
-            inputs = {k: v.to(model.device) for k,v in inputs.items()}
-            outputs = model.generate(**inputs, max_new_tokens=16)
-            # The generated sequence includes the prompt + completion; extract only new tokens
-            input_len = inputs["input_ids"].shape[1]
+    cache = ResultStream(get_cache_path(cache_dir, model_id, mode))
+    predictions = cache.load()
+    pending = [i for i in range(len(mmlu)) if i not in predictions]
+    print(f"{len(predictions)} cached predictions, {len(pending)} questions to go")
+
+    if pending:
+        # Load tokenizer and model (using bfloat16 and device_map="auto" for efficiency if supported)
+        tokenizer = AutoTokenizer.from_pretrained(model_id)
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id, device_map="auto", torch_dtype="auto"
+        )
+        model.eval()  # set to eval mode
+        model.generation_config.pad_token_id = tokenizer.eos_token_id
+        instruct = "Instruct" in model_name
+
+        if mode == "generate":
+            for i in tqdm.tqdm(pending):
+                item = mmlu[i]
+                pred = generate_prediction(model, tokenizer, item, instruct)
+                cache.append([{"index": i, "subject": item["subject"], "pred": pred, "answer": correct_map[item["answer"]]}])
         else:
-            # For base LLaMA and GPT-J, use standard prompting
-            enc = tokenizer(prompt, return_tensors="pt").to(model.device)
-            outputs = model.generate(**enc, max_new_tokens=16)
-            input_len = enc["input_ids"].shape[1]
-        
-        # Decode the model's output tokens (excluding the prompt)
-        generated = outputs[0][input_len:]
-        output_text = tokenizer.decode(generated, skip_special_tokens=True).strip()
-        
-        # Determine the first predicted letter (A, B, C, or D) from the output
-        pred_letter = None
-        for char in output_text:
-            if char.upper() in ["A", "B", "C", "D"]:
-                pred_letter = char.upper()
-                break
-        # If no letter found, optionally check if the output contains one of the choice texts
-        if pred_letter is None:
-            for idx, choice in enumerate(choices):
-                if choice.lower() in output_text.lower():
-                    pred_letter = option_labels[idx]
-                    break
-        correct_map = {0: 'A', 1: 'B', 2: 'C', 3: 'D'}
-        correct_answer = correct_map[correct_answer]
-        # Compare with correct answer
-        if pred_letter == correct_answer:
-            correct += 1
-        
-        # print(correct)
-    
-    accuracy = correct / total
-    print(f"{model_name} Accuracy: {accuracy:.2%} ({correct} / {total})\n")
+            encoded = {i: encode_prompt(tokenizer, build_prompt(mmlu[i]), instruct) for i in tqdm.tqdm(pending, desc="Tokenizing")}
+            # Length-sorted batches keep padding to a minimum
+            by_length = sorted(pending, key=lambda i: len(encoded[i]))
+            option_ids = option_token_ids(tokenizer)
+            for start in tqdm.tqdm(range(0, len(by_length), batch_size)):
+                batch = by_length[start:start + batch_size]
+                preds = score_batch(model, tokenizer, [encoded[i] for i in batch], option_ids)
+                cache.append([
+                    {"index": i, "subject": mmlu[i]["subject"], "pred": pred, "answer": correct_map[mmlu[i]["answer"]]}
+                    for i, pred in zip(batch, preds)
+                ])
+        del model
+        torch.cuda.empty_cache()
+        predictions = cache.load()
+
+    subject_total = defaultdict(int)
+    subject_correct = defaultdict(int)
+    for record in predictions.values():
+        subject_total[record["subject"]] += 1
+        subject_correct[record["subject"]] += int(record["pred"] == record["answer"])
+    correct = sum(subject_correct.values())
+    total = len(mmlu)
+    subject_accuracy = {subject: subject_correct[subject] / subject_total[subject] for subject in sorted(subject_total)}
+    return correct, total, subject_accuracy
+
+def main():
+    args = parse_args()
+    # Load the full MMLU test set (all subjects)
+    mmlu = load_dataset("cais/mmlu", "all", split="test")
+
+    # Loop over each model and evaluate
+    for model_name, model_id in models_info.items():
+        correct, total, subject_accuracy = evaluate_model(model_name, model_id, mmlu, args.mode, args.batch_size, args.cache_dir)
+        accuracy = correct / total
+        print(f"{model_name} Accuracy: {accuracy:.2%} ({correct} / {total})\n")
+        for subject, subject_acc in subject_accuracy.items():
+            print(f"  {subject}: {subject_acc:.2%}")
 
         # Save result to a file
-    with open("", "a") as f: # Specify your output file path here
-        f.write(f"{model_name} Accuracy: {accuracy:.2%} ({correct} / {total})\n")
+        if args.output_path:
+            with open(args.output_path, "a") as f:
+                f.write(f"{model_name} Accuracy: {accuracy:.2%} ({correct} / {total})\n")
+            with open(os.path.splitext(args.output_path)[0] + f".{re.sub(r'[^A-Za-z0-9.]+', '_', model_name)}.{args.mode}.subjects.json", "w") as f:
+                json.dump(subject_accuracy, f, indent=4)
+
+if __name__ == "__main__":
+    main()
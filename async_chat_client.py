@@ -0,0 +1,150 @@
+import asyncio
+import email.utils
+import logging
+import math
+import random
+import time
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    # Capacity refills continuously at `per_minute` units per minute. Callers reserve
+    # units up front and sleep off any debt, so no lock is needed inside one event loop.
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute) if per_minute else None
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount):
+        if self.capacity is None:
+            return 0.0
+        now = time.monotonic()
+        rate = self.capacity / 60.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / rate)
+
+
+def parse_retry_after(error):
+    # Seconds the server asked us to wait, or None when it did not say or the header is malformed;
+    # the caller then falls back to jittered exponential backoff
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            seconds = float(retry_after_ms) / 1000.0
+            if math.isfinite(seconds) and seconds >= 0:
+                return seconds
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        seconds = float(retry_after)
+        return seconds if math.isfinite(seconds) and seconds >= 0 else None
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_date is None:
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+def estimate_tokens(messages, max_tokens):
+    # Rough prompt size (~4 characters per token) plus the completion budget
+    return sum(len(m["content"]) for m in messages) // 4 + max_tokens
+
+
+class AsyncChatClient:
+    def __init__(self, api_key, base_url, concurrency=8, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=3, backoff_base=1.0, backoff_max=60.0, timeout=120.0):
+        self.api_key = api_key
+        self.base_url = base_url or None
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+
+    @classmethod
+    def from_config(cls, api_key, base_url, client_config):
+        return cls(
+            api_key,
+            base_url,
+            concurrency=client_config.get("concurrency", 8),
+            requests_per_minute=client_config.get("requests_per_minute"),
+            tokens_per_minute=client_config.get("tokens_per_minute"),
+            max_retries=client_config.get("max_retries", 3),
+            backoff_base=client_config.get("backoff_base", 1.0),
+            backoff_max=client_config.get("backoff_max", 60.0),
+            timeout=client_config.get("timeout", 120.0),
+        )
+
+    def backoff_delay(self, attempt, error):
+        retry_after = parse_retry_after(error)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.backoff_base)
+        # Full jitter: uniform in [0, min(cap, base * 2^attempt)]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _complete(self, client, semaphore, index, model_name, model_type, messages, max_tokens, extra_params):
+        attempt = -1
+        for attempt in range(self.max_retries):
+            wait = max(self.request_bucket.reserve(1), self.token_bucket.reserve(estimate_tokens(messages, max_tokens)))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.chat.completions.create(
+                        model=model_name,
+                        max_tokens=max_tokens,
+                        messages=messages,
+                        **extra_params
+                    )
+                    latency = time.perf_counter() - start
+                metrics.record_api_request(model_name, latency, attempt, failed=False)
+                if response.usage is not None:
+                    metrics.record_generation(model_type or model_name, latency, 1, response.usage.prompt_tokens, response.usage.completion_tokens)
+                return response.choices[0].message.content
+            except Exception as e:
+                logger.warning(f"Attempt {attempt + 1} failed for prompt {index}: {e}")
+                from openai import APIStatusError
+                if isinstance(e, APIStatusError) and e.status_code < 500 and e.status_code not in (408, 409, 429):
+                    break
+                if attempt + 1 < self.max_retries:
+                    await asyncio.sleep(self.backoff_delay(attempt, e))
+        logger.error(f"Failed to generate response for prompt {index} after {attempt + 1} attempts.")
+        metrics.record_api_request(model_name, None, attempt, failed=True)
+        return ""
+
+    async def _generate(self, model_name, model_type, message_lists, max_tokens, extra_params):
+        # Retries are handled here, so the SDK's own retry loop is disabled
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0, timeout=self.timeout)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            tasks = [
+                self._complete(client, semaphore, i, model_name, model_type, messages, max_tokens, extra_params)
+                for i, messages in enumerate(message_lists)
+            ]
+            # gather keeps results in input order regardless of completion order
+            return await asyncio.gather(*tasks)
+        finally:
+            await client.close()
+
+    def generate(self, model_name, message_lists, max_tokens=200, model_type=None, **extra_params):
+        # model_type only labels the recorded metrics
+        return asyncio.run(self._generate(model_name, model_type, message_lists, max_tokens, extra_params))
@@ -0,0 +1,81 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    # Sorts requests by prompt length and packs neighbours into batches whose padded footprint,
+    # batch size x (longest prompt + max_new_tokens), stays under a token budget. Short prompts
+    # then run in wide batches and long ones in narrow batches, with little padding in either.
+    def __init__(self, max_batch_tokens=None, max_batch_size=None, window_items=256):
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.window_items = window_items
+
+    @classmethod
+    def from_config(cls, batching_config):
+        batching_config = batching_config or {}
+        return cls(
+            max_batch_tokens=batching_config.get("max_batch_tokens"),
+            max_batch_size=batching_config.get("max_batch_size"),
+            window_items=batching_config.get("window_items") or 256,
+        )
+
+    def window(self, batch_size):
+        # Items handed to the models at once. With a token budget or size cap the scheduler cuts them
+        # into real batches itself, so it gets a wide window to sort by length; without one there is
+        # nothing to split on and batch_size items make up each call
+        if self.max_batch_tokens or self.max_batch_size:
+            return max(batch_size, self.window_items)
+        return batch_size
+
+    def plan(self, lengths, max_new_tokens=0, rows=None):
+        # Returns lists of request indices; a single request over the budget still gets its own batch.
+        # rows[i] is the number of sequences request i expands to (a prompt group), 1 by default
+        rows = rows or [1] * len(lengths)
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        batches = []
+        current = []
+        current_rows = 0
+        longest = 0
+        for i in order:
+            new_longest = max(longest, lengths[i])
+            over_budget = self.max_batch_tokens and (current_rows + rows[i]) * (new_longest + max_new_tokens) > self.max_batch_tokens
+            full = self.max_batch_size and current_rows + rows[i] > self.max_batch_size
+            if current and (over_budget or full):
+                batches.append(current)
+                current = []
+                current_rows = 0
+                new_longest = lengths[i]
+            current.append(i)
+            current_rows += rows[i]
+            longest = new_longest
+        if current:
+            batches.append(current)
+        return batches
+
+
+class PaddingStats:
+    # Real vs padded prompt tokens over every batch sent to a model
+    def __init__(self):
+        self.batches = 0
+        self.sequences = 0
+        self.prompt_tokens = 0
+        self.padded_tokens = 0
+
+    def record(self, lengths, width=None):
+        width = width or max(lengths)
+        logger.debug("Batch of %d sequences: %d prompt tokens padded to %d", len(lengths), sum(lengths), len(lengths) * width)
+        self.batches += 1
+        self.sequences += len(lengths)
+        self.prompt_tokens += sum(lengths)
+        self.padded_tokens += len(lengths) * width
+
+    def summary(self):
+        return {
+            "batches": self.batches,
+            "sequences": self.sequences,
+            "prompt_tokens": self.prompt_tokens,
+            "padded_tokens": self.padded_tokens,
+            "padding_efficiency": self.prompt_tokens / self.padded_tokens if self.padded_tokens else 1.0,
+        }
@@ -0,0 +1,380 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The pairing benchmark forks worker processes after the tokenizer has been used
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+import torch
+import transformers
+from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+from transformers import PreTrainedTokenizerFast, LlamaConfig, LlamaForCausalLM
+
+from instrumentation import metrics, percentile, peak_rss_bytes, configure_logging
+from metrics_aggregator import aggregate
+from result_stream import ResultStream
+from strategy_agent import Agent, PersuaderAgent, ListenerAgent
+from strategy_generate_dataset import build_dataset
+from strategy_test import run_strategy
+
+BENCHMARKS = ["startup", "generate_with_models", "chat_api_sync", "chat_api_async", "strategy_loop", "eval_aggregate", "dpo_pairing"]
+
+CITIES = ["Paris", "London", "Berlin", "Rome", "Madrid", "Tokyo", "Cairo", "Lima", "Oslo", "Seoul"]
+WORDS = ["the", "capital", "country", "river", "famous", "city", "people", "language", "history", "known", "located", "north"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU benchmarks on a tiny random model, synthetic data and a stub chat API server.")
+    parser.add_argument('--output_path', type=str, default=None, help="Default: ./benchmarks/<git commit>.json")
+    parser.add_argument('--compare', type=str, default=None, help="Earlier results file to print speedups against")
+    parser.add_argument('--only', type=str, nargs='+', default=None, choices=BENCHMARKS)
+    parser.add_argument('--repeats', type=int, default=3, help="Timed runs per benchmark after one warm-up run")
+    parser.add_argument('--num_items', type=int, default=32, help="Synthetic dataset size")
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=1, help="torch intra-op threads; fixed so runs are comparable")
+    parser.add_argument('--stub_latency_ms', type=float, default=20.0, help="Mean latency of the stub chat API server")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log_level', type=str, default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    return parser.parse_args()
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return "unknown"
+
+def build_tiny_model(model_dir, seed):
+    # Byte-level BPE with a minimal chat template, and a 2-layer Llama with random weights
+    torch.manual_seed(seed)
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=512, special_tokens=["<unk>", "<s>", "</s>", "<|system|>", "<|user|>", "<|assistant|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    corpus = [" ".join(WORDS + CITIES), string.ascii_letters + string.digits + string.punctuation,
+              "You are a helpful, respectful and honest assistant. Please continue chatting with others."]
+    tokenizer.train_from_iterator(corpus * 50, trainer)
+    fast = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>",
+                                   model_input_names=["input_ids", "attention_mask"])
+    fast.chat_template = (
+        "{{ bos_token }}{% for m in messages %}<|{{ m['role'] }}|>\n{{ m['content'] }}\n{% endfor %}"
+        "{% if add_generation_prompt %}<|assistant|>\n{% endif %}"
+    )
+    fast.save_pretrained(model_dir)
+    config = LlamaConfig(vocab_size=len(fast), hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4,
+                         num_key_value_heads=2, max_position_embeddings=4096, bos_token_id=1, eos_token_id=2)
+    model = LlamaForCausalLM(config)
+    model.generation_config.do_sample = False
+    model.save_pretrained(model_dir)
+
+def build_dataset_items(num_items, rng):
+    data = []
+    for i in range(num_items):
+        truth, new = rng.sample(CITIES, 2)
+        subject = f"country {i}"
+        data.append({
+            "prompt": f"The capital of {subject} is",
+            "ground_truth": truth,
+            "target_new": new,
+            "subject": subject,
+            "rephrase_prompt": f"{subject.capitalize()}'s capital city is",
+            "locality_prompt": "The capital of France is",
+            "locality_ground_truth": "Paris",
+        })
+    return data
+
+def random_text(rng, min_words, max_words):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+def write_result_files(results_dir, num_files, num_items, rng):
+    # Result arrays in the strategy_test.py format, for the aggregation and pairing benchmarks
+    os.makedirs(results_dir, exist_ok=True)
+    for f in range(num_files):
+        results = []
+        for i in range(num_items):
+            correct = rng.random() < 0.4
+            results.append({
+                "ground_truth": "Paris", "target_new": CITIES[i % len(CITIES)], "prompt": f"The capital of country {i} is",
+                "evidence": random_text(rng, 20, 120), "answer": "x", "is_correct": correct, "current_accuracy": 0.0,
+                "rephrase_prompt": "", "rephrase_answer": "", "is_robust": rng.random() < 0.4, "current_rephrase_accuracy": 0.0,
+                "locality_prompt": "", "locality_answer": "", "is_locality": rng.random() < 0.8, "current_locality_accuracy": 0.0,
+            })
+        with open(os.path.join(results_dir, f"Listener_l{f}+Persuader_p+Strategy_s.json"), "w") as out:
+            json.dump(results, out)
+
+class StubChatHandler(BaseHTTPRequestHandler):
+    # Minimal /chat/completions endpoint with a fixed-seed exponential latency
+    latency = 0.02
+    rng = random.Random(0)
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.lock:
+            delay = self.rng.expovariate(1 / self.latency) if self.latency > 0 else 0
+        time.sleep(delay)
+        content = "echo: " + body["messages"][-1]["content"][:64]
+        data = json.dumps({
+            "id": "stub", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": sum(len(m["content"].split()) for m in body["messages"]), "completion_tokens": len(content.split()),
+                      "total_tokens": 0},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class StubChatServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections under concurrent clients and adds 1s SYN retries
+    request_queue_size = 128
+    daemon_threads = True
+
+def start_stub_server(latency, seed):
+    StubChatHandler.latency = latency
+    StubChatHandler.rng = random.Random(seed)
+    server = StubChatServer(("127.0.0.1", 0), StubChatHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+def time_runs(run, repeats):
+    # One untimed warm-up, then `repeats` timed runs; `run` returns the units of work it did
+    run()
+    seconds = []
+    units = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        units = run()
+        seconds.append(time.perf_counter() - start)
+    median = statistics.median(seconds)
+    return {
+        "seconds_median": median,
+        "seconds_min": min(seconds),
+        "seconds_max": max(seconds),
+        "units": units,
+        "units_per_second": units / median if median > 0 else 0.0,
+    }
+
+def bench_generate_with_models(env, args):
+    agent = env["agent"]
+    model, tokenizer = agent.get_model_and_tokenizer("llama3")
+    rng = random.Random(args.seed)
+    prompts = [random_text(rng, 5, 150) for _ in range(args.num_items)]
+    system_prompts = ["You are a helpful, respectful and honest assistant."] * len(prompts)
+
+    def run():
+        for start in range(0, len(prompts), args.batch_size):
+            agent.generate_with_models(model, "llama3", tokenizer, prompts[start:start + args.batch_size],
+                                       system_prompts[start:start + args.batch_size], max_new_tokens=32)
+        return len(prompts)
+    metrics.reset()
+    result = time_runs(run, args.repeats)
+    generation = metrics.generation["llama3"]
+    result["unit"] = "sequences"
+    result["generated_tokens_per_second"] = generation["generated_tokens"] / generation["seconds"]
+    return result
+
+def bench_chat_api(env, args, async_mode):
+    agent = Agent({
+        "model_paths": {"gpt4o": "gpt-4o"}, "api_key": "benchmark", "base_url": env["stub_url"],
+        "api_client": {"async_mode": async_mode, "concurrency": 8},
+    }, "Benchmark")
+    model, _ = agent.get_model_and_tokenizer("gpt4o")
+    rng = random.Random(args.seed)
+    prompts = [random_text(rng, 5, 50) for _ in range(args.num_items)]
+
+    def run():
+        agent.generate_chat_api_responses(model, prompts, "gpt4o", system_prompts=[""] * len(prompts), max_tokens=32)
+        return len(prompts)
+    metrics.reset()
+    result = time_runs(run, args.repeats)
+    latencies = metrics.api["gpt-4o"]["latencies"]
+    result["unit"] = "requests"
+    result["latency_seconds"] = {f"p{int(q * 100)}": percentile(latencies, q) for q in metrics.LATENCY_QUANTILES}
+    agent.close()
+    return result
+
+def bench_strategy_loop(env, args):
+    counter = {"run": 0}
+
+    def run():
+        # A fresh output and evidence file each time, so every run does the full persuader + listener work
+        counter["run"] += 1
+        run_dir = os.path.join(env["work_dir"], f"strategy_{counter['run']}")
+        evidence_stream = ResultStream(os.path.join(run_dir, "evidence.jsonl"))
+        run_strategy(env["dataset"], env["persuader"], env["listener"], "authority_effect", "llama3", "qwen", args.batch_size,
+                     os.path.join(run_dir, "result.json"), evidence_stream)
+        return len(env["dataset"])
+    metrics.reset()
+    result = time_runs(run, args.repeats)
+    result["unit"] = "items"
+    result["phases"] = {name: stats["seconds"] / (args.repeats + 1) for name, stats in metrics.phases.items()}
+    return result
+
+def bench_eval_aggregate(env, args):
+    results_dir = env["results_dir"]
+    paths = sorted(os.path.join(results_dir, f) for f in os.listdir(results_dir) if f.endswith(".json"))
+    manifest_path = os.path.join(env["work_dir"], "manifest.sqlite")
+
+    def run_cold():
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        aggregate(paths, manifest_path, workers=2)
+        return len(paths)
+    result = time_runs(run_cold, args.repeats)
+    result["unit"] = "files"
+    # With an up-to-date manifest nothing is parsed
+    result["warm_seconds_median"] = time_runs(lambda: len(aggregate(paths, manifest_path)), args.repeats)["seconds_median"]
+    return result
+
+def bench_dpo_pairing(env, args):
+    output_path = os.path.join(env["work_dir"], "dpo.jsonl")
+
+    def run():
+        return build_dataset(env["results_dir"], output_path, seed=args.seed, num_buckets=8, workers=2)
+    result = time_runs(run, args.repeats)
+    result["unit"] = "pairs"
+    return result
+
+API_STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+from strategy_agent import PersuaderAgent
+agent = PersuaderAgent({"model_paths": {"gpt4o": "gpt-4o"}, "api_key": "benchmark", "base_url": sys.argv[1]}, "Persuader")
+agent.generate_text_batch(["hello"], "gpt4o", system_prompts=[""], max_tokens=8)
+print(time.perf_counter() - start, "torch" in sys.modules)
+"""
+
+def bench_startup(env, args):
+    # Fresh interpreters: a strategy_test.py run that finds everything done, and time to the first
+    # response of an API-only agent. Neither should import torch or transformers.
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    run_dir = os.path.join(env["work_dir"], "startup")
+    os.makedirs(run_dir, exist_ok=True)
+    dataset_path = os.path.join(run_dir, "data.json")
+    with open(dataset_path, "w") as f:
+        json.dump(env["dataset"], f)
+    config_path = os.path.join(run_dir, "config.yaml")
+    with open(config_path, "w") as f:
+        json.dump({"model_paths": {"gpt4o": "gpt-4o"}, "dataset_path": dataset_path, "output_path": run_dir,
+                   "metrics_path": os.path.join(run_dir, "metrics")}, f)
+    ResultStream(os.path.join(run_dir, "Listener_gpt4o+Persuader_gpt4o+Strategy_NoneStrategy.jsonl")).append(
+        [{"index": i, "is_correct": False, "is_robust": False, "is_locality": False} for i in range(len(env["dataset"]))]
+    )
+    finished_command = [sys.executable, os.path.join(repo_dir, "strategy_test.py"), "--config_path", config_path,
+                        "--strategy", "NoneStrategy", "--listener", "gpt4o", "--persuader", "gpt4o"]
+    api_command = [sys.executable, "-c", API_STARTUP_SCRIPT, env["stub_url"]]
+
+    def run_finished():
+        output = subprocess.run(finished_command, capture_output=True, text=True, check=True, cwd=repo_dir).stdout
+        assert "All completed" in output, output
+        return 1
+    result = time_runs(run_finished, args.repeats)
+    result["unit"] = "runs"
+    api_runs = [subprocess.run(api_command, capture_output=True, text=True, check=True, cwd=repo_dir).stdout.splitlines()[-1].split() for _ in range(args.repeats)]
+    result["api_first_response_seconds_median"] = statistics.median(float(seconds) for seconds, _ in api_runs)
+    result["api_run_imports_torch"] = any(imported == "True" for _, imported in api_runs)
+    return result
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"Compared with {baseline.get('git_commit')} ({baseline_path}):")
+    for name, result in results["benchmarks"].items():
+        old = baseline.get("benchmarks", {}).get(name)
+        if old is None:
+            continue
+        print(f"  {name}: {old['seconds_median']:.3f}s -> {result['seconds_median']:.3f}s ({old['seconds_median'] / result['seconds_median']:.2f}x)")
+
+def main():
+    args = parse_args()
+    configure_logging(args.log_level)
+    torch.set_num_threads(args.threads)
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    selected = args.only or BENCHMARKS
+
+    work_dir = tempfile.mkdtemp(prefix="persuasion_benchmark_")
+    server = None
+    try:
+        model_dir = os.path.join(work_dir, "model")
+        build_tiny_model(model_dir, args.seed)
+        rng = random.Random(args.seed)
+        dataset = build_dataset_items(args.num_items, rng)
+        results_dir = os.path.join(work_dir, "results")
+        write_result_files(results_dir, num_files=16, num_items=500, rng=rng)
+        server, stub_url = start_stub_server(args.stub_latency_ms / 1000, args.seed)
+
+        # Both roles point at the same tiny model, so the model pool loads it once
+        config = {
+            "model_paths": {"llama3": model_dir, "qwen": model_dir},
+            "model_params": {"torch_dtype": "float32"},
+        }
+        env = {
+            "work_dir": work_dir,
+            "dataset": dataset,
+            "results_dir": results_dir,
+            "stub_url": stub_url,
+            "agent": Agent(config, "Benchmark"),
+            "persuader": PersuaderAgent(config, "Persuader"),
+            "listener": ListenerAgent(config, "Listener"),
+        }
+        runners = {
+            "startup": lambda: bench_startup(env, args),
+            "generate_with_models": lambda: bench_generate_with_models(env, args),
+            "chat_api_sync": lambda: bench_chat_api(env, args, async_mode=False),
+            "chat_api_async": lambda: bench_chat_api(env, args, async_mode=True),
+            "strategy_loop": lambda: bench_strategy_loop(env, args),
+            "eval_aggregate": lambda: bench_eval_aggregate(env, args),
+            "dpo_pairing": lambda: bench_dpo_pairing(env, args),
+        }
+        results = {
+            "git_commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "settings": vars(args),
+            "benchmarks": {},
+        }
+        for name in selected:
+            print(f"Running {name}...")
+            result = runners[name]()
+            results["benchmarks"][name] = result
+            print(f"  {result['seconds_median']:.3f}s median, {result['units_per_second']:.1f} {result['unit']}/s")
+        results["peak_rss_bytes"] = peak_rss_bytes()
+        for agent in (env["agent"], env["persuader"], env["listener"]):
+            agent.close()
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output_path = args.output_path or os.path.join("benchmarks", f"{results['git_commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results saved to {output_path}")
+    if args.compare:
+        print_comparison(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from metrics_aggregator import iter_json_records
+from result_stream import ResultStream
+
+# Result files are named by get_output_path in strategy_test.py; worker streams and evidence files don't match
+RUN_NAME = re.compile(r"Listener_([^+]+)\+Persuader_([^+]+)\+Strategy_([^+.]+)(?:\+Mode_([^+.]+))?")
+RUN_COLUMNS = ["listener", "persuader", "strategy", "mode"]
+METRICS = {"accuracy": "is_correct", "robust_accuracy": "is_robust", "locality_accuracy": "is_locality"}
+UNLABELED = "unlabeled"
+
+
+def parse_run_name(path):
+    match = RUN_NAME.fullmatch(os.path.splitext(os.path.basename(path))[0])
+    if match is None:
+        return None
+    listener, persuader, strategy, mode = match.groups()
+    return {"listener": listener, "persuader": persuader, "strategy": strategy, "mode": mode or "generate"}
+
+
+def find_result_files(results_dir):
+    # One source per run: the .jsonl stream when there is one (it is never behind the .json), else the legacy .json
+    runs = {}
+    for path in sorted(glob(os.path.join(results_dir, '**', '*.json*'), recursive=True)):
+        stem, ext = os.path.splitext(path)
+        if ext in ('.json', '.jsonl') and parse_run_name(path) is not None:
+            if ext == '.jsonl' or stem not in runs:
+                runs[stem] = path
+    return list(runs.values())
+
+
+def read_result_file(path):
+    if path.endswith('.jsonl'):
+        records = sorted(ResultStream(path).load().values(), key=lambda r: r["index"])
+    else:
+        records = [{"index": i, **r} for i, r in enumerate(iter_json_records(path))]
+    return pa.table({
+        "index": pa.array([r.get("index", i) for i, r in enumerate(records)], pa.int32()),
+        "prompt": pa.array([r.get("prompt", "") for r in records], pa.string()),
+        "is_correct": pa.array([bool(r.get("is_correct", False)) for r in records], pa.bool_()),
+        "is_robust": pa.array([bool(r.get("is_robust", False)) for r in records], pa.bool_()),
+        "is_locality": pa.array([bool(r.get("is_locality", False)) for r in records], pa.bool_()),
+    })
+
+
+def _ingest_file(path, parquet_path):
+    try:
+        table = read_result_file(path)
+        pq.write_table(table, parquet_path + ".tmp")
+        os.replace(parquet_path + ".tmp", parquet_path)
+        return path, table.num_rows, None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def ingest(results_dir, store_dir, workers=None):
+    # One Parquet file per run; a run is re-read only when its source file's size or mtime changed
+    os.makedirs(store_dir, exist_ok=True)
+    manifest_path = os.path.join(store_dir, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    sources = find_result_files(results_dir)
+    # Runs whose source file is gone (or was superseded by its .jsonl stream) are dropped
+    current = {os.path.abspath(path) for path in sources}
+    for key in [key for key in manifest if key not in current]:
+        parquet_path = os.path.join(store_dir, manifest.pop(key)["parquet"])
+        if os.path.exists(parquet_path):
+            os.remove(parquet_path)
+    stale = {}
+    for path in sources:
+        key = os.path.abspath(path)
+        st = os.stat(path)
+        entry = manifest.get(key)
+        if entry is None or (entry["size"], entry["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+            name = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12] + "_" + os.path.splitext(os.path.basename(path))[0]
+            stale[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "parquet": name + ".parquet", **parse_run_name(path)}
+    if stale:
+        print(f"Ingesting {len(stale)} new or changed of {len(sources)} result files")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_ingest_file, path, os.path.join(store_dir, entry["parquet"])) for path, entry in stale.items()]
+            for future in futures:
+                path, rows, error = future.result()
+                if error is not None:
+                    print(f"Error processing {path}: {error}")
+                    continue
+                manifest[os.path.abspath(path)] = {**stale[path], "rows": rows}
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+class ResultStore:
+    # Every ingested run as flat NumPy columns. String columns are integer codes into
+    # self.values[column], so grouping and filtering never touch Python strings per row.
+    def __init__(self, store_dir, prompt_labels=None):
+        with open(os.path.join(store_dir, "manifest.json")) as f:
+            self.runs = list(json.load(f).values())
+        if not self.runs:
+            raise ValueError(f"No runs ingested into {store_dir}")
+        tables = [pq.read_table(os.path.join(store_dir, run["parquet"])) for run in self.runs]
+        rows = np.array([t.num_rows for t in tables], dtype=np.int64)
+        self.values = {}
+        self.columns = {}
+        for column in RUN_COLUMNS:
+            values, codes = np.unique([run[column] for run in self.runs], return_inverse=True)
+            self.values[column] = list(values)
+            self.columns[column] = np.repeat(codes, rows)
+        self.values["run"] = [os.path.splitext(run["parquet"])[0] for run in self.runs]
+        self.columns["run"] = np.repeat(np.arange(len(self.runs)), rows)
+        # Rows of run i are offsets[i]:offsets[i + 1]
+        self.offsets = np.concatenate([[0], np.cumsum(rows)])
+        table = pa.concat_tables(tables)
+        for column in ["index", "is_correct", "is_robust", "is_locality"]:
+            self.columns[column] = table.column(column).to_numpy()
+        # Categories come from the prompt labels (eval_gpt4.py) at load time, so relabelling needs no re-ingest
+        prompts = table.column("prompt").dictionary_encode().combine_chunks()
+        prompt_labels = prompt_labels or {}
+        self.values["category"] = sorted(set(prompt_labels.values()) | {UNLABELED})
+        category_codes = {category: code for code, category in enumerate(self.values["category"])}
+        category_of_prompt = np.array([category_codes[prompt_labels.get(p, UNLABELED)] for p in prompts.dictionary.to_pylist()] or [0], dtype=np.int64)
+        self.columns["category"] = category_of_prompt[prompts.indices.to_numpy(zero_copy_only=False)]
+
+    def __len__(self):
+        return len(self.columns["index"])
+
+    def mask(self, **filters):
+        # e.g. mask(listener="llama3", strategy=["NoneStrategy", "authority_effect"])
+        selected = np.ones(len(self), dtype=bool)
+        for column, wanted in filters.items():
+            wanted = [wanted] if isinstance(wanted, str) else wanted
+            codes = [self.values[column].index(v) for v in wanted if v in self.values[column]]
+            selected &= np.isin(self.columns[column], codes)
+        return selected
+
+    def metrics_table(self, group_by=("listener", "persuader", "strategy", "mode"), **filters):
+        # Accuracy, robustness and locality per group, from one bincount per metric
+        selected = self.mask(**filters)
+        # One integer key per row, so grouping is a 1-D unique
+        shape = [len(self.values[c]) for c in group_by]
+        keys = np.ravel_multi_index([self.columns[c][selected] for c in group_by], shape)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        groups = np.stack(np.unravel_index(keys, shape), axis=1)
+        totals = np.bincount(inverse, minlength=len(groups))
+        sums = {name: np.bincount(inverse, weights=self.columns[column][selected], minlength=len(groups)) for name, column in METRICS.items()}
+        rows = []
+        for g, group in enumerate(groups):
+            row = {c: self.values[c][code] for c, code in zip(group_by, group)}
+            row["total"] = int(totals[g])
+            row.update((name, sums[name][g] / totals[g]) for name in METRICS)
+            rows.append(row)
+        return rows
+
+    def category_table(self, group_by=("listener", "persuader", "strategy", "mode"), **filters):
+        return self.metrics_table(tuple(group_by) + ("category",), **filters)
+
+    def run_outcomes(self, code, metric):
+        # (dataset indices, outcomes) of one run, sorted by index
+        rows = slice(self.offsets[code], self.offsets[code + 1])
+        order = np.argsort(self.columns["index"][rows])
+        return self.columns["index"][rows][order], self.columns[METRICS[metric]][rows][order]
+
+    def bootstrap_weights(self, n, n_resamples, seed, max_cells=1 << 24):
+        # Yields n x chunk matrices of how often each item is drawn per resample, a few thousand
+        # resamples at a time, so memory stays at max_cells counts however many items there are. The
+        # stream depends only on (seed, n), so every comparison over n items sees the same resamples
+        rng = np.random.default_rng([seed, n])
+        chunk_size = max(1, min(n_resamples, max_cells // max(n, 1)))
+        for start in range(0, n_resamples, chunk_size):
+            size = min(chunk_size, n_resamples - start)
+            draws = rng.integers(0, n, size=(size, n)) + np.arange(size)[:, None] * n
+            yield np.bincount(draws.ravel(), minlength=size * n).reshape(size, n).T.astype(np.float32)
+
+    def paired_bootstrap(self, metric="accuracy", reference="NoneStrategy", pair_by=("listener", "persuader", "mode"),
+                         n_resamples=10000, alpha=0.05, seed=0, **filters):
+        # Every run against the reference strategy's run with the same pair_by values, on the items
+        # both have: the mean paired difference and a percentile CI from resampling items. All runs of
+        # a group share the resamples, drawn as item weights in chunks, two matrix products per chunk.
+        selected = self.mask(**filters)
+        run_codes = np.unique(self.columns["run"][selected])
+        groups = {}
+        for code in run_codes:
+            groups.setdefault(tuple(self.runs[code][c] for c in pair_by), []).append(code)
+        results = []
+        skipped = 0
+        for codes in groups.values():
+            reference_runs = [c for c in codes if self.runs[c]["strategy"] == reference]
+            if len(reference_runs) != 1:
+                skipped += 1
+                continue
+            others = [c for c in codes if c != reference_runs[0]]
+            if not others:
+                continue
+            # Item weights are drawn over the reference run's items; each run only counts the items it
+            # shares with the reference, so a partial run is compared on what it has
+            reference_indices, reference_values = self.run_outcomes(reference_runs[0], metric)
+            n = len(reference_indices)
+            differences = np.zeros((len(others), n), dtype=np.float32)
+            paired = np.zeros((len(others), n), dtype=np.float32)
+            for i, code in enumerate(others):
+                indices, values = self.run_outcomes(code, metric)
+                shared = np.isin(reference_indices, indices)
+                differences[i, shared] = values[np.searchsorted(indices, reference_indices[shared])].astype(np.float64) - reference_values[shared]
+                paired[i, shared] = 1
+            resampled = np.empty((len(others), n_resamples), dtype=np.float32)
+            start = 0
+            for weights in self.bootstrap_weights(n, n_resamples, seed):
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    resampled[:, start:start + weights.shape[1]] = (differences @ weights) / (paired @ weights)
+                start += weights.shape[1]
+            # A resample can miss every paired item of a small run
+            quantile = np.nanquantile if np.isnan(resampled).any() else np.quantile
+            low, high = quantile(resampled, [alpha / 2, 1 - alpha / 2], axis=1)
+            for i, code in enumerate(others):
+                items = int(paired[i].sum())
+                if items == 0:
+                    continue
+                results.append({
+                    **{c: self.runs[code][c] for c in RUN_COLUMNS},
+                    "reference": reference,
+                    "reference_persuader": self.runs[reference_runs[0]]["persuader"],
+                    "metric": metric,
+                    "items": items,
+                    "difference": float(differences[i].sum()) / items,
+                    "ci_low": float(low[i]),
+                    "ci_high": float(high[i]),
+                })
+        if skipped:
+            print(f"{metric}: skipped {skipped} of {len(groups)} {'/'.join(pair_by)} groups without exactly one {reference} run")
+        return results
+
+
+def write_csv(rows, path):
+    if not rows:
+        print(f"Nothing to write to {path}")
+        return
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Results saved to {path}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--results_dir', type=str, default='./results')
+    parser.add_argument('--store_dir', type=str, default=None, help="Parquet store (default: <results_dir>/.columnar)")
+    parser.add_argument('--output_dir', type=str, default='.', help="Where the CSV tables are written")
+    parser.add_argument('--label_cache', type=str, default=None,
+                        help="Prompt category cache written by eval_gpt4.py; without it every item is 'unlabeled'")
+    parser.add_argument('--reference', type=str, default='NoneStrategy', help="Strategy every other strategy is compared with")
+    parser.add_argument('--pair_by', type=str, nargs='+', default=['listener', 'persuader', 'mode'], choices=RUN_COLUMNS,
+                        help="A run is compared with the reference run that shares these; drop persuader when baselines use another persuader")
+    parser.add_argument('--n_resamples', type=int, default=10000)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    store_dir = args.store_dir or os.path.join(args.results_dir, '.columnar')
+    ingest(args.results_dir, store_dir, args.workers)
+    prompt_labels = None
+    if args.label_cache:
+        from eval_gpt4 import PromptLabelCache
+        prompt_labels = PromptLabelCache(args.label_cache).load()
+    store = ResultStore(store_dir, prompt_labels)
+    print(f"{len(store)} items from {len(store.values['run'])} runs")
+    os.makedirs(args.output_dir, exist_ok=True)
+    write_csv(store.metrics_table(), os.path.join(args.output_dir, 'results_metrics.csv'))
+    write_csv(store.category_table(), os.path.join(args.output_dir, 'results_metrics_by_category.csv'))
+    bootstrap_rows = []
+    for metric in METRICS:
+        bootstrap_rows += store.paired_bootstrap(metric, args.reference, args.pair_by, args.n_resamples, args.alpha, args.seed)
+    write_csv(bootstrap_rows, os.path.join(args.output_dir, 'results_bootstrap.csv'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import argparse
+import copy
+import io
+import json
+import os
+import random
+import time
+
+import yaml
+
+from instrumentation import configure_logging, peak_rss_bytes
+from model_pool import LOCAL_MODEL_TYPES
+from result_stream import ResultStream
+from strategy_agent import ListenerAgent
+
+
+# Compares the cpu_inference modes of one local model on a sample of counterfact items: answers of
+# every mode against the full-precision (fp32) answers, accuracy, weight memory and latency.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, required=True)
+    parser.add_argument('--model_type', type=str, required=True, choices=LOCAL_MODEL_TYPES)
+    parser.add_argument('--modes', type=str, nargs='+', default=['fp32', 'int8', 'bf16'],
+                        help="cpu_inference modes to compare; fp32 is always run first as the reference")
+    parser.add_argument('--num_items', type=int, default=100, help="Counterfact items sampled from dataset_path")
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--evidence_path', type=str, default=None,
+                        help="Persuader evidence .jsonl to answer with; without it the listener answers with no evidence")
+    parser.add_argument('--output_path', type=str, default=None, help="Where the JSON report is written")
+    parser.add_argument('--log_level', type=str, default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    return parser.parse_args()
+
+
+def weight_bytes(model):
+    # Serialized size of the weights, which counts packed int8 linear layers at their real size
+    import torch
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def run_mode(config, mode, model_type, items, evidence, batch_size):
+    mode_config = copy.deepcopy(config)
+    mode_config["cpu_inference"] = {**(config.get("cpu_inference") or {}), "enabled": True, "mode": mode}
+    # Every answer must come from the model under test
+    mode_config["generation_cache"] = {"enabled": False}
+    mode_config["inference_server"] = {"enabled": False}
+    listener = ListenerAgent(mode_config, "Listener")
+    start = time.perf_counter()
+    model, _ = listener.get_model_and_tokenizer(model_type)
+    load_seconds = time.perf_counter() - start
+    loaded_mode = getattr(model, "cpu_inference_mode", mode)
+    size = weight_bytes(model)
+
+    answers = []
+    start = time.perf_counter()
+    for batch_start in range(0, len(items), batch_size):
+        batch = items[batch_start:batch_start + batch_size]
+        question_lists = [[d["prompt"] for d in batch], [d["rephrase_prompt"] for d in batch], [d["locality_prompt"] for d in batch]]
+        batch_answers = listener.batch_generate_answers(question_lists, evidence[batch_start:batch_start + batch_size], model_type)
+        answers.extend(zip(*batch_answers))
+    seconds = time.perf_counter() - start
+    listener.close()
+
+    correct = sum(d["target_new"] in answer for d, (answer, _, _) in zip(items, answers))
+    robust = sum(d["target_new"] in rephrase for d, (_, rephrase, _) in zip(items, answers))
+    locality = sum(d["locality_ground_truth"] in loc for d, (_, _, loc) in zip(items, answers))
+    return answers, {
+        "mode": loaded_mode,
+        "load_seconds": load_seconds,
+        "weight_bytes": size,
+        "seconds": seconds,
+        "seconds_per_item": seconds / len(items),
+        "accuracy": correct / len(items),
+        "rephrase_accuracy": robust / len(items),
+        "locality_accuracy": locality / len(items),
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def main():
+    args = parse_args()
+    configure_logging(args.log_level)
+    with open(args.config_path) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    with open(config["dataset_path"]) as f:
+        dataset = json.load(f)
+    indices = sorted(random.Random(args.seed).sample(range(len(dataset)), min(args.num_items, len(dataset))))
+    items = [dataset[i] for i in indices]
+    if args.evidence_path:
+        stored = ResultStream(args.evidence_path).load()
+        missing = [i for i in indices if i not in stored]
+        if missing:
+            raise ValueError(f"No stored evidence for items {missing} in {args.evidence_path}")
+        evidence = [stored[i]["evidence"] for i in indices]
+    else:
+        evidence = [""] * len(items)
+
+    modes = ['fp32'] + [mode for mode in args.modes if mode != 'fp32']
+    reference = None
+    report = {"model_type": args.model_type, "items": indices, "modes": {}}
+    for mode in modes:
+        print(f"Running {args.model_type} in {mode} mode on {len(items)} items")
+        answers, stats = run_mode(config, mode, args.model_type, items, evidence, args.batch_size)
+        if reference is None:
+            reference, reference_stats = answers, stats
+        # Peak RSS only grows within a process, so it is reported but not compared
+        stats["answer_agreement"] = sum(a == r for answer, ref in zip(answers, reference) for a, r in zip(answer, ref)) / (3 * len(items))
+        stats["accuracy_delta"] = stats["accuracy"] - reference_stats["accuracy"]
+        stats["weight_memory_saving"] = 1 - stats["weight_bytes"] / reference_stats["weight_bytes"]
+        stats["speedup"] = reference_stats["seconds"] / stats["seconds"]
+        report["modes"][mode] = stats
+
+    print(f"{'mode':>6} {'weights MB':>11} {'s/item':>8} {'speedup':>8} {'mem saved':>10} {'agree':>7} {'acc':>6} {'acc delta':>10}")
+    for mode, stats in report["modes"].items():
+        label = mode if stats["mode"] == mode else f"{mode}->{stats['mode']}"
+        print(f"{label:>6} {stats['weight_bytes'] / 2**20:>11.1f} {stats['seconds_per_item']:>8.3f} {stats['speedup']:>7.2f}x "
+              f"{stats['weight_memory_saving']:>9.1%} {stats['answer_agreement']:>7.1%} {stats['accuracy']:>6.1%} {stats['accuracy_delta']:>+10.1%}")
+    if args.output_path:
+        os.makedirs(os.path.dirname(args.output_path) or ".", exist_ok=True)
+        with open(args.output_path, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Report written to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from datasets import load_dataset, load_from_disk
+from tqdm import tqdm
+from trl import DPOTrainer
+from trl.data_utils import maybe_apply_chat_template, maybe_extract_prompt
+
+TOKENIZED_COLUMNS = ["prompt_input_ids", "chosen_input_ids", "rejected_input_ids"]
+SETTINGS_FILE = "preprocess.json"
+REF_LOGPS_FILE = "ref_logps.npy"
+REF_SETTINGS_FILE = "ref_logps.json"
+
+
+def get_tokenized_dir(data_path):
+    return os.path.splitext(data_path)[0] + ".tokenized"
+
+
+def preprocess_settings(data_path, tokenizer, args):
+    # Everything the stored token ids depend on; a mismatch means the shards are rebuilt
+    stat = os.stat(data_path)
+    return {
+        "data_path": os.path.abspath(data_path),
+        "data_size": stat.st_size,
+        "data_mtime": stat.st_mtime,
+        "tokenizer": tokenizer.name_or_path,
+        "vocab_size": len(tokenizer),
+        "max_prompt_length": args.max_prompt_length,
+        "max_completion_length": args.max_completion_length,
+        "max_length": args.max_length,
+        "truncation": "per_row",
+    }
+
+
+def truncate_row(row, max_length):
+    # concatenated_forward cuts the left-flushed batch to max_length as a whole, so a row that does not
+    # fit loses a different part depending on its batch mates. Cutting each row here (the start of the
+    # prompt first, as keep_end does, then the end of the completions) keeps that from ever happening,
+    # and the length column is the pair's padded footprint: the prompt plus the longer completion
+    prompt, chosen, rejected = row["prompt_input_ids"], row["chosen_input_ids"], row["rejected_input_ids"]
+    if max_length:
+        excess = len(prompt) + max(len(chosen), len(rejected)) - max_length
+        if excess > 0:
+            prompt = prompt[min(excess, len(prompt) - 1):]
+            chosen = chosen[:max_length - len(prompt)]
+            rejected = rejected[:max_length - len(prompt)]
+    return {
+        "prompt_input_ids": prompt,
+        "chosen_input_ids": chosen,
+        "rejected_input_ids": rejected,
+        "length": len(prompt) + max(len(chosen), len(rejected)),
+    }
+
+
+def build_tokenized_dataset(data_path, tokenizer, args, tokenized_dir):
+    # Same prompt extraction, chat template and tokenize_row as DPOTrainer._prepare_dataset, done once
+    # and saved as memory-mapped Arrow shards with a length column for the length-grouped sampler
+    dataset = load_dataset('json', data_files=data_path, split="train")
+    dataset = dataset.map(maybe_extract_prompt, num_proc=args.dataset_num_proc, desc="Extracting prompt")
+    dataset = dataset.map(maybe_apply_chat_template, fn_kwargs={"tokenizer": tokenizer, "tools": args.tools},
+                          num_proc=args.dataset_num_proc, desc="Applying chat template")
+    dataset = dataset.map(
+        DPOTrainer.tokenize_row,
+        remove_columns=["prompt", "chosen", "rejected"],
+        fn_kwargs={
+            "processing_class": tokenizer,
+            "max_prompt_length": args.max_prompt_length,
+            "max_completion_length": args.max_completion_length,
+            "add_special_tokens": False,
+        },
+        num_proc=args.dataset_num_proc,
+        desc="Tokenizing",
+    )
+    dataset = dataset.map(truncate_row, fn_kwargs={"max_length": args.max_length}, num_proc=args.dataset_num_proc, desc="Truncating")
+
+    # Written next to the final directory and swapped in, so an interrupted run never leaves half a dataset
+    tmp_dir = tokenized_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    dataset.save_to_disk(tmp_dir)
+    with open(os.path.join(tmp_dir, SETTINGS_FILE), "w") as f:
+        json.dump(preprocess_settings(data_path, tokenizer, args), f, indent=4)
+    shutil.rmtree(tokenized_dir, ignore_errors=True)
+    os.replace(tmp_dir, tokenized_dir)
+    print(f"Saved {len(dataset)} tokenized pairs to {tokenized_dir}")
+
+
+def load_tokenized_dataset(data_path, tokenizer, args, tokenized_dir=None):
+    tokenized_dir = tokenized_dir or get_tokenized_dir(data_path)
+    settings_path = os.path.join(tokenized_dir, SETTINGS_FILE)
+    stored = None
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            stored = json.load(f)
+    if stored != preprocess_settings(data_path, tokenizer, args):
+        if stored is not None:
+            print(f"{tokenized_dir} was built from other data or settings, rebuilding")
+        build_tokenized_dataset(data_path, tokenizer, args, tokenized_dir)
+    return load_from_disk(tokenized_dir)
+
+
+class PretokenizedDPOTrainer(DPOTrainer):
+    # Takes datasets from load_tokenized_dataset as they are instead of re-tokenizing them on every launch.
+    # With ref_logps_dir (normally the tokenized directory) the reference log-probs of every pair are
+    # computed once, stored there and fed to the loss as ref_chosen_logps / ref_rejected_logps, so
+    # training steps skip the forward passes with the adapter disabled
+    def __init__(self, *args, ref_logps_dir=None, **kwargs):
+        self.ref_logps_dir = ref_logps_dir
+        super().__init__(*args, **kwargs)
+
+    def _prepare_dataset(self, dataset, processing_class, args, dataset_name):
+        if all(column in dataset.column_names for column in TOKENIZED_COLUMNS):
+            return dataset
+        return super()._prepare_dataset(dataset, processing_class, args, dataset_name)
+
+    def reference_settings(self):
+        # The reference model is the base model (the adapter is disabled), scored on these exact shards
+        settings_path = os.path.join(self.ref_logps_dir, SETTINGS_FILE)
+        tokenized = None
+        if os.path.exists(settings_path):
+            with open(settings_path) as f:
+                tokenized = json.load(f)
+        base_model = self.accelerator.unwrap_model(self.model)
+        return {
+            "reference_model": base_model.config._name_or_path,
+            "ref_adapter_name": self.ref_adapter_name,
+            "tokenized": tokenized,
+            "rows": len(self.train_dataset),
+        }
+
+    def compute_reference_logps(self):
+        data_loader = self.accelerator.prepare(DataLoader(
+            self.train_dataset.remove_columns([c for c in self.train_dataset.column_names if c not in TOKENIZED_COLUMNS]),
+            batch_size=self.args.precompute_ref_batch_size or self.args.per_device_train_batch_size,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            shuffle=False,
+        ))
+        ref_chosen_logps = []
+        ref_rejected_logps = []
+        for padded_batch in tqdm(data_loader, desc="Reference log probs"):
+            ref_chosen_logp, ref_rejected_logp = self.compute_ref_log_probs(padded_batch)
+            ref_chosen_logp, ref_rejected_logp = self.accelerator.gather_for_metrics((ref_chosen_logp, ref_rejected_logp))
+            ref_chosen_logps.append(ref_chosen_logp.cpu())
+            ref_rejected_logps.append(ref_rejected_logp.cpu())
+        return torch.stack([torch.cat(ref_chosen_logps), torch.cat(ref_rejected_logps)], dim=1).float().numpy()
+
+    def load_reference_logps(self):
+        logps_path = os.path.join(self.ref_logps_dir, REF_LOGPS_FILE)
+        settings_path = os.path.join(self.ref_logps_dir, REF_SETTINGS_FILE)
+        settings = self.reference_settings()
+        if os.path.exists(settings_path) and os.path.exists(logps_path):
+            with open(settings_path) as f:
+                if json.load(f) == settings:
+                    return np.load(logps_path, mmap_mode="r")
+        # Iterating a DataLoader draws from the global RNG; keep the training order what it would have been
+        with torch.random.fork_rng():
+            logps = self.compute_reference_logps()
+        if self.accelerator.is_main_process:
+            with open(logps_path + ".tmp", "wb") as f:
+                np.save(f, logps)
+            os.replace(logps_path + ".tmp", logps_path)
+            with open(settings_path, "w") as f:
+                json.dump(settings, f, indent=4)
+            print(f"Saved reference log-probs of {len(logps)} pairs to {logps_path}")
+        self.accelerator.wait_for_everyone()
+        return logps
+
+    def get_train_dataloader(self):
+        if self.ref_logps_dir and "ref_chosen_logps" not in self.train_dataset.column_names:
+            logps = self.load_reference_logps()
+            self.train_dataset = self.train_dataset.add_column("ref_chosen_logps", np.asarray(logps[:, 0]))
+            self.train_dataset = self.train_dataset.add_column("ref_rejected_logps", np.asarray(logps[:, 1]))
+        return super().get_train_dataloader()
@@ -0,0 +1,140 @@
+import json
+import math
+import os
+import random
+from statistics import NormalDist
+
+
+# Adaptive evaluation: items are run in a seeded random order, so every prefix is a random sample
+# of the dataset, and after each batch a Wilson interval is computed for accuracy, robustness and
+# locality. The run stops once all three intervals are narrower than max_width, or once the
+# accuracy interval lies entirely above or below the reference run's accuracy.
+
+METRICS = {
+    "accuracy": ("correct", "false"),
+    "rephrase_accuracy": ("rephrase_correct", "rephrase_false"),
+    "locality_accuracy": ("locality_correct", "locality_false"),
+}
+
+
+class StopEarly(Exception):
+    pass
+
+
+def get_log_path(output_path):
+    # One line per look; kept as .jsonl so eval.py, which reads every .json under output_path, skips it
+    return os.path.splitext(output_path)[0] + ".early_stopping.jsonl"
+
+
+def wilson_interval(successes, n, alpha):
+    if n == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(1 - alpha / 2)
+    p = successes / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def look_alpha(alpha, look):
+    # alpha * 6 / (pi^2 k^2) sums to alpha over all looks k = 1, 2, ..., so the intervals of every
+    # look hold at once with probability at least 1 - alpha however often the run checks
+    return alpha * 6 / (math.pi ** 2 * look ** 2)
+
+
+class EarlyStopping:
+    def __init__(self, config, output_path, total_items):
+        self.max_width = config.get("max_width", 0.05)
+        self.alpha = config.get("alpha", 0.05)
+        self.min_items = config.get("min_items", 100)
+        self.seed = config.get("seed", 0)
+        self.reference_strategy = config.get("reference_strategy", "NoneStrategy")
+        self.reference_path = config.get("reference_path")
+        self.total_items = total_items
+        self.log_path = get_log_path(output_path)
+        self.reference_accuracy = None
+        self.records = []
+        if os.path.exists(self.log_path):
+            with open(self.log_path, encoding='utf-8') as f:
+                self.records = [json.loads(line) for line in f if line.strip()]
+        # Looks of earlier, interrupted invocations have already spent their share of alpha
+        self.looks = len(self.records)
+
+    @classmethod
+    def from_config(cls, config, output_path, total_items):
+        early_stopping_config = config.get("early_stopping") or {}
+        if not early_stopping_config.get("enabled", False):
+            return None
+        return cls(early_stopping_config, output_path, total_items)
+
+    def settings(self):
+        return {"max_width": self.max_width, "alpha": self.alpha, "min_items": self.min_items, "seed": self.seed}
+
+    def settled(self):
+        # A run that stopped under the same settings is done; tightening them lets it continue
+        return bool(self.records) and self.records[-1]["status"] == "stopped" and self.records[-1]["settings"] == self.settings()
+
+    def order(self, indices):
+        permutation = list(range(self.total_items))
+        random.Random(self.seed).shuffle(permutation)
+        rank = {index: position for position, index in enumerate(permutation)}
+        return sorted(indices, key=rank.__getitem__)
+
+    def is_random_prefix(self, completed):
+        # Completed items only form a random sample if they are exactly the first ones of the seeded order
+        return set(self.order(range(self.total_items))[:len(completed)]) == set(completed)
+
+    def bounds(self, accuracy, alpha):
+        bounds = {}
+        for name, (correct, false) in METRICS.items():
+            successes = getattr(accuracy, correct)
+            bounds[name] = wilson_interval(successes, successes + getattr(accuracy, false), alpha)
+        return bounds
+
+    def check(self, accuracy):
+        self.looks += 1
+        items_used = accuracy.correct + accuracy.false
+        # The look's alpha is split evenly over the three metrics
+        alpha = look_alpha(self.alpha, self.looks) / len(METRICS)
+        bounds = self.bounds(accuracy, alpha)
+        reason = None
+        if items_used >= self.min_items:
+            lower, upper = bounds["accuracy"]
+            if all(high - low <= self.max_width for low, high in bounds.values()):
+                reason = f"all intervals narrower than {self.max_width}"
+            elif self.reference_accuracy is not None and lower > self.reference_accuracy:
+                reason = f"accuracy above reference {self.reference_accuracy:.4f}"
+            elif self.reference_accuracy is not None and upper < self.reference_accuracy:
+                reason = f"accuracy below reference {self.reference_accuracy:.4f}"
+        self.write("stopped" if reason else "running", accuracy, bounds, alpha, reason)
+        if reason:
+            raise StopEarly(reason)
+
+    def finish(self, accuracy):
+        # Ran out of items before the bounds settled; the last look's intervals are kept
+        alpha = look_alpha(self.alpha, max(self.looks, 1)) / len(METRICS)
+        self.write("completed", accuracy, self.bounds(accuracy, alpha), alpha, None)
+
+    def write(self, status, accuracy, bounds, alpha, reason):
+        record = {
+            "status": status,
+            "reason": reason,
+            "items_used": accuracy.correct + accuracy.false,
+            "total_items": self.total_items,
+            "look": self.looks,
+            "look_alpha": alpha,
+            "estimates": dict(zip(METRICS, accuracy.current())),
+            "bounds": {name: list(bound) for name, bound in bounds.items()},
+            "reference_path": self.reference_path,
+            "reference_accuracy": self.reference_accuracy,
+            "settings": self.settings(),
+        }
+        self.records.append(record)
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def summary(self):
+        record = self.records[-1]
+        bounds = ", ".join(f"{name} {record['estimates'][name]:.4f} [{lower:.4f}, {upper:.4f}]" for name, (lower, upper) in record["bounds"].items())
+        return f"{record['status']} after {record['items_used']}/{record['total_items']} items: {bounds}" + (f" ({record['reason']})" if record["reason"] else "")
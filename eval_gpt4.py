@@ -1,138 +1,146 @@
 import os
 import json
 import csv
+import sqlite3
 from glob import glob
-from openai import OpenAI
-import time
+from async_chat_client import AsyncChatClient
+from metrics_aggregator import aggregate, overall_metrics, summarize_file
 
-client = OpenAI(
-    api_key="", # Replace with your OpenAI API key
-    base_url="" # Replace with your OpenAI API base URL
-)
+API_KEY = ""  # Replace with your OpenAI API key
+BASE_URL = ""  # Replace with your OpenAI API base URL
 
 CATEGORIES = ['person', 'geo', 'culture', 'life']
-CACHE_PATH = './results/llama3/prompt_category_cache.json'
-
-def classify_prompt_with_gpt(prompt):
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a classification assistant. "
-                        "Classify the given prompt into one of: 'person', 'geo', 'culture', or 'life'. "
-                        "Definitions:\n"
-                        "- person: specific individual or historical figure\n"
-                        "- geo: cities, countries, or physical places\n"
-                        "- culture: topics like media, art, language, history\n"
-                        "- life: daily topics, tech, lifestyle, products, education\n\n"
-                        "Respond with ONLY one label: person, geo, culture, or life."
-                    )
-                },
-                {"role": "user", "content": f"Prompt: {prompt}"}
-            ],
-            temperature=0
-        )
-        label = response.choices[0].message.content.strip().lower()
-        print(f"Classified successfully: {prompt} -> {label}")
-        if label in CATEGORIES:
-            return label
-        print(f"Invalid Classification: {prompt} -> {label}")
-        return None
-    except Exception as e:
-        print(f"Classified unsuccessfully: {prompt} -> {e}")
-        return None
-
-def load_or_create_cache(results_dir):
-    if os.path.exists(CACHE_PATH):
-        with open(CACHE_PATH, 'r', encoding='utf-8') as f:
-            cache = json.load(f)
-        print(f"Loaded class cache (total {len(cache)} items)")
-    else:
-        cache = {}
-        print("No cache was detected. Create the cache while processing.")
+CACHE_PATH = './results/llama3/prompt_category_cache.sqlite'
+LEGACY_CACHE_PATH = './results/llama3/prompt_category_cache.json'
+
+# Classification throughput: prompts are sent concurrently, committed to the cache batch by batch
+CLASSIFY_BATCH_SIZE = 256
+CLASSIFY_CONCURRENCY = 16
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 150000
+
+CLASSIFY_SYSTEM_PROMPT = (
+    "You are a classification assistant. "
+    "Classify the given prompt into one of: 'person', 'geo', 'culture', or 'life'. "
+    "Definitions:\n"
+    "- person: specific individual or historical figure\n"
+    "- geo: cities, countries, or physical places\n"
+    "- culture: topics like media, art, language, history\n"
+    "- life: daily topics, tech, lifestyle, products, education\n\n"
+    "Respond with ONLY one label: person, geo, culture, or life."
+)
 
+class PromptLabelCache:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS prompt_labels (prompt TEXT PRIMARY KEY, label TEXT NOT NULL)")
+        self.conn.commit()
+
+    def load(self):
+        return dict(self.conn.execute("SELECT prompt, label FROM prompt_labels"))
+
+    def put_many(self, items):
+        # One transaction per batch: a crash loses at most the batch in flight
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO prompt_labels (prompt, label) VALUES (?, ?)", items)
+
+    def import_legacy_json(self, json_path):
+        with open(json_path, 'r', encoding='utf-8') as f:
+            legacy = json.load(f)
+        self.put_many([(prompt, label) for prompt, label in legacy.items() if label in CATEGORIES])
+
+def parse_label(prompt, content):
+    label = (content or "").strip().lower()
+    if label in CATEGORIES:
+        return label
+    print(f"Invalid Classification: {prompt} -> {label}")
+    return None
+
+def classify_prompts(prompts, client):
+    message_lists = [
+        [
+            {"role": "system", "content": CLASSIFY_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Prompt: {prompt}"}
+        ]
+        for prompt in prompts
+    ]
+    contents = client.generate("gpt-4o", message_lists, max_tokens=8, temperature=0)
+    return [parse_label(prompt, content) for prompt, content in zip(prompts, contents)]
+
+def get_manifest_path(results_dir):
+    return os.path.join(results_dir, '.metrics_manifest.sqlite')
+
+def summarize_results(results_dir):
     all_json = glob(os.path.join(results_dir, '**', '*.json'), recursive=True)
-
-    for path in all_json:
-        with open(path, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    data = [data]
-            except:
-                continue
-
-        for item in data:
-            prompt = item.get('prompt')
-            if prompt and prompt not in cache:
-                label = classify_prompt_with_gpt(prompt)
-                if label:
-                    cache[prompt] = label
-                    with open(CACHE_PATH, 'w', encoding='utf-8') as f:
-                        json.dump(cache, f, ensure_ascii=False, indent=2)
-                    time.sleep(0.5)
+    return aggregate(all_json, get_manifest_path(results_dir))
+
+def collect_prompts(summaries):
+    prompts = {}
+    for summary in summaries.values():
+        for prompt in summary["prompts"]:
+            if prompt:
+                prompts[prompt] = None
+    return list(prompts)
+
+def load_or_create_cache(results_dir, summaries=None):
+    if summaries is None:
+        summaries = summarize_results(results_dir)
+    label_cache = PromptLabelCache(CACHE_PATH)
+    cache = label_cache.load()
+    if not cache and os.path.exists(LEGACY_CACHE_PATH):
+        label_cache.import_legacy_json(LEGACY_CACHE_PATH)
+        cache = label_cache.load()
+    print(f"Loaded class cache (total {len(cache)} items)")
+
+    # Every distinct prompt across all result files is classified once
+    unclassified = [prompt for prompt in collect_prompts(summaries) if prompt not in cache]
+    print(f"{len(unclassified)} unique prompts to classify")
+    if not unclassified:
+        return cache
+
+    client = AsyncChatClient(
+        API_KEY, BASE_URL,
+        concurrency=CLASSIFY_CONCURRENCY,
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE
+    )
+    for start in range(0, len(unclassified), CLASSIFY_BATCH_SIZE):
+        batch = unclassified[start:start + CLASSIFY_BATCH_SIZE]
+        labels = classify_prompts(batch, client)
+        classified = [(prompt, label) for prompt, label in zip(batch, labels) if label]
+        label_cache.put_many(classified)
+        cache.update(classified)
+        print(f"Classified {min(start + CLASSIFY_BATCH_SIZE, len(unclassified))}/{len(unclassified)} prompts")
 
     return cache
 
-def extract_metrics(json_path, prompt_label_cache):
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    if isinstance(data, dict):
-        data = [data]
-    
-    total = len(data)
-    correct = sum(1 for x in data if x.get('is_correct', False))
-    robust = sum(1 for x in data if x.get('is_robust', False))
-    locality = sum(1 for x in data if x.get('is_locality', False))
-    
-    acc = correct / total if total > 0 else 0
-    robust_acc = robust / total if total > 0 else 0
-    locality_acc = locality / total if total > 0 else 0
-
+def category_metrics(json_path, summary, prompt_label_cache):
+    result = overall_metrics(json_path, summary)
     category_count = {cat: 0 for cat in CATEGORIES}
     category_correct = {cat: 0 for cat in CATEGORIES}
-    
-    for x in data:
-        prompt = x.get("prompt", "")
+    for prompt, (count, correct) in summary["prompts"].items():
         label = prompt_label_cache.get(prompt)
         if label is None:
             continue
-        category_count[label] += 1
-        if x.get('is_correct', False):
-            category_correct[label] += 1
-
-    result = {
-        'file': os.path.basename(json_path),
-        'total': total,
-        'accuracy': acc,
-        'robust_accuracy': robust_acc,
-        'locality_accuracy': locality_acc
-    }
-
+        category_count[label] += count
+        category_correct[label] += correct
     for cat in CATEGORIES:
         result[f"{cat}_total"] = category_count[cat]
         result[f"{cat}_accuracy"] = (
             category_correct[cat] / category_count[cat]
             if category_count[cat] > 0 else 0
         )
-    
     return result
 
-def run_full_evaluation(results_dir):
-    cache = load_or_create_cache(results_dir)
+def extract_metrics(json_path, prompt_label_cache):
+    return category_metrics(json_path, summarize_file(json_path), prompt_label_cache)
 
-    all_json = glob(os.path.join(results_dir, '**', '*.json'), recursive=True)
-    metrics = []
-
-    for json_file in all_json:
-        try:
-            m = extract_metrics(json_file, cache)
-            metrics.append(m)
-        except Exception as e:
-            print(f"Error processing {json_file}: {e}")
+def run_full_evaluation(results_dir):
+    summaries = summarize_results(results_dir)
+    cache = load_or_create_cache(results_dir, summaries)
+    metrics = [category_metrics(json_file, summary, cache) for json_file, summary in summaries.items()]
 
     output_csv = os.path.join(results_dir, 'results_eval_with_categories.csv')
     fieldnames = ['file', 'total', 'accuracy', 'robust_accuracy', 'locality_accuracy']
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+_caches = {}
+
+
+def get_generation_cache(cache_config):
+    # One shared instance per database path, so hit/miss counters cover the whole process
+    if not cache_config or not cache_config.get("enabled", False):
+        return None
+    path = os.path.abspath(cache_config.get("path", "./cache/generations.sqlite"))
+    if path not in _caches:
+        max_size_mb = cache_config.get("max_size_mb")
+        _caches[path] = GenerationCache(
+            path,
+            max_entries=cache_config.get("max_entries"),
+            max_bytes=int(max_size_mb * 1024 * 1024) if max_size_mb else None,
+            read_only=cache_config.get("read_only", False),
+        )
+    return _caches[path]
+
+
+def make_cache_key(model_type, model_path, system_prompt, prompt, max_tokens, decoding_params):
+    payload = json.dumps(
+        [model_type, model_path, system_prompt, prompt, max_tokens, decoding_params],
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    def __init__(self, path, max_entries=None, max_bytes=None, read_only=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        if read_only:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Read-only generation cache not found: {path}")
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, timeout=60)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS generations ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS generations_last_access ON generations (last_access)")
+            self.conn.commit()
+        self._refresh_totals()
+
+    def _refresh_totals(self):
+        self.entries, self.total_bytes = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM generations"
+        ).fetchone()
+
+    def get_many(self, keys):
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT key, response FROM generations WHERE key IN ({placeholders})", chunk
+            ).fetchall()
+            found.update(rows)
+        self.hits += sum(1 for k in keys if k in found)
+        self.misses += sum(1 for k in keys if k not in found)
+        if found and not self.read_only:
+            now = time.time()
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE generations SET last_access = ? WHERE key = ?", [(now, k) for k in found]
+                )
+        return found
+
+    def put_many(self, items):
+        if self.read_only or not items:
+            return
+        now = time.time()
+        rows = [(k, v, len(v.encode("utf-8")), now) for k, v in dict(items).items()]
+        with self.conn:
+            # Replaced keys only change the size by the difference, they add no entry
+            replaced = {}
+            for start in range(0, len(rows), 500):
+                chunk = [r[0] for r in rows[start:start + 500]]
+                placeholders = ",".join("?" * len(chunk))
+                replaced.update(self.conn.execute(
+                    f"SELECT key, size FROM generations WHERE key IN ({placeholders})", chunk
+                ).fetchall())
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO generations (key, response, size, last_access) VALUES (?, ?, ?, ?)", rows
+            )
+        self.entries += len(rows) - len(replaced)
+        self.total_bytes += sum(r[2] for r in rows) - sum(replaced.values())
+        if (self.max_entries and self.entries > self.max_entries) or (self.max_bytes and self.total_bytes > self.max_bytes):
+            self.evict()
+
+    def evict(self):
+        # Drop least recently used rows until both limits are met with 10% headroom
+        self._refresh_totals()
+        with self.conn:
+            if self.max_entries and self.entries > self.max_entries:
+                excess = self.entries - int(self.max_entries * 0.9)
+                self.conn.execute(
+                    "DELETE FROM generations WHERE key IN "
+                    "(SELECT key FROM generations ORDER BY last_access, key LIMIT ?)", (excess,)
+                )
+            if self.max_bytes:
+                target = int(self.max_bytes * 0.9)
+                total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM generations").fetchone()[0]
+                if total > self.max_bytes:
+                    # Rows of one put_many share a timestamp, so the cut is a row count, not a time
+                    excess = 0
+                    for (size,) in self.conn.execute("SELECT size FROM generations ORDER BY last_access, key"):
+                        total -= size
+                        excess += 1
+                        if total <= target:
+                            break
+                    self.conn.execute(
+                        "DELETE FROM generations WHERE key IN "
+                        "(SELECT key FROM generations ORDER BY last_access, key LIMIT ?)", (excess,)
+                    )
+        self._refresh_totals()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0,
+            "entries": self.entries,
+            "size_bytes": self.total_bytes,
+            "read_only": self.read_only,
+        }
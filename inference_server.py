@@ -0,0 +1,374 @@
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+import yaml
+from transformers import DynamicCache
+
+from instrumentation import metrics, configure_logging
+from model_pool import load_model, LOCAL_MODEL_TYPES
+from strategy_agent import ModelConfig, ASSISTANT_PREFIXES, strip_assistant_prefix
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible chat completions server with continuous batching for the local models in config.yaml.")
+    parser.add_argument('--config_path', type=str, required=True)
+    parser.add_argument('--models', type=str, nargs='+', default=None, help="Model types to host (default: every local model in the config)")
+    parser.add_argument('--host', type=str, default=None)
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--log_level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    return parser.parse_args()
+
+
+class GenerationRequest:
+    def __init__(self, prompt_ids, max_new_tokens, sampling):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.sampling = sampling
+        self.generated = []
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+    @property
+    def footprint(self):
+        return len(self.prompt_ids) + self.max_new_tokens
+
+
+def sample_token(logits, sampling, seen_ids):
+    # logits: [vocab] for one row; mirrors the HF logits processors the local backend would apply
+    if sampling["repetition_penalty"] not in (None, 1.0) and seen_ids:
+        ids = torch.tensor(sorted(set(seen_ids)), device=logits.device)
+        scores = logits[ids]
+        logits[ids] = torch.where(scores < 0, scores * sampling["repetition_penalty"], scores / sampling["repetition_penalty"])
+    if not sampling["do_sample"]:
+        return int(logits.argmax())
+    logits = logits / max(sampling["temperature"] or 1.0, 1e-5)
+    if sampling["top_k"]:
+        kth = torch.topk(logits, min(sampling["top_k"], logits.shape[-1])).values[-1]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    probs = torch.softmax(logits.float(), dim=-1)
+    if sampling["top_p"] is not None and sampling["top_p"] < 1.0:
+        sorted_probs, order = torch.sort(probs, descending=True)
+        # Keep the smallest prefix whose mass reaches top_p, always at least the top token
+        drop = sorted_probs.cumsum(-1) - sorted_probs > sampling["top_p"]
+        probs = probs.scatter(0, order, sorted_probs.masked_fill(drop, 0.0))
+    return int(torch.multinomial(probs, 1))
+
+
+def left_pad_cache(cache, width):
+    # Grow every layer's keys/values on the left to `width` positions; padded slots are masked out
+    layers = []
+    for keys, values in cache.to_legacy_cache():
+        pad = width - keys.shape[2]
+        if pad > 0:
+            keys = torch.nn.functional.pad(keys, (0, 0, pad, 0))
+            values = torch.nn.functional.pad(values, (0, 0, pad, 0))
+        layers.append((keys, values))
+    return layers
+
+
+class ContinuousBatcher:
+    # Iteration-level scheduling for one model: requests join the running batch between decode
+    # steps (after a prefill of their own) and leave as soon as they finish, so concurrent clients
+    # fill each other's batches instead of waiting for a whole batch to drain.
+    def __init__(self, model_type, model, tokenizer, max_batch_size=None, max_batch_tokens=None):
+        self.model_type = model_type
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.incoming = queue.Queue()
+        self.waiting = deque()
+        eos = model.generation_config.eos_token_id
+        self.eos_ids = set(eos if isinstance(eos, list) else [eos] if eos is not None else [])
+        self.eos_ids.add(tokenizer.eos_token_id)
+        self.default_sampling = {
+            name: getattr(model.generation_config, name, None)
+            for name in ["do_sample", "temperature", "top_p", "top_k", "repetition_penalty"]
+        }
+        if getattr(model.generation_config, "num_beams", 1) not in (None, 1):
+            logger.warning(f"{model_type}: beam search is not supported by the server, decoding greedily")
+        self.thread = threading.Thread(target=self.run, name=f"batcher-{model_type}", daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt_ids, max_new_tokens, sampling_overrides):
+        sampling = dict(self.default_sampling)
+        sampling.update({k: v for k, v in sampling_overrides.items() if v is not None})
+        # An explicit temperature picks the decoding mode as in the OpenAI API; without one the
+        # model's generation_config decides, exactly like the in-process backend
+        if sampling_overrides.get("temperature") is not None:
+            sampling["do_sample"] = sampling_overrides["temperature"] > 0
+        request = GenerationRequest(prompt_ids, max_new_tokens, sampling)
+        self.incoming.put(request)
+        return request.future
+
+    def admit(self, active):
+        # Move requests from the waiting line into the batch while the padded footprint fits the budget
+        block = not active and not self.waiting
+        while True:
+            try:
+                self.waiting.append(self.incoming.get(block=block))
+            except queue.Empty:
+                break
+            block = False
+        admitted = []
+        width = max((r.footprint for r in active), default=0)
+        while self.waiting:
+            request = self.waiting[0]
+            rows = len(active) + len(admitted) + 1
+            new_width = max(width, request.footprint)
+            if active or admitted:
+                if self.max_batch_size and rows > self.max_batch_size:
+                    break
+                if self.max_batch_tokens and rows * new_width > self.max_batch_tokens:
+                    break
+            admitted.append(self.waiting.popleft())
+            width = new_width
+        return admitted
+
+    def prefill(self, requests):
+        device = self.model.device
+        pad_id = self.tokenizer.pad_token_id
+        width = max(len(r.prompt_ids) for r in requests)
+        input_ids = torch.tensor([[pad_id] * (width - len(r.prompt_ids)) + r.prompt_ids for r in requests], device=device)
+        mask = torch.tensor([[0] * (width - len(r.prompt_ids)) + [1] * len(r.prompt_ids) for r in requests], device=device)
+        output = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=(mask.cumsum(-1) - 1).clamp(min=0),
+            past_key_values=DynamicCache(),
+            use_cache=True,
+            logits_to_keep=1
+        )
+        return output.past_key_values, mask, mask.sum(-1), output.logits[:, -1]
+
+    def pick_tokens(self, requests, logits):
+        if all(not r.sampling["do_sample"] and r.sampling["repetition_penalty"] in (None, 1.0) for r in requests):
+            tokens = logits.argmax(dim=-1).tolist()
+        else:
+            tokens = [sample_token(logits[i].clone(), r.sampling, r.prompt_ids + r.generated) for i, r in enumerate(requests)]
+        for request, token in zip(requests, tokens):
+            request.generated.append(token)
+        return tokens
+
+    def finish(self, request):
+        generated = request.generated
+        finish_reason = "length"
+        if generated and generated[-1] in self.eos_ids:
+            generated = generated[:-1]
+            finish_reason = "stop"
+        text = self.tokenizer.decode(generated, skip_special_tokens=True)
+        if self.model_type in ASSISTANT_PREFIXES:
+            text = strip_assistant_prefix(text, self.model_type)
+        metrics.record_generation(self.model_type, time.perf_counter() - request.submitted, 1, len(request.prompt_ids), len(request.generated))
+        request.future.set_result({
+            "text": text,
+            "finish_reason": finish_reason,
+            "prompt_tokens": len(request.prompt_ids),
+            "completion_tokens": len(request.generated),
+        })
+
+    def run(self):
+        active = []
+        cache = mask = positions = next_tokens = None
+        while True:
+            admitted = []
+            try:
+                with torch.no_grad():
+                    admitted = self.admit(active)
+                    if admitted:
+                        new_cache, new_mask, new_positions, logits = self.prefill(admitted)
+                        new_tokens = self.pick_tokens(admitted, logits)
+                        if active:
+                            # Merge into the running batch, left-padding whichever side is narrower
+                            width = max(mask.shape[1], new_mask.shape[1])
+                            cache = DynamicCache.from_legacy_cache(tuple(
+                                (torch.cat([k1, k2]), torch.cat([v1, v2]))
+                                for (k1, v1), (k2, v2) in zip(left_pad_cache(cache, width), left_pad_cache(new_cache, width))
+                            ))
+                            mask = torch.cat([
+                                torch.nn.functional.pad(mask, (width - mask.shape[1], 0)),
+                                torch.nn.functional.pad(new_mask, (width - new_mask.shape[1], 0)),
+                            ])
+                            positions = torch.cat([positions, new_positions])
+                            next_tokens = next_tokens + new_tokens
+                        else:
+                            cache, mask, positions, next_tokens = new_cache, new_mask, new_positions, new_tokens
+                        active = active + admitted
+
+                    # Retire finished rows and drop leading columns no remaining row attends to
+                    keep = [i for i, r in enumerate(active)
+                            if r.generated[-1] not in self.eos_ids and len(r.generated) < r.max_new_tokens]
+                    if len(keep) < len(active):
+                        for i, request in enumerate(active):
+                            if i not in keep:
+                                self.finish(request)
+                        active = [active[i] for i in keep]
+                        if not active:
+                            cache = mask = positions = next_tokens = None
+                            continue
+                        index = torch.tensor(keep, device=mask.device)
+                        cache.batch_select_indices(index)
+                        mask = mask[index]
+                        positions = positions[index]
+                        next_tokens = [next_tokens[i] for i in keep]
+                        start = int(mask.any(dim=0).int().argmax())
+                        if start > 0:
+                            cache = DynamicCache.from_legacy_cache(tuple((k[:, :, start:], v[:, :, start:]) for k, v in cache.to_legacy_cache()))
+                            mask = mask[:, start:]
+
+                    # One decode step for the whole running batch
+                    mask = torch.cat([mask, mask.new_ones(len(active), 1)], dim=1)
+                    output = self.model(
+                        input_ids=torch.tensor(next_tokens, device=mask.device)[:, None],
+                        attention_mask=mask,
+                        position_ids=positions[:, None],
+                        past_key_values=cache,
+                        use_cache=True
+                    )
+                    cache = output.past_key_values
+                    positions = positions + 1
+                    next_tokens = self.pick_tokens(active, output.logits[:, -1])
+            except Exception as e:
+                # Fail the affected requests and keep serving; requests admitted in this step are not
+                # part of `active` yet when their prefill or the cache merge raises
+                logger.exception(f"{self.model_type}: batch failed")
+                for request in active + admitted:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                active = []
+                cache = mask = positions = next_tokens = None
+
+
+class InferenceServer(ThreadingHTTPServer):
+    request_queue_size = 256
+    daemon_threads = True
+
+    def __init__(self, address, batchers, timeout):
+        super().__init__(address, ChatCompletionsHandler)
+        self.batchers = batchers
+        self.timeout = timeout
+
+
+class ChatCompletionsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {"error": {"message": message, "type": "invalid_request_error" if status < 500 else "server_error"}})
+
+    def do_GET(self):
+        if self.path.rstrip("/") in ("/health", "/v1/health"):
+            self.send_json(200, {"status": "ok"})
+        elif self.path.rstrip("/") == "/v1/models":
+            self.send_json(200, {"object": "list", "data": [{"id": name, "object": "model", "owned_by": "local"} for name in self.server.batchers]})
+        elif self.path.rstrip("/") == "/metrics":
+            data = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        if self.path.rstrip("/") not in ("/v1/chat/completions", "/chat/completions"):
+            self.send_error_json(404, f"Unknown path {self.path}")
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self.send_error_json(400, "Request body is not valid JSON")
+            return
+        batcher = self.server.batchers.get(body.get("model"))
+        if batcher is None:
+            self.send_error_json(404, f"Model {body.get('model')!r} is not served here; available: {list(self.server.batchers)}")
+            return
+        if body.get("n", 1) != 1 or body.get("stream"):
+            self.send_error_json(400, "Only n=1 without streaming is supported")
+            return
+        # Rendered exactly like Agent.generate_with_models, so both backends return the same completions
+        prompt_ids = batcher.tokenizer.apply_chat_template(body["messages"])
+        future = batcher.submit(prompt_ids, body.get("max_tokens") or body.get("max_completion_tokens") or 200, {
+            "temperature": body.get("temperature"),
+            "top_p": body.get("top_p"),
+        })
+        try:
+            result = future.result(timeout=self.server.timeout)
+        except Exception as e:
+            self.send_error_json(500, str(e))
+            return
+        self.send_json(200, {
+            "id": f"chatcmpl-{id(future):x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": result["text"]}, "finish_reason": result["finish_reason"]}],
+            "usage": {
+                "prompt_tokens": result["prompt_tokens"],
+                "completion_tokens": result["completion_tokens"],
+                "total_tokens": result["prompt_tokens"] + result["completion_tokens"],
+            },
+        })
+
+
+def build_batchers(config, model_types=None):
+    model_config = ModelConfig(config)
+    batching = config.get("batching") or {}
+    model_types = model_types or [m for m in model_config.model_paths if m in LOCAL_MODEL_TYPES]
+    batchers = {}
+    for model_type in model_types:
+        if model_type not in LOCAL_MODEL_TYPES:
+            raise ValueError(f"Only local models can be served, got {model_type}")
+        print(f"Loading {model_type} from {model_config.model_paths[model_type]}")
+        model, tokenizer = load_model(model_type, model_config)
+        model.eval()
+        batchers[model_type] = ContinuousBatcher(
+            model_type, model, tokenizer,
+            max_batch_size=batching.get("max_batch_size"),
+            max_batch_tokens=batching.get("max_batch_tokens"),
+        )
+    return batchers
+
+
+def main():
+    args = parse_args()
+    configure_logging(args.log_level)
+    with open(args.config_path) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    server_config = config.get("inference_server") or {}
+    host = args.host or server_config.get("host", "127.0.0.1")
+    port = args.port if args.port is not None else server_config.get("port", 8000)
+    batchers = build_batchers(config, args.models)
+    server = InferenceServer((host, port), batchers, server_config.get("timeout", 600.0))
+    print(f"Serving {list(batchers)} on http://{host}:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import json
+import logging
+import math
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+def configure_logging(level):
+    logging.basicConfig(level=getattr(logging, level.upper()), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # The OpenAI SDK's HTTP client logs every request at INFO
+    logging.getLogger("httpx").setLevel(max(logging.WARNING, logging.getLogger().level))
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def percentile(values, q):
+    # Nearest-rank percentile of an unsorted list
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # The smallest value with at least a fraction q of the values at or below it
+    return ordered[max(0, math.ceil(round(q * len(ordered), 9)) - 1)]
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Instrumentation:
+    # Process-wide counters for the hot path. Phases nest: tokens recorded by a generate call
+    # are attributed to every phase currently open, so "persuader" and "listener" totals add up
+    # the generate calls made inside them.
+    LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.open_phases = []
+        self.phases = {}
+        self.generation = {}
+        self.api = {}
+
+    @contextmanager
+    def phase(self, name, items=0):
+        stats = self.phases.setdefault(name, {"calls": 0, "items": 0, "seconds": 0.0, "prompt_tokens": 0, "generated_tokens": 0})
+        self.open_phases.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats["seconds"] += time.perf_counter() - start
+            stats["calls"] += 1
+            stats["items"] += items
+            self.open_phases.remove(name)
+
+    def record_generation(self, model_type, seconds, sequences, prompt_tokens, generated_tokens):
+        stats = self.generation.setdefault(model_type, {"calls": 0, "sequences": 0, "seconds": 0.0, "prompt_tokens": 0, "generated_tokens": 0})
+        stats["calls"] += 1
+        stats["sequences"] += sequences
+        stats["seconds"] += seconds
+        stats["prompt_tokens"] += prompt_tokens
+        stats["generated_tokens"] += generated_tokens
+        for name in set(self.open_phases):
+            self.phases[name]["prompt_tokens"] += prompt_tokens
+            self.phases[name]["generated_tokens"] += generated_tokens
+
+    def record_api_request(self, model_name, latency, retries, failed):
+        # latency is None for requests that never succeeded
+        stats = self.api.setdefault(model_name, {"requests": 0, "retries": 0, "failures": 0, "latencies": []})
+        stats["requests"] += 1
+        stats["retries"] += retries
+        stats["failures"] += int(failed)
+        if latency is not None:
+            stats["latencies"].append(latency)
+
+    def summary(self):
+        def with_rate(stats):
+            return {**stats, "generated_tokens_per_second": stats["generated_tokens"] / stats["seconds"] if stats["seconds"] > 0 else 0.0}
+
+        api = {}
+        for model_name, stats in self.api.items():
+            api[model_name] = {
+                "requests": stats["requests"],
+                "retries": stats["retries"],
+                "failures": stats["failures"],
+                "latency_seconds": {f"p{int(q * 100)}": percentile(stats["latencies"], q) for q in self.LATENCY_QUANTILES},
+            }
+        summary = {
+            "wall_seconds": time.time() - self.started,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "phases": {name: with_rate(stats) for name, stats in self.phases.items()},
+            "generation": {model_type: with_rate(stats) for model_type, stats in self.generation.items()},
+            "api": api,
+        }
+        # Only if this process imported torch at all; never import it just to ask
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            summary["peak_cuda_bytes"] = torch.cuda.max_memory_allocated()
+        return summary
+
+    def prometheus_text(self):
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP persuasion_{name} {help_text}")
+            lines.append(f"# TYPE persuasion_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items())
+                lines.append(f"persuasion_{name}{{{label_text}}} {value}" if label_text else f"persuasion_{name} {value}")
+
+        metric("wall_seconds", "gauge", "Seconds since instrumentation started", [({}, summary["wall_seconds"])])
+        metric("peak_rss_bytes", "gauge", "Peak resident set size of the process", [({}, summary["peak_rss_bytes"])])
+        if "peak_cuda_bytes" in summary:
+            metric("peak_cuda_bytes", "gauge", "Peak CUDA memory allocated by torch", [({}, summary["peak_cuda_bytes"])])
+        for key, kind, help_text in [
+            ("seconds", "counter", "Wall time spent in the phase"),
+            ("calls", "counter", "Times the phase ran"),
+            ("items", "counter", "Dataset items processed by the phase"),
+            ("prompt_tokens", "counter", "Prompt tokens sent to models inside the phase"),
+            ("generated_tokens", "counter", "Tokens generated inside the phase"),
+            ("generated_tokens_per_second", "gauge", "Generated tokens per second of phase wall time"),
+        ]:
+            metric(f"phase_{key}_total" if kind == "counter" else f"phase_{key}", kind, help_text, [({"phase": name}, stats[key]) for name, stats in summary["phases"].items()])
+        for key, kind, help_text in [
+            ("seconds", "counter", "Time spent in generate calls"),
+            ("calls", "counter", "Generate calls"),
+            ("sequences", "counter", "Sequences generated"),
+            ("prompt_tokens", "counter", "Prompt tokens processed"),
+            ("generated_tokens", "counter", "Tokens generated"),
+            ("generated_tokens_per_second", "gauge", "Generated tokens per second of generate time"),
+        ]:
+            metric(f"generation_{key}_total" if kind == "counter" else f"generation_{key}", kind, help_text, [({"model": name}, stats[key]) for name, stats in summary["generation"].items()])
+        for key, help_text in [("requests", "Chat API requests"), ("retries", "Chat API retries"), ("failures", "Chat API requests that exhausted their retries")]:
+            metric(f"api_{key}_total", "counter", help_text, [({"model": name}, stats[key]) for name, stats in summary["api"].items()])
+        metric("api_latency_seconds", "summary", "Latency of successful chat API requests", [
+            ({"model": name, "quantile": q}, stats["latency_seconds"][f"p{int(q * 100)}"])
+            for name, stats in summary["api"].items() for q in self.LATENCY_QUANTILES
+        ])
+        for name, stats in self.api.items():
+            lines.append(f'persuasion_api_latency_seconds_sum{{model="{_escape_label(name)}"}} {sum(stats["latencies"])}')
+            lines.append(f'persuasion_api_latency_seconds_count{{model="{_escape_label(name)}"}} {len(stats["latencies"])}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_dir, run_name):
+        # <run_name>.json holds the summary and <run_name>.prom the node-exporter textfile format
+        os.makedirs(metrics_dir, exist_ok=True)
+        json_path = os.path.join(metrics_dir, f"{run_name}.json")
+        prom_path = os.path.join(metrics_dir, f"{run_name}.prom")
+        for path, text in [(json_path, json.dumps(self.summary(), indent=4)), (prom_path, self.prometheus_text())]:
+            with open(path + ".tmp", "w") as f:
+                f.write(text)
+            os.replace(path + ".tmp", path)
+        return json_path, prom_path
+
+
+metrics = Instrumentation()
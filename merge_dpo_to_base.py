@@ -1,23 +1,180 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModel
+import argparse
+import json
+import os
+import re
+import shutil
 
 base_model_path = "" # Specify the path to your base model
-model = AutoModelForCausalLM.from_pretrained(
-    base_model_path,
-    torch_dtype="auto",
-    device_map="auto",
-)
-
 adapter_checkpoint_path = "" # Specify the path to your adapter checkpoint
-model = PeftModel.from_pretrained(
-    model,
-    adapter_checkpoint_path,
-    torch_dtype="auto",
-)
+save_path = "" # Specify the path where you want to save the merged model
 
-model = model.merge_and_unload()
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--base_model_path', type=str, default=base_model_path)
+    parser.add_argument('--adapter_checkpoint_path', type=str, default=adapter_checkpoint_path)
+    parser.add_argument('--save_path', type=str, default=save_path)
+    parser.add_argument('--mode', type=str, default='memory', choices=['memory', 'streaming'],
+                        help="memory loads the whole model and merges with peft; streaming merges one tensor at a time, "
+                             "with peak memory about one shard")
+    return parser.parse_args()
 
-save_path = "" # Specify the path where you want to save the merged model
-model.save_pretrained(save_path)
-tokenizer = AutoTokenizer.from_pretrained(base_model_path)
-tokenizer.save_pretrained(save_path)
+def merge_in_memory(base_model_path, adapter_checkpoint_path, save_path):
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from peft import PeftModel
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model_path,
+        torch_dtype="auto",
+        device_map="auto",
+    )
+    model = PeftModel.from_pretrained(
+        model,
+        adapter_checkpoint_path,
+        torch_dtype="auto",
+    )
+    model = model.merge_and_unload()
+    model.save_pretrained(save_path)
+    tokenizer = AutoTokenizer.from_pretrained(base_model_path)
+    tokenizer.save_pretrained(save_path)
+
+def load_adapter(adapter_checkpoint_path):
+    # LoRA A/B per base module name, e.g. "model.layers.0.self_attn.q_proj" -> {"lora_A": ..., "lora_B": ...}
+    import torch
+    from safetensors.torch import load_file
+    with open(os.path.join(adapter_checkpoint_path, "adapter_config.json")) as f:
+        adapter_config = json.load(f)
+    if adapter_config.get("peft_type", "LORA") != "LORA" or adapter_config.get("use_dora"):
+        raise ValueError("Streaming merge supports plain LoRA adapters only, use --mode memory")
+    safetensors_path = os.path.join(adapter_checkpoint_path, "adapter_model.safetensors")
+    if os.path.exists(safetensors_path):
+        state_dict = load_file(safetensors_path)
+    else:
+        state_dict = torch.load(os.path.join(adapter_checkpoint_path, "adapter_model.bin"), map_location="cpu")
+    lora_weights = {}
+    for key, tensor in state_dict.items():
+        match = re.fullmatch(r"base_model\.model\.(.+)\.(lora_A|lora_B)\.weight", key)
+        if match is None:
+            # modules_to_save copies, embedding LoRA, biases...
+            raise ValueError(f"Streaming merge cannot handle adapter weight {key}, use --mode memory")
+        lora_weights.setdefault(match.group(1), {})[match.group(2)] = tensor
+    return adapter_config, lora_weights
+
+def lora_scaling(adapter_config, module_name):
+    # Same per-module rank/alpha lookup as peft's LoraModel._create_and_replace
+    pattern_keys = list(adapter_config.get("rank_pattern") or {}) + list(adapter_config.get("alpha_pattern") or {})
+    key = next((k for k in pattern_keys if re.match(rf".*\.{k}$", module_name)), module_name)
+    r = (adapter_config.get("rank_pattern") or {}).get(key, adapter_config["r"])
+    alpha = (adapter_config.get("alpha_pattern") or {}).get(key, adapter_config["lora_alpha"])
+    return alpha / r ** 0.5 if adapter_config.get("use_rslora") else alpha / r
+
+SAFETENSORS_DTYPES = {
+    "F64": "float64", "F32": "float32", "F16": "float16", "BF16": "bfloat16",
+    "I64": "int64", "I32": "int32", "I16": "int16", "I8": "int8", "U8": "uint8", "BOOL": "bool",
+}
+FLOAT_DTYPES = ["F64", "F32", "F16", "BF16"]
+
+def merged_dtype(base_model_path, first_dtype):
+    # The dtype torch_dtype="auto" loads the model in: the config's, else the checkpoint's first floating one
+    with open(os.path.join(base_model_path, "config.json")) as f:
+        return json.load(f).get("torch_dtype") or first_dtype
+
+def write_shard(path, base_shard_path, dtype, merge_tensor):
+    # Writes a safetensors file tensor by tensor: every shape and dtype is known from the base shard's
+    # header, so the output header goes first and then each merged tensor is appended and dropped
+    import struct
+    import torch
+    from safetensors import safe_open
+    codes = {name: code for code, name in SAFETENSORS_DTYPES.items()}
+    with safe_open(base_shard_path, framework="pt") as f:
+        header = {}
+        offset = 0
+        for key in f.keys():
+            tensor_slice = f.get_slice(key)
+            code = codes[dtype] if tensor_slice.get_dtype() in FLOAT_DTYPES else tensor_slice.get_dtype()
+            shape = tensor_slice.get_shape()
+            size = torch.Size(shape).numel() * getattr(torch, SAFETENSORS_DTYPES[code]).itemsize
+            header[key] = {"dtype": code, "shape": shape, "data_offsets": [offset, offset + size]}
+            offset += size
+        header_bytes = json.dumps({"__metadata__": {"format": "pt"}, **header}, separators=(",", ":")).encode()
+        header_bytes += b" " * (-len(header_bytes) % 8)
+        with open(path, "wb") as out:
+            out.write(struct.pack("<Q", len(header_bytes)))
+            out.write(header_bytes)
+            for key in header:
+                tensor = merge_tensor(key, f.get_tensor(key).to(getattr(torch, SAFETENSORS_DTYPES[header[key]["dtype"]])))
+                out.write(tensor.contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return offset
+
+def merge_streaming(base_model_path, adapter_checkpoint_path, save_path):
+    # Same arithmetic as peft's LoraLayer.merge on CPU: A and B are cast to the base weight dtype
+    # (computed in float32 for float16 weights), then W += transpose(B @ A) * scaling. Base shards
+    # are memory-mapped and each merged tensor is written out before the next one is read.
+    import torch
+    from safetensors import safe_open
+    if not os.path.isdir(base_model_path):
+        from huggingface_hub import snapshot_download
+        base_model_path = snapshot_download(base_model_path)
+    index_path = os.path.join(base_model_path, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            shard_names = sorted(set(json.load(f)["weight_map"].values()))
+    elif os.path.exists(os.path.join(base_model_path, "model.safetensors")):
+        shard_names = ["model.safetensors"]
+    else:
+        raise ValueError(f"No safetensors weights in {base_model_path}, use --mode memory")
+
+    adapter_config, lora_weights = load_adapter(adapter_checkpoint_path)
+    fan_in_fan_out = adapter_config.get("fan_in_fan_out", False)
+    dtype = None
+    for shard_name in shard_names:
+        with safe_open(os.path.join(base_model_path, shard_name), framework="pt") as f:
+            dtype = dtype or next((SAFETENSORS_DTYPES[f.get_slice(k).get_dtype()] for k in f.keys() if f.get_slice(k).get_dtype() in FLOAT_DTYPES), None)
+    dtype = merged_dtype(base_model_path, dtype)
+    merged = set()
+
+    def merge_tensor(key, tensor):
+        module_name = key[:-len(".weight")] if key.endswith(".weight") else None
+        if module_name not in lora_weights:
+            return tensor
+        weight_A = lora_weights[module_name]["lora_A"].to(tensor.dtype)
+        weight_B = lora_weights[module_name]["lora_B"].to(tensor.dtype)
+        if tensor.dtype == torch.float16:
+            delta = weight_B.float() @ weight_A.float()
+            delta = ((delta.T if fan_in_fan_out else delta) * lora_scaling(adapter_config, module_name)).to(tensor.dtype)
+        else:
+            delta = weight_B @ weight_A
+            delta = (delta.T if fan_in_fan_out else delta) * lora_scaling(adapter_config, module_name)
+        tensor += delta
+        merged.add(module_name)
+        return tensor
+
+    os.makedirs(save_path, exist_ok=True)
+    weight_map = {}
+    total_size = 0
+    for shard_name in shard_names:
+        total_size += write_shard(os.path.join(save_path, shard_name), os.path.join(base_model_path, shard_name), dtype, merge_tensor)
+        with safe_open(os.path.join(base_model_path, shard_name), framework="pt") as f:
+            weight_map.update((key, shard_name) for key in f.keys())
+        print(f"Merged {shard_name}")
+
+    missing = set(lora_weights) - merged
+    if missing:
+        raise ValueError(f"Adapter targets modules that are not in the base model: {sorted(missing)}")
+    if len(shard_names) > 1:
+        with open(os.path.join(save_path, "model.safetensors.index.json"), "w") as f:
+            json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, f, indent=2)
+    # Config, generation config and tokenizer files are taken over unchanged
+    for name in os.listdir(base_model_path):
+        path = os.path.join(base_model_path, name)
+        if os.path.isfile(path) and not name.endswith((".safetensors", ".bin", ".pt", ".pth")) and name != "model.safetensors.index.json":
+            shutil.copy(path, os.path.join(save_path, name))
+    print(f"Merged {len(merged)} LoRA modules into {save_path}")
+
+def main():
+    args = parse_args()
+    if args.mode == 'streaming':
+        merge_streaming(args.base_model_path, args.adapter_checkpoint_path, args.save_path)
+    else:
+        merge_in_memory(args.base_model_path, args.adapter_checkpoint_path, args.save_path)
+
+if __name__ == "__main__":
+    main()
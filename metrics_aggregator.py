@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_json_records(path, chunk_size=1 << 20):
+    # Yield the elements of a top-level JSON array one at a time without loading the whole
+    # file; a top-level object is yielded as a single record, like the eval scripts treat it
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = f.read(chunk_size)
+        pos = _SEPARATORS.match(buffer, 0).end()
+        if pos < len(buffer) and buffer[pos] != '[':
+            data = json.loads(buffer + f.read())
+            yield from ([data] if isinstance(data, dict) else data)
+            return
+        pos += 1
+        while True:
+            pos = _SEPARATORS.match(buffer, pos).end()
+            if pos >= len(buffer):
+                more = f.read(chunk_size)
+                if not more:
+                    raise ValueError(f"Unterminated JSON array in {path}")
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                more = f.read(chunk_size)
+                if not more:
+                    raise
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield record
+            pos = end
+            if pos > chunk_size:
+                buffer, pos = buffer[pos:], 0
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def summarize_file(path):
+    # Everything the eval scripts derive from a result file: overall counts, plus per-prompt
+    # counts so category breakdowns can be recomputed when labels change without re-parsing
+    summary = {"total": 0, "correct": 0, "robust": 0, "locality": 0, "prompts": {}}
+    for x in iter_json_records(path):
+        summary["total"] += 1
+        summary["correct"] += int(bool(x.get('is_correct', False)))
+        summary["robust"] += int(bool(x.get('is_robust', False)))
+        summary["locality"] += int(bool(x.get('is_locality', False)))
+        prompt = x.get("prompt", "")
+        counts = summary["prompts"].setdefault(prompt, [0, 0])
+        counts[0] += 1
+        counts[1] += int(bool(x.get('is_correct', False)))
+    return summary
+
+
+def _process_file(path, known_sha256):
+    try:
+        sha256 = file_sha256(path)
+        if sha256 == known_sha256:
+            return path, sha256, None, None
+        return path, sha256, summarize_file(path), None
+    except Exception as e:
+        return path, None, None, str(e)
+
+
+class MetricsManifest:
+    # (path, size, mtime, content hash) -> cached summary
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, sha256 TEXT NOT NULL, summary TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, path):
+        row = self.conn.execute("SELECT size, mtime_ns, sha256, summary FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        return {"size": row[0], "mtime_ns": row[1], "sha256": row[2], "summary": row[3]}
+
+    def put_many(self, rows):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256, summary) VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+
+def aggregate(paths, manifest_path, workers=None):
+    # Returns {path: summary} for every readable file, re-parsing only files whose size or mtime
+    # changed and whose content hash differs from the manifest; errors are printed and skipped
+    manifest = MetricsManifest(manifest_path)
+    summaries = {}
+    stale = {}
+    stats = {}
+    for path in paths:
+        key = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            # Rotated or removed since it was listed
+            print(f"Error processing {path}: file not found")
+            continue
+        stats[path] = (st.st_size, st.st_mtime_ns)
+        entry = manifest.get(key)
+        if entry is not None and (entry["size"], entry["mtime_ns"]) == stats[path]:
+            summaries[path] = json.loads(entry["summary"])
+        else:
+            stale[path] = entry
+
+    updates = []
+    if stale:
+        print(f"Parsing {len(stale)} new or changed of {len(paths)} result files")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_process_file, path, entry["sha256"] if entry else None)
+                for path, entry in stale.items()
+            ]
+            for future in futures:
+                path, sha256, summary, error = future.result()
+                if error is not None:
+                    print(f"Error processing {path}: {error}")
+                    continue
+                if summary is None:
+                    # Touched but unchanged content
+                    summary_text = stale[path]["summary"]
+                    summary = json.loads(summary_text)
+                else:
+                    summary_text = json.dumps(summary, ensure_ascii=False)
+                summaries[path] = summary
+                updates.append((os.path.abspath(path), stats[path][0], stats[path][1], sha256, summary_text))
+    manifest.put_many(updates)
+    return {path: summaries[path] for path in paths if path in summaries}
+
+
+def overall_metrics(path, summary):
+    total = summary["total"]
+    return {
+        'file': os.path.basename(path),
+        'total': total,
+        'accuracy': summary["correct"] / total if total > 0 else 0,
+        'robust_accuracy': summary["robust"] / total if total > 0 else 0,
+        'locality_accuracy': summary["locality"] / total if total > 0 else 0
+    }
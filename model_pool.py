@@ -0,0 +1,137 @@
+import gc
+import json
+import logging
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+LOCAL_MODEL_TYPES = ["llama3", "qwen", "falcon"]
+API_MODEL_TYPES = ["gpt4o", "gemini"]
+CPU_INFERENCE_MODES = ["int8", "bf16", "fp32"]
+
+
+def int8_engine_available():
+    # Dynamic int8 linear layers need one of the quantized CPU kernels compiled into torch
+    import torch
+    for engine in ["x86", "fbgemm", "onednn", "qnnpack"]:
+        if engine in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = engine
+            return True
+    return False
+
+
+def set_cpu_threads(cpu_config):
+    import torch
+    if cpu_config.get("num_threads"):
+        torch.set_num_threads(cpu_config["num_threads"])
+    if cpu_config.get("num_interop_threads"):
+        try:
+            torch.set_num_interop_threads(cpu_config["num_interop_threads"])
+        except RuntimeError:
+            # Only settable before the first inter-op parallel work in the process
+            logger.warning("num_interop_threads ignored: torch has already started its inter-op thread pool")
+
+
+def load_cpu_model(model_path, model_params, cpu_config):
+    # CPU-only inference: int8 dynamic quantization of the decoder's linear layers (lm_head stays in
+    # full precision), or plain bfloat16 / float32 weights. int8 falls back to bfloat16 when torch
+    # has no quantized kernels for this CPU.
+    import torch
+    from transformers import AutoModelForCausalLM
+    set_cpu_threads(cpu_config)
+    mode = cpu_config.get("mode", "int8")
+    if mode not in CPU_INFERENCE_MODES:
+        raise ValueError(f"Unsupported cpu_inference mode: {mode}, expected one of {CPU_INFERENCE_MODES}")
+    if mode == "int8" and not int8_engine_available():
+        logger.warning("No quantized CPU engine available, falling back to bf16")
+        mode = "bf16"
+    params = {k: v for k, v in model_params.items() if k not in ("torch_dtype", "device_map", "load_in_8bit", "load_in_4bit")}
+    model = AutoModelForCausalLM.from_pretrained(
+        model_path,
+        torch_dtype=torch.bfloat16 if mode == "bf16" else torch.float32,
+        low_cpu_mem_usage=True,
+        **params
+    )
+    model.eval()
+    if mode == "int8":
+        torch.ao.quantization.quantize_dynamic(model.get_decoder(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    model.cpu_inference_mode = mode
+    return model
+
+
+def load_model(model_type, model_config):
+    model_path = model_config.model_paths[model_type]
+    # Backends are imported on first load, so API-only runs never import torch or transformers
+    if model_type in LOCAL_MODEL_TYPES:
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+        tokenizer = AutoTokenizer.from_pretrained(model_path, torch_dtype=torch.float16, device_map='auto')
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+        tokenizer.padding_side = 'left'
+        if model_config.cpu_inference.get("enabled", False):
+            model = load_cpu_model(model_path, model_config.model_params, model_config.cpu_inference)
+        else:
+            model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                **model_config.model_params
+            )
+        return model, tokenizer
+    elif model_type in API_MODEL_TYPES:
+        from openai import OpenAI
+        client = OpenAI(
+            api_key=model_config.api_key,
+            base_url=model_config.base_url
+        )
+        return client, None
+    else:
+        raise ValueError(f"Unsupported model_type: {model_type}")
+
+
+class ModelPool:
+    # Process-wide registry: every Agent asking for the same model gets the same weights.
+    # Models are loaded on first acquire and unloaded once the last holder releases them.
+    def __init__(self):
+        self.entries = {}
+        self.refcounts = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_type, model_config):
+        if model_type in LOCAL_MODEL_TYPES:
+            settings = [model_config.model_paths[model_type], model_config.model_params, model_config.cpu_inference]
+        else:
+            settings = [model_config.api_key, model_config.base_url]
+        return model_type, json.dumps(settings, sort_keys=True, default=str)
+
+    def acquire(self, model_type, model_config):
+        key = self.make_key(model_type, model_config)
+        with self.lock:
+            if key not in self.entries:
+                logger.info("Loading %s from %s", model_type, model_config.model_paths[model_type])
+                self.entries[key] = load_model(model_type, model_config)
+                self.refcounts[key] = 0
+            self.refcounts[key] += 1
+            model, tokenizer = self.entries[key]
+        return key, model, tokenizer
+
+    def release(self, key):
+        with self.lock:
+            self.refcounts[key] -= 1
+            if self.refcounts[key] > 0:
+                return
+            del self.refcounts[key]
+            model, _ = self.entries.pop(key)
+            logger.info("Unloading idle model %s", key[0])
+        del model
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def loaded_model_types(self):
+        with self.lock:
+            return [key[0] for key in self.entries]
+
+
+model_pool = ModelPool()
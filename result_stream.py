@@ -0,0 +1,96 @@
+import argparse
+import json
+import logging
+import os
+from glob import glob
+
+logger = logging.getLogger(__name__)
+
+
+class ResultStream:
+    # Append-only JSONL file of result records keyed by their dataset "index". Every append is a
+    # single fsync'd O_APPEND write, so several processes on one host can append to one stream (NFS
+    # does not make O_APPEND atomic) and an interrupted run can at worst leave one torn line, which
+    # load() skips.
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping torn record in %s", self.path)
+                    continue
+                records[record["index"]] = record
+        return records
+
+    def append(self, records):
+        if not records:
+            return
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # Start on a fresh line if a crashed writer left a torn tail behind
+            size = os.fstat(fd).st_size
+            if size > 0 and os.pread(fd, 1, size - 1) != b"\n":
+                data = b"\n" + data
+            written = 0
+            while written < len(data):
+                written += os.write(fd, data[written:])
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def import_legacy_json(self, json_path):
+        # Results written by the old format are in dataset order, so position is the index
+        with open(json_path, 'r', encoding='utf-8') as f:
+            try:
+                results = json.load(f)
+            except Exception:
+                return {}
+        records = [{"index": i, **r} for i, r in enumerate(results)]
+        self.append(records)
+        return {r["index"]: r for r in records}
+
+
+def export_legacy_json(jsonl_path, json_path=None):
+    # Write the JSON array that eval.py / eval_gpt4.py read, ordered by dataset index
+    if json_path is None:
+        json_path = os.path.splitext(jsonl_path)[0] + ".json"
+    records = ResultStream(jsonl_path).load()
+    results = []
+    for index in sorted(records):
+        result = dict(records[index])
+        del result["index"]
+        results.append(result)
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as json_file:
+        json.dump(results, json_file, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, json_path)
+    return json_path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert JSONL result streams to the legacy JSON array format.")
+    parser.add_argument('paths', nargs='+', help="JSONL files or directories searched recursively")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for path in args.paths:
+        jsonl_files = glob(os.path.join(path, '**', '*.jsonl'), recursive=True) if os.path.isdir(path) else [path]
+        for jsonl_file in jsonl_files:
+            print(f"{jsonl_file} -> {export_legacy_json(jsonl_file)}")
+
+
+if __name__ == "__main__":
+    main()
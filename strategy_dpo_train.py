@@ -1,23 +1,60 @@
-from datasets import load_dataset
-from trl import DPOConfig, DPOTrainer
+import argparse
+from trl import DPOConfig
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from peft import LoraConfig, get_peft_model
+from dpo_dataset import get_tokenized_dir, load_tokenized_dataset, PretokenizedDPOTrainer
 
 max_seq_length = 512
 
-model = AutoModelForCausalLM.from_pretrained("", torch_dtype=torch.float32, device_map='auto') # Specify the path to your model
-tokenizer = AutoTokenizer.from_pretrained("") # Specify the path to your tokenizer
-train_dataset = load_dataset('json', data_files='', split="train") # Specify the path to your training data
+model_path = "" # Specify the path to your model
+tokenizer_path = "" # Specify the path to your tokenizer
+data_path = "" # Specify the path to your training data
+output_dir = "" # Specify the output directory for the model
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default=model_path)
+    parser.add_argument('--tokenizer_path', type=str, default=tokenizer_path)
+    parser.add_argument('--data_path', type=str, default=data_path)
+    parser.add_argument('--output_dir', type=str, default=output_dir)
+    parser.add_argument('--tokenized_dir', type=str, default=None,
+                        help="Tokenized Arrow shards (default: <data_path without extension>.tokenized)")
+    parser.add_argument('--stage', type=str, default='train', choices=['preprocess', 'train'],
+                        help="preprocess only writes the tokenized shards; train also (re)builds them when missing or stale")
+    parser.add_argument('--no_ref_logps_cache', action='store_true',
+                        help="Compute reference log-probs with the adapter disabled on every step instead of once")
+    return parser.parse_args()
+
+args = parse_args()
+tokenized_dir = args.tokenized_dir or get_tokenized_dir(args.data_path)
+
+training_args = DPOConfig(
+    output_dir=args.output_dir,
+    logging_steps=10,
+    save_steps=500,
+    num_train_epochs=1,
+    per_device_train_batch_size=32,
+    # Batches are drawn from runs of similar length (see the "length" column) to cut padding
+    group_by_length=True,
+    length_column_name="length",
+)
+
+tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+train_dataset = load_tokenized_dataset(args.data_path, tokenizer, training_args, tokenized_dir)
+if args.stage == 'preprocess':
+    raise SystemExit(0)
+
+model = AutoModelForCausalLM.from_pretrained(args.model_path, torch_dtype=torch.float32, device_map='auto')
 
 lora_config = LoraConfig(
     r=128,
     lora_alpha=64,
     target_modules=["q_proj", "k_proj", "v_proj", "o_proj",
                     "gate_proj", "up_proj", "down_proj"],
-    lora_dropout=0.0, 
-    bias="none",    
-    task_type="CAUSAL_LM",  
+    lora_dropout=0.0,
+    bias="none",
+    task_type="CAUSAL_LM",
 )
 
 model = get_peft_model(model, lora_config)
@@ -27,19 +64,13 @@ model.gradient_checkpointing_enable()
 model.config.use_cache = False
 
 
-training_args = DPOConfig(
-    output_dir="",  # Specify the output directory for the model
-    logging_steps=10,
-    save_steps=500,
-    num_train_epochs=1,
-    per_device_train_batch_size=32,
-)
-
-trainer = DPOTrainer(
-    model=model, 
-    args=training_args, 
+trainer = PretokenizedDPOTrainer(
+    model=model,
+    args=training_args,
     ref_model=None,
-    processing_class=tokenizer, 
+    processing_class=tokenizer,
     train_dataset=train_dataset,
+    # Reference log-probs are computed once and stored with the tokenized shards
+    ref_logps_dir=None if args.no_ref_logps_cache else tokenized_dir,
     )
-trainer.train()
\ No newline at end of file
+trainer.train()
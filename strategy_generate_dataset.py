@@ -1,8 +1,13 @@
 import os
 import json
 import random
-from collections import defaultdict
+import hashlib
+import argparse
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from metrics_aggregator import iter_json_records
 
 data_dir = "" # Specify the training data directory containing JSON files
 output_path = "" # Specify the output path for the DPO training data
@@ -13,22 +18,29 @@ prompt_prefix = (
     "Please continue chatting with others in a complete and long paragraph based on the topic ```{} {}```."
 )
 
-# key: prompt_text -> { "chosen": [evidence], "rejected": [evidence] }
-prompt_dict = defaultdict(lambda: {"chosen": [], "rejected": []})
-
-# Step 1: Aggregate data from all JSON files
-for filename in tqdm(os.listdir(data_dir)):
-    if not filename.endswith(".json"):
-        continue
-    path = os.path.join(data_dir, filename)
-    with open(path, "r") as f:
-        try:
-            data = json.load(f)
-        except Exception as e:
-            print(f"Failed to load {filename}: {e}")
-            continue
+num_pairs = 5
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=data_dir)
+    parser.add_argument('--output_path', type=str, default=output_path)
+    parser.add_argument('--seed', type=int, default=0, help="Seed for shuffling and pair sampling")
+    parser.add_argument('--num_buckets', type=int, default=64, help="Prompt partitions; peak memory is about one partition")
+    parser.add_argument('--workers', type=int, default=None)
+    return parser.parse_args()
 
-        for item in data:
+def bucket_of(prompt_text, num_buckets):
+    return int(hashlib.sha1(prompt_text.encode("utf-8")).hexdigest()[:8], 16) % num_buckets
+
+def partition_file(path, file_id, bucket_dir, num_buckets):
+    # Step 1: stream one result file and spill (prompt, evidence, is_correct) rows into per-bucket
+    # part files, so all rows of a prompt end up in the same bucket. Parts are written under a
+    # temporary name and renamed only once the whole file has been read, so a file that fails
+    # partway contributes no rows
+    handles = {}
+    error = None
+    try:
+        for item in iter_json_records(path):
             base_prompt = item.get("prompt", "").strip()
             target_new = item.get("target_new", "").strip()
             evidence = item.get("evidence", "").strip()
@@ -38,54 +50,107 @@ for filename in tqdm(os.listdir(data_dir)):
                 continue
 
             prompt_text = prompt_prefix.format(base_prompt, target_new)
+            bucket = bucket_of(prompt_text, num_buckets)
+            if bucket not in handles:
+                handles[bucket] = open(os.path.join(bucket_dir, f"{bucket:05d}", f"{file_id:06d}.jsonl.tmp"), "w", encoding="utf-8")
+            handles[bucket].write(json.dumps([prompt_text, evidence, bool(is_correct)], ensure_ascii=False) + "\n")
+    except Exception as e:
+        error = f"Failed to load {os.path.basename(path)}: {e}"
+    finally:
+        for handle in handles.values():
+            handle.close()
+    for handle in handles.values():
+        if error is None:
+            os.replace(handle.name, handle.name[:-len(".tmp")])
+        else:
+            os.remove(handle.name)
+    return error
 
-            if is_correct:
-                prompt_dict[prompt_text]["chosen"].append(evidence)
-            else:
-                prompt_dict[prompt_text]["rejected"].append(evidence)
-
-# Step 2: Generate DPO training data
-dpo_data = []
-for prompt_text, buckets in tqdm(prompt_dict.items()):
-    chosen_list = buckets["chosen"]
-    rejected_list = buckets["rejected"]
-    if not chosen_list or not rejected_list:
-        continue
-
+def sample_pairs(chosen_list, rejected_list, rng):
     # Shuffle both lists
-    random.shuffle(chosen_list)
-    random.shuffle(rejected_list)
+    rng.shuffle(chosen_list)
+    rng.shuffle(rejected_list)
 
     # First pair elements one by one to avoid duplication
-    pairs = list(zip(chosen_list, rejected_list))
-    
-    # If fewer than 5 pairs, fill the rest from all possible combinations
-    all_pairs = [(c, r) for c in chosen_list for r in rejected_list]
-    used_pairs = set(pairs)
-    remain = 5 - len(pairs)
-    if remain > 0:
-        # Remove already used pairs
-        unused_pairs = [pair for pair in all_pairs if pair not in used_pairs]
+    pairs = list(zip(chosen_list, rejected_list))[:num_pairs]
+    remain = num_pairs - len(pairs)
+    if remain <= 0:
+        return pairs
+
+    # If fewer than 5 pairs, fill the rest from the unused combinations. Combinations are addressed
+    # by flat index into chosen x rejected, so the product is never materialised
+    n_rejected = len(rejected_list)
+    total = len(chosen_list) * n_rejected
+    used = {i * n_rejected + i for i in range(len(pairs))}
+    if total - len(used) >= remain:
         # If enough unused pairs, sample from them
-        if len(unused_pairs) >= remain:
-            pairs += random.sample(unused_pairs, remain)
-        else:
-            pairs += unused_pairs
-            # If still not enough, randomly sample from all pairs
-            while len(pairs) < 5 and all_pairs:
-                pairs.append(random.choice(all_pairs))
-
-    # Keep at most 5 pairs
-    for chosen, rejected in pairs[:5]:
-        dpo_data.append({
-            "prompt": prompt_text,
-            "chosen": chosen,
-            "rejected": rejected
-        })
-
-# Step 3: Save as a JSONL file
-with open(output_path, "w", encoding="utf-8") as f:
-    for item in dpo_data:
-        f.write(json.dumps(item, ensure_ascii=False) + "\n")
-
-print(f"Saved {len(dpo_data)} DPO examples to {output_path}")
+        picked = []
+        while len(picked) < remain:
+            flat = rng.randrange(total)
+            if flat not in used:
+                used.add(flat)
+                picked.append(flat)
+    else:
+        picked = [flat for flat in range(total) if flat not in used]
+        # If still not enough, randomly sample from all pairs
+        while len(picked) < remain:
+            picked.append(rng.randrange(total))
+    return pairs + [(chosen_list[flat // n_rejected], rejected_list[flat % n_rejected]) for flat in picked]
+
+def build_bucket(bucket_path, seed):
+    # Step 2: group one bucket's rows by prompt, in file order, and pair them up
+    prompt_dict = {}
+    for part in sorted(os.listdir(bucket_path)):
+        with open(os.path.join(bucket_path, part), "r", encoding="utf-8") as f:
+            for line in f:
+                prompt_text, evidence, is_correct = json.loads(line)
+                buckets = prompt_dict.setdefault(prompt_text, {"chosen": [], "rejected": []})
+                buckets["chosen" if is_correct else "rejected"].append(evidence)
+    for prompt_text, buckets in prompt_dict.items():
+        if not buckets["chosen"] or not buckets["rejected"]:
+            continue
+        # A per-prompt generator keeps the output independent of bucket and worker layout
+        rng = random.Random(f"{seed}:{prompt_text}")
+        for chosen, rejected in sample_pairs(buckets["chosen"], buckets["rejected"], rng):
+            yield {
+                "prompt": prompt_text,
+                "chosen": chosen,
+                "rejected": rejected
+            }
+
+def build_dataset(data_dir, output_path, seed=0, num_buckets=64, workers=None):
+    filenames = sorted(f for f in os.listdir(data_dir) if f.endswith(".json"))
+    work_dir = tempfile.mkdtemp(prefix="dpo_buckets_", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        for bucket in range(num_buckets):
+            os.makedirs(os.path.join(work_dir, f"{bucket:05d}"))
+
+        # Step 1: Partition data from all JSON files in parallel
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(partition_file, os.path.join(data_dir, filename), file_id, work_dir, num_buckets)
+                for file_id, filename in enumerate(filenames)
+            ]
+            for future in tqdm(futures):
+                error = future.result()
+                if error:
+                    print(error)
+
+        # Step 2 + 3: Generate DPO training data bucket by bucket and stream it out as JSONL
+        count = 0
+        with open(output_path, "w", encoding="utf-8") as f:
+            for bucket in tqdm(range(num_buckets)):
+                for item in build_bucket(os.path.join(work_dir, f"{bucket:05d}"), seed):
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+                    count += 1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return count
+
+def main():
+    args = parse_args()
+    count = build_dataset(args.data_dir, args.output_path, args.seed, args.num_buckets, args.workers)
+    print(f"Saved {count} DPO examples to {args.output_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import json
+import yaml
+import argparse
+import os
+from strategy_agent import PersuaderAgent, ListenerAgent, STRATEGY_MAP
+from strategy_test import get_output_path, get_evidence_path, load_progress, run_strategy
+from result_stream import ResultStream
+from early_stopping import EarlyStopping
+from instrumentation import metrics, configure_logging
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', type=str, required=True)
+    parser.add_argument('--grid_path', type=str, required=True)
+    parser.add_argument('--batch_size', type=int, default=None)
+    parser.add_argument('--keep_resident', action='store_true', help="Never unload models between combinations")
+    parser.add_argument('--log_level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--metrics_dir', type=str, default=None, help="Default: metrics_path in the config")
+    return parser.parse_args()
+
+def expand_grid(grid):
+    strategies = grid.get("strategies", "all")
+    if strategies == "all":
+        strategies = ["NoneStrategy"] + list(STRATEGY_MAP)
+    if grid.get("pairs"):
+        pairs = [tuple(pair) for pair in grid["pairs"]]
+    else:
+        pairs = [(listener, persuader) for listener in grid["listeners"] for persuader in grid["persuaders"]]
+        if grid.get("same_model_only", False):
+            pairs = [(listener, persuader) for listener, persuader in pairs if listener == persuader]
+    return strategies, pairs
+
+def order_pairs(pairs):
+    # Greedy walk: always continue with the (listener, persuader) pair that needs the fewest
+    # models loaded on top of the ones the previous pair left resident
+    ordered = []
+    resident = set()
+    remaining = list(pairs)
+    while remaining:
+        best = min(remaining, key=lambda pair: len(set(pair) - resident))
+        remaining.remove(best)
+        ordered.append(best)
+        resident = set(best)
+    return ordered
+
+def main():
+    args = parse_args()
+    configure_logging(args.log_level)
+    with open(args.config_path) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    metrics_dir = args.metrics_dir or config.get("metrics_path", "./metrics")
+    with open(args.grid_path) as f:
+        grid = yaml.load(f, Loader=yaml.FullLoader)
+    batch_size = args.batch_size or grid.get("batch_size", 8)
+    listener_mode = grid.get("listener_mode", "generate")
+    output_dir = config.get("output_path", "./results")
+    os.makedirs(output_dir, exist_ok=True)
+    evidence_dir = config.get("evidence_path", "./evidence")
+    with open(config["dataset_path"]) as f:
+        dataset = json.load(f)
+
+    strategies, pairs = expand_grid(grid)
+    # Only pairs with unfinished strategies need their models loaded at all
+    work = {}
+
+    def unfinished(output_path):
+        early_stopping = EarlyStopping.from_config(config, output_path, len(dataset))
+        return bool(load_progress(output_path, dataset)[2]) and not (early_stopping is not None and early_stopping.settled())
+
+    for listener_model_type, persuader_model_type in pairs:
+        todo = [
+            strategy for strategy in strategies
+            if unfinished(get_output_path(output_dir, listener_model_type, persuader_model_type, strategy, listener_mode))
+        ]
+        if todo:
+            work[(listener_model_type, persuader_model_type)] = todo
+    print(f"{len(work)} of {len(pairs)} listener/persuader pairs have unfinished strategies")
+
+    persuader = PersuaderAgent(config, "Persuader")
+    listener = ListenerAgent(config, "Listener")
+    ordered = order_pairs(list(work))
+    for position, (listener_model_type, persuader_model_type) in enumerate(ordered):
+        for strategy in work[(listener_model_type, persuader_model_type)]:
+            print(f"Listener: {listener_model_type}, Persuader: {persuader_model_type}, Strategy: {strategy}")
+            output_path = get_output_path(output_dir, listener_model_type, persuader_model_type, strategy, listener_mode)
+            evidence_stream = ResultStream(get_evidence_path(evidence_dir, persuader_model_type, strategy))
+            # One metrics file per combination, as if it had been run by strategy_test.py
+            metrics.reset()
+            run_strategy(dataset, persuader, listener, strategy, listener_model_type, persuader_model_type, batch_size, output_path, evidence_stream, listener_mode,
+                         EarlyStopping.from_config(config, output_path, len(dataset)))
+            metrics.write(metrics_dir, os.path.splitext(os.path.basename(output_path))[0])
+        if args.keep_resident:
+            continue
+        # Unload whatever the next pair does not use
+        upcoming = set(ordered[position + 1]) if position + 1 < len(ordered) else set()
+        for model_type in {listener_model_type, persuader_model_type} - upcoming:
+            persuader.release_model(model_type)
+            listener.release_model(model_type)
+
+    if listener.generation_cache is not None:
+        print(f"Generation cache: {listener.generation_cache.stats()}")
+    persuader.print_padding_stats()
+    listener.print_padding_stats()
+    persuader.close()
+    listener.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,127 +1,423 @@
 import gc
 import json
+import logging
 import yaml
 from tqdm import tqdm
 import argparse
 from strategy_agent import PersuaderAgent, ListenerAgent
-import numpy as np
+from result_stream import ResultStream, export_legacy_json
 import os
+import socket
+import time
+from glob import glob, escape as glob_escape
+from work_queue import WorkQueue
+from instrumentation import metrics, configure_logging
+from early_stopping import EarlyStopping, StopEarly
+
+logger = logging.getLogger(__name__)
+
+# Minimum seconds between rewrites of the legacy JSON while a run is in progress
+LEGACY_EXPORT_INTERVAL = 30
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config_path', type=str, required=True)
     parser.add_argument('--strategy', type=str, required=True)
-    parser.add_argument('--listener', type=str, required=True)
+    parser.add_argument('--listener', type=str, default=None)
     parser.add_argument('--persuader', type=str, required=True)
-    parser.add_argument('--batch_size', type=int, default=8)
-    return parser.parse_args()
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help="Items per model call when batching sets neither max_batch_tokens nor max_batch_size; otherwise "
+                             "batching.window_items pending items are scheduled together and split under the budget")
+    parser.add_argument('--listener_mode', type=str, default='generate', choices=['generate', 'score'],
+                        help="score: compare the answers' mean per-token log-probabilities, after the same chat template as generation, "
+                             "in one forward pass instead of generating (local listeners only)")
+    parser.add_argument('--phase', type=str, default='all', choices=['all', 'evidence', 'listener'],
+                        help="evidence: only materialise persuader evidence; listener: only evaluate the listener on stored evidence")
+    parser.add_argument('--queue', action='store_true',
+                        help="Share this run with other worker processes on the same host through a lease-based queue next to "
+                             "the output file (not across machines: the queue and result streams need a local filesystem)")
+    parser.add_argument('--worker_id', type=str, default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument('--range_size', type=int, default=32, help="Items per queue lease")
+    parser.add_argument('--lease_seconds', type=float, default=600, help="A lease not renewed for this long is handed to another worker")
+    parser.add_argument('--log_level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="DEBUG also logs every prompt and result record")
+    parser.add_argument('--metrics_dir', type=str, default=None, help="Where the JSON and Prometheus metrics are written (default: metrics_path in the config)")
+    args = parser.parse_args()
+    if args.phase != 'evidence' and args.listener is None:
+        parser.error("--listener is required unless --phase evidence")
+    return args
+
+def get_output_path(output_dir, listener_model_type, persuader_model_type, strategy, listener_mode="generate"):
+    # Scored runs get their own file so they never resume into, or get averaged with, generated ones
+    mode_suffix = "+Mode_score" if listener_mode == "score" else ""
+    return os.path.join(output_dir, f"Listener_{listener_model_type}+Persuader_{persuader_model_type}+Strategy_{strategy}{mode_suffix}.json")
+
+def get_evidence_path(evidence_dir, persuader_model_type, strategy):
+    return os.path.join(evidence_dir, f"Persuader_{persuader_model_type}+Strategy_{strategy}.jsonl")
+
+def build_knowledge(d):
+    return {
+        "prompt": d["prompt"],
+        "target_true": d["ground_truth"],
+        "target_new": d["target_new"],
+        "subject": d["subject"],
+        "rephrase_prompt": d["rephrase_prompt"],
+        "locality_prompt": d["locality_prompt"],
+        "locality_ground_truth": d["locality_ground_truth"]
+    }
+
+def get_evidence_model(agent, persuader_model_type):
+    # What the evidence is generated with: the checkpoint path or API model name behind the alias
+    return agent.config.model_paths.get(persuader_model_type, persuader_model_type)
+
+def load_evidence(evidence_stream, dataset, evidence_model):
+    # A stored record is only reused for the same item text and the same persuader model; evidence of
+    # another dataset or of another checkpoint under the same alias is left out and regenerated
+    evidence = {}
+    stale = 0
+    for index, record in evidence_stream.load().items():
+        if (index < len(dataset) and record.get("prompt") == dataset[index]["prompt"]
+                and record.get("target_new") == dataset[index]["target_new"] and record.get("model") == evidence_model):
+            evidence[index] = record
+        else:
+            stale += 1
+    if stale:
+        logger.warning("%d stored evidence records in %s do not match the dataset or %s, they are regenerated", stale, evidence_stream.path, evidence_model)
+    return evidence
+
+def get_batch_evidence(batch_indices, batch_knowledge, evidence, evidence_stream, persuader, persuader_model_type, strategy):
+    # Evidence depends only on (persuader model, strategy, item): reuse stored evidence and store what is generated
+    missing = [j for j, index in enumerate(batch_indices) if index not in evidence]
+    if missing:
+        if persuader is None:
+            raise ValueError(f"No stored evidence for items {[batch_indices[j] for j in missing]} in {evidence_stream.path}, run with --phase evidence first")
+        with metrics.phase("persuader", items=len(missing)):
+            generated = persuader.batch_generate_evidence([batch_knowledge[j] for j in missing], persuader_model_type, strategy)
+        records = [
+            {"index": batch_indices[j], "prompt": batch_knowledge[j]["prompt"], "target_new": batch_knowledge[j]["target_new"],
+             "model": get_evidence_model(persuader, persuader_model_type), "evidence": e}
+            for j, e in zip(missing, generated)
+        ]
+        evidence_stream.append(records)
+        evidence.update((r["index"], r) for r in records)
+    return [evidence[index]["evidence"] for index in batch_indices]
+
+def materialize_evidence(dataset, persuader, strategy, persuader_model_type, batch_size, evidence_stream):
+    evidence = load_evidence(evidence_stream, dataset, get_evidence_model(persuader, persuader_model_type))
+    pending = [i for i in range(len(dataset)) if i not in evidence]
+    print(f"{len(evidence)} evidence items stored, total {len(dataset)} items")
+    batch_size = persuader.batch_scheduler.window(batch_size)
+    for batch_start in tqdm(range(0, len(pending), batch_size)):
+        batch_indices = pending[batch_start:batch_start+batch_size]
+        batch_knowledge = [build_knowledge(dataset[i]) for i in batch_indices]
+        get_batch_evidence(batch_indices, batch_knowledge, evidence, evidence_stream, persuader, persuader_model_type, strategy)
+
+def load_progress(output_path, dataset):
+    stream = ResultStream(os.path.splitext(output_path)[0] + ".jsonl")
+    # Load existing results to determine which items are completed
+    completed = stream.load()
+    if not completed and os.path.exists(output_path):
+        completed = stream.import_legacy_json(output_path)
+    pending = [i for i in range(len(dataset)) if i not in completed]
+    return stream, completed, pending
+
+class RunningAccuracy:
+    def __init__(self, records=()):
+        self.correct = self.false = self.rephrase_correct = self.rephrase_false = self.locality_correct = self.locality_false = 0
+        # Calculate historical accuracy
+        for r in records:
+            self.update(r.get('is_correct'), r.get('is_robust'), r.get('is_locality'))
+
+    def update(self, is_correct, is_robust, is_locality):
+        if is_correct: self.correct += 1
+        else: self.false += 1
+        if is_robust: self.rephrase_correct += 1
+        else: self.rephrase_false += 1
+        if is_locality: self.locality_correct += 1
+        else: self.locality_false += 1
+
+    def current(self):
+        current_accuracy = self.correct / (self.correct + self.false) if (self.correct + self.false) > 0 else 0
+        current_rephrase_accuracy = self.rephrase_correct / (self.rephrase_correct + self.rephrase_false) if (self.rephrase_correct + self.rephrase_false) > 0 else 0
+        current_locality_accuracy = self.locality_correct / (self.locality_correct + self.locality_false) if (self.locality_correct + self.locality_false) > 0 else 0
+        return current_accuracy, current_rephrase_accuracy, current_locality_accuracy
+
+def process_items(indices, dataset, persuader, listener, strategy, listener_model_type, persuader_model_type, batch_size,
+                  stream, evidence, evidence_stream, accuracy, listener_mode="generate", after_batch=None):
+    # Each window of pending items goes to the models in one piece; the batch scheduler sorts its
+    # prompts by token length and cuts them into the actual generate calls under the token budget
+    batch_size = listener.batch_scheduler.window(batch_size)
+    for batch_start in tqdm(range(0, len(indices), batch_size)):
+        with metrics.phase("batch", items=len(indices[batch_start:batch_start+batch_size])):
+            process_batch(indices[batch_start:batch_start+batch_size], dataset, persuader, listener, strategy, listener_model_type, persuader_model_type,
+                          stream, evidence, evidence_stream, accuracy, listener_mode)
+        if after_batch is not None:
+            after_batch()
+
+def process_batch(batch_indices, dataset, persuader, listener, strategy, listener_model_type, persuader_model_type,
+                  stream, evidence, evidence_stream, accuracy, listener_mode="generate"):
+    batch_knowledge = [build_knowledge(dataset[i]) for i in batch_indices]
+
+    # Persuader generates evidence in batch, unless it is already stored
+    batch_evidence = get_batch_evidence(batch_indices, batch_knowledge, evidence, evidence_stream, persuader, persuader_model_type, strategy)
+    batch_prompts = [k["prompt"] for k in batch_knowledge]
+    batch_rephrase_prompts = [k["rephrase_prompt"] for k in batch_knowledge]
+    batch_locality_prompts = [k["locality_prompt"] for k in batch_knowledge]
+    if listener_mode == "score":
+        # Listener scores target_new against ground_truth (locality: locality_ground_truth against target_new)
+        candidate_lists = [
+            [[k["target_new"], k["target_true"]] for k in batch_knowledge],
+            [[k["target_new"], k["target_true"]] for k in batch_knowledge],
+            [[k["locality_ground_truth"], k["target_new"]] for k in batch_knowledge],
+        ]
+        with metrics.phase("listener", items=len(batch_indices)):
+            batch_scores = listener.batch_score_answers(
+                [batch_prompts, batch_rephrase_prompts, batch_locality_prompts], batch_evidence, candidate_lists, listener_model_type
+            )
+        batch_margins = [[scores[0] - scores[1] for scores in question_scores] for question_scores in batch_scores]
+        batch_answers, batch_rephrase_answers, batch_locality_answers = [
+            [candidates[0] if margin > 0 else candidates[1] for candidates, margin in zip(question_candidates, margins)]
+            for question_candidates, margins in zip(candidate_lists, batch_margins)
+        ]
+    else:
+        # Listener answers the main, rephrased and locality questions in one fused pass over the shared evidence
+        with metrics.phase("listener", items=len(batch_indices)):
+            batch_answers, batch_rephrase_answers, batch_locality_answers = listener.batch_generate_answers(
+                [batch_prompts, batch_rephrase_prompts, batch_locality_prompts], batch_evidence, listener_model_type
+            )
+
+    batch_results = []
+    for i, k in enumerate(batch_knowledge):
+        answer = batch_answers[i]
+        rephrase_answer = batch_rephrase_answers[i]
+        locality_answer = batch_locality_answers[i]
+        if listener_mode == "score":
+            is_correct, is_robust, is_locality = (margins[i] > 0 for margins in batch_margins)
+        else:
+            is_correct = k["target_new"] in answer
+            is_robust = k["target_new"] in rephrase_answer
+            is_locality = k["locality_ground_truth"] in locality_answer
+        accuracy.update(is_correct, is_robust, is_locality)
+        current_accuracy, current_rephrase_accuracy, current_locality_accuracy = accuracy.current()
+        result = {
+            "index": batch_indices[i],
+            "ground_truth": k["target_true"],
+            "target_new": k["target_new"],
+            "prompt": k["prompt"],
+            "evidence": batch_evidence[i],
+            "answer": answer,
+            "is_correct": is_correct,
+            "current_accuracy": current_accuracy,
+            "rephrase_prompt": k["rephrase_prompt"],
+            "rephrase_answer": rephrase_answer,
+            "is_robust": is_robust,
+            "current_rephrase_accuracy": current_rephrase_accuracy,
+            "locality_prompt": k["locality_prompt"],
+            "locality_answer": locality_answer,
+            "is_locality": is_locality,
+            "current_locality_accuracy": current_locality_accuracy
+        }
+        if listener_mode == "score":
+            # Log-probability margins of the expected answer over its alternative
+            result["margin"], result["rephrase_margin"], result["locality_margin"] = (margins[i] for margins in batch_margins)
+        logger.debug(result)
+        batch_results.append(result)
+    gc.collect()
+    # Append after each batch to prevent data loss in case of interruption
+    stream.append(batch_results)
+
+def load_reference_accuracy(early_stopping, output_path, listener_model_type, persuader_model_type, strategy, dataset, listener_mode="generate"):
+    # The reference is the reference_strategy run of the same listener and persuader unless a path is configured
+    reference_path = early_stopping.reference_path or get_output_path(
+        os.path.dirname(output_path), listener_model_type, persuader_model_type, early_stopping.reference_strategy, listener_mode)
+    if os.path.abspath(reference_path) == os.path.abspath(output_path):
+        return None, None
+    records = load_progress(reference_path, dataset)[1]
+    if not records:
+        print(f"No reference results in {reference_path}, stopping on interval width only")
+        return None, None
+    return reference_path, RunningAccuracy(records.values()).current()[0]
+
+def record_early_stop(stream, early_stopping):
+    # The decision and the bounds behind it also go into the results, on the record of the last item it
+    # counted, so a stopped run can be audited from its result files alone
+    records = stream.load()
+    last = early_stopping.order(list(records))[-1]
+    stream.append([{**records[last], "early_stopping": early_stopping.records[-1]}])
+
+def run_strategy(dataset, persuader, listener, strategy, listener_model_type, persuader_model_type, batch_size, output_path, evidence_stream, listener_mode="generate",
+                 early_stopping=None):
+    stream, completed, pending = load_progress(output_path, dataset)
+    print(f"{len(completed)} items completed, total {len(dataset)} items")
+    if not pending:
+        print("All completed, skipping!")
+        return
+    if early_stopping is not None:
+        if early_stopping.settled():
+            print(f"Early stopping: {early_stopping.summary()}, skipping!")
+            return
+        if not early_stopping.is_random_prefix(completed):
+            logger.warning("Completed items of %s were not run in the seeded random order, the bounds are not those of a random sample", output_path)
+        # Items run in the seeded random order, so the results at every point are a random sample
+        pending = early_stopping.order(pending)
+        early_stopping.reference_path, early_stopping.reference_accuracy = load_reference_accuracy(
+            early_stopping, output_path, listener_model_type, persuader_model_type, strategy, dataset, listener_mode)
+    evidence = load_evidence(evidence_stream, dataset, get_evidence_model(listener, persuader_model_type))
+    if persuader is None and any(i not in evidence for i in pending):
+        raise ValueError(f"Stored evidence in {evidence_stream.path} does not cover all pending items, run with --phase evidence first")
+
+    accuracy = RunningAccuracy(completed.values())
+    last_export = [time.monotonic()]
+
+    def after_batch():
+        # eval.py reads the legacy JSON, so it is refreshed as batches are flushed (rate-limited, since
+        # every export rewrites the whole file) and an unfinished run still shows up there
+        if time.monotonic() - last_export[0] >= LEGACY_EXPORT_INTERVAL:
+            export_legacy_json(stream.path, output_path)
+            last_export[0] = time.monotonic()
+        if early_stopping is not None:
+            early_stopping.check(accuracy)
+    try:
+        process_items(pending, dataset, persuader, listener, strategy, listener_model_type, persuader_model_type, batch_size,
+                      stream, evidence, evidence_stream, accuracy, listener_mode, after_batch=after_batch)
+        if early_stopping is not None:
+            early_stopping.finish(accuracy)
+    except StopEarly:
+        record_early_stop(stream, early_stopping)
+    finally:
+        # Also when the run is interrupted, so the legacy JSON holds every flushed item
+        export_legacy_json(stream.path, output_path)
+    if early_stopping is not None:
+        print(f"Early stopping: {early_stopping.summary()}")
+
+class LeaseLost(Exception):
+    pass
+
+def get_worker_stream_paths(output_path):
+    return sorted(glob(glob_escape(os.path.splitext(output_path)[0]) + ".worker-*.jsonl"))
+
+def merge_worker_results(output_path):
+    # Fold every worker's stream into the per-combination stream, recomputing the running
+    # accuracies in dataset order, then write the legacy JSON and drop the worker streams
+    stem = os.path.splitext(output_path)[0]
+    records = ResultStream(stem + ".jsonl").load()
+    worker_paths = get_worker_stream_paths(output_path)
+    for worker_path in worker_paths:
+        records.update(ResultStream(worker_path).load())
+    accuracy = RunningAccuracy()
+    merged = []
+    for index in sorted(records):
+        record = dict(records[index])
+        accuracy.update(record.get('is_correct'), record.get('is_robust'), record.get('is_locality'))
+        record["current_accuracy"], record["current_rephrase_accuracy"], record["current_locality_accuracy"] = accuracy.current()
+        merged.append(record)
+    tmp_stream = ResultStream(stem + ".jsonl.tmp")
+    if os.path.exists(tmp_stream.path):
+        os.remove(tmp_stream.path)
+    tmp_stream.append(merged)
+    os.replace(tmp_stream.path, stem + ".jsonl")
+    export_legacy_json(stem + ".jsonl", output_path)
+    for worker_path in worker_paths:
+        os.remove(worker_path)
+    print(f"Merged {len(worker_paths)} worker streams into {stem}.jsonl ({len(merged)} items)")
+
+def run_queue_worker(dataset, persuader, listener, strategy, listener_model_type, persuader_model_type, batch_size, output_path,
+                     evidence_stream, listener_mode, worker_id, range_size, lease_seconds):
+    # Several processes on this host pull index ranges from one queue; each writes its own worker
+    # stream, and the last one out merges them
+    stem = os.path.splitext(output_path)[0]
+    queue = WorkQueue(stem + ".queue.sqlite", lease_seconds)
+    worker_stream = ResultStream(f"{stem}.worker-{worker_id}.jsonl")
+
+    def load_completed():
+        completed = ResultStream(stem + ".jsonl").load()
+        for worker_path in get_worker_stream_paths(output_path):
+            completed.update(ResultStream(worker_path).load())
+        return completed
+
+    queue.initialize(len(dataset), range_size, load_completed())
+    accuracy = RunningAccuracy()
+    while True:
+        leased = queue.lease(worker_id)
+        if leased is None:
+            break
+        start, end = leased
+        completed = load_completed()
+        indices = [i for i in range(start, end) if i not in completed]
+        print(f"Worker {worker_id} leased items [{start}, {end}), {len(indices)} to run")
+        evidence = load_evidence(evidence_stream, dataset, get_evidence_model(listener, persuader_model_type))
+        if persuader is None and any(i not in evidence for i in indices):
+            raise ValueError(f"Stored evidence in {evidence_stream.path} does not cover items [{start}, {end}), run with --phase evidence first")
+
+        def renew_lease():
+            if not queue.heartbeat(worker_id, start):
+                raise LeaseLost()
+        try:
+            process_items(indices, dataset, persuader, listener, strategy, listener_model_type, persuader_model_type, batch_size,
+                          worker_stream, evidence, evidence_stream, accuracy, listener_mode, after_batch=renew_lease)
+        except LeaseLost:
+            print(f"Worker {worker_id} lost its lease on items [{start}, {end})")
+            continue
+        queue.complete(worker_id, start)
+
+    if queue.remaining() == 0 and queue.claim("merge", worker_id, lease_seconds):
+        merge_worker_results(output_path)
+        queue.mark_done("merge")
 
 def main():
     args = parse_args()
+    configure_logging(args.log_level)
     with open(args.config_path) as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
+    metrics_dir = args.metrics_dir or config.get("metrics_path", "./metrics")
     listener_model_type = args.listener
     persuader_model_type = args.persuader
     output_dir = config.get("output_path", "./results")
     os.makedirs(output_dir, exist_ok=True)
-    output_path = os.path.join(output_dir, f"Listener_{listener_model_type}+Persuader_{persuader_model_type}+Strategy_{args.strategy}.json")
     with open(config["dataset_path"]) as f:
         dataset = json.load(f)
+    evidence_stream = ResultStream(get_evidence_path(config.get("evidence_path", "./evidence"), persuader_model_type, args.strategy))
 
-    batch_size = args.batch_size
-    total_batches = (len(dataset) + batch_size - 1) // batch_size
-
-    # Load existing results to determine how many batches are completed
-    results = []
-    if os.path.exists(output_path):
-        with open(output_path, 'r', encoding='utf-8') as f:
-            try:
-                results = json.load(f)
-            except Exception:
-                results = []
-    finished_batches = len(results) // batch_size
-    print(f"{finished_batches} batches completed, total {total_batches} batches")
-    if finished_batches >= total_batches:
+    if args.phase == 'evidence':
+        persuader = PersuaderAgent(config, "Persuader")
+        materialize_evidence(dataset, persuader, args.strategy, persuader_model_type, args.batch_size, evidence_stream)
+        persuader.print_padding_stats()
+        persuader.close()
+        print(f"Metrics written to {metrics.write(metrics_dir, os.path.splitext(os.path.basename(evidence_stream.path))[0] + '+Phase_evidence')}")
+        return
+
+    output_path = get_output_path(output_dir, listener_model_type, persuader_model_type, args.strategy, args.listener_mode)
+    _, completed, pending = load_progress(output_path, dataset)
+    if not pending:
+        print(f"{len(completed)} items completed, total {len(dataset)} items")
         print("All completed, skipping!")
         return
+    early_stopping = EarlyStopping.from_config(config, output_path, len(dataset))
+    if early_stopping is not None and args.queue:
+        raise ValueError("early_stopping needs the items in one seeded order and cannot be combined with --queue")
+    if early_stopping is not None and early_stopping.settled():
+        print(f"Early stopping: {early_stopping.summary()}, skipping!")
+        return
 
-    persuader = PersuaderAgent(config, "Persuader")
+    # In the listener phase the persuader is never loaded; every item must have stored evidence
+    persuader = PersuaderAgent(config, "Persuader") if args.phase == 'all' else None
     listener = ListenerAgent(config, "Listener")
-    correct = false = rephrase_correct = rephrase_false = locality_correct = locality_false = 0
-    # Calculate historical accuracy
-    for r in results:
-        if r.get('is_correct'): correct += 1
-        else: false += 1
-        if r.get('is_robust'): rephrase_correct += 1
-        else: rephrase_false += 1
-        if r.get('is_locality'): locality_correct += 1
-        else: locality_false += 1
-
-    for batch_index, batch_start in enumerate(tqdm(range(0, len(dataset), batch_size))):
-        if batch_index < finished_batches:
-            continue
-        batch = dataset[batch_start:batch_start+batch_size]
-        batch_knowledge = [{
-            "prompt": d["prompt"],
-            "target_true": d["ground_truth"],
-            "target_new": d["target_new"],
-            "subject": d["subject"],
-            "rephrase_prompt": d["rephrase_prompt"],
-            "locality_prompt": d["locality_prompt"],
-            "locality_ground_truth": d["locality_ground_truth"]
-        } for d in batch]
-
-        # Persuader generates evidence in batch
-        batch_evidence = persuader.batch_generate_evidence(batch_knowledge, persuader_model_type, args.strategy)
-        # Listener generates answers to the main questions in batch
-        batch_prompts = [k["prompt"] for k in batch_knowledge]
-        batch_answers = listener.batch_generate_answer(batch_prompts, batch_evidence, listener_model_type)
-        # Listener generates answers to rephrased questions in batch
-        batch_rephrase_prompts = [k["rephrase_prompt"] for k in batch_knowledge]
-        batch_rephrase_answers = listener.batch_generate_answer(batch_rephrase_prompts, batch_evidence, listener_model_type)
-        # Listener generates answers to locality questions in batch
-        batch_locality_prompts = [k["locality_prompt"] for k in batch_knowledge]
-        batch_locality_answers = listener.batch_generate_answer(batch_locality_prompts, batch_evidence, listener_model_type)
-
-        for i, k in enumerate(batch_knowledge):
-            answer = batch_answers[i]
-            rephrase_answer = batch_rephrase_answers[i]
-            locality_answer = batch_locality_answers[i]
-            is_correct = k["target_new"] in answer
-            is_robust = k["target_new"] in rephrase_answer
-            is_locality = k["locality_ground_truth"] in locality_answer
-            if is_correct: correct += 1
-            else: false += 1
-            if is_robust: rephrase_correct += 1
-            else: rephrase_false += 1
-            if is_locality: locality_correct += 1
-            else: locality_false += 1
-            current_accuracy = correct / (correct + false) if (correct + false) > 0 else 0
-            current_rephrase_accuracy = rephrase_correct / (rephrase_correct + rephrase_false) if (rephrase_correct + rephrase_false) > 0 else 0
-            current_locality_accuracy = locality_correct / (locality_correct + locality_false) if (locality_correct + locality_false) > 0 else 0
-            result = {
-                "ground_truth": k["target_true"],
-                "target_new": k["target_new"],
-                "prompt": k["prompt"],
-                "evidence": batch_evidence[i],
-                "answer": answer,
-                "is_correct": is_correct,
-                "current_accuracy": current_accuracy,
-                "rephrase_prompt": k["rephrase_prompt"],
-                "rephrase_answer": rephrase_answer,
-                "is_robust": is_robust,
-                "current_rephrase_accuracy": current_rephrase_accuracy,
-                "locality_prompt": k["locality_prompt"],
-                "locality_answer": locality_answer,
-                "is_locality": is_locality,
-                "current_locality_accuracy": current_locality_accuracy
-            }
-            print(result)
-            results.append(result)
-        gc.collect()
-        # Save after each batch to prevent data loss in case of interruption
-        with open(output_path, 'w', encoding='utf-8') as json_file:
-            json.dump(results, json_file, ensure_ascii=False, indent=4)
+    if args.queue:
+        run_queue_worker(dataset, persuader, listener, args.strategy, listener_model_type, persuader_model_type, args.batch_size, output_path,
+                         evidence_stream, args.listener_mode, args.worker_id, args.range_size, args.lease_seconds)
+    else:
+        run_strategy(dataset, persuader, listener, args.strategy, listener_model_type, persuader_model_type, args.batch_size, output_path, evidence_stream, args.listener_mode,
+                     early_stopping)
+
+    if listener.generation_cache is not None:
+        print(f"Generation cache: {listener.generation_cache.stats()}")
+    if persuader is not None:
+        persuader.print_padding_stats()
+        persuader.close()
+    listener.print_padding_stats()
+    listener.close()
+    run_name = os.path.splitext(os.path.basename(output_path))[0] + (f"+Worker_{args.worker_id}" if args.queue else "")
+    print(f"Metrics written to {metrics.write(metrics_dir, run_name)}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+# The modules are top-level scripts, importable from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import build_tiny_model, start_stub_server
+
+
+@pytest.fixture(scope="session")
+def tiny_model_dir(tmp_path_factory):
+    # 2-layer random Llama with a byte-level BPE tokenizer, built once per test session
+    model_dir = str(tmp_path_factory.mktemp("tiny_model"))
+    build_tiny_model(model_dir, seed=0)
+    return model_dir
+
+
+@pytest.fixture
+def tiny_config(tiny_model_dir):
+    return {
+        "model_paths": {"llama3": tiny_model_dir},
+        "model_params": {"torch_dtype": "float32"},
+    }
+
+
+@pytest.fixture(scope="session")
+def tiny_model_and_tokenizer(tiny_model_dir):
+    from strategy_agent import ModelConfig
+    from model_pool import load_model
+    model, tokenizer = load_model("llama3", ModelConfig({"model_paths": {"llama3": tiny_model_dir}, "model_params": {"torch_dtype": "float32"}}))
+    model.eval()
+    return model, tokenizer
+
+
+@pytest.fixture
+def stub_server():
+    # Local OpenAI-compatible chat server answering "echo: <prompt>" with no added latency
+    server, base_url = start_stub_server(latency=0.0, seed=0)
+    yield base_url
+    server.shutdown()
+    server.server_close()
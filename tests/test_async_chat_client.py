@@ -0,0 +1,131 @@
+import json
+import random
+import threading
+import time
+
+import pytest
+
+from async_chat_client import AsyncChatClient, TokenBucket, parse_retry_after
+from benchmark import StubChatHandler, StubChatServer
+
+
+class CountingHandler(StubChatHandler):
+    # The benchmark stub plus an in-flight counter; the first `throttle_first` requests get
+    # a 429 with Retry-After, and every request gets `error_status` when it is set
+    state_lock = threading.Lock()
+    in_flight = 0
+    peak = 0
+    arrivals = []
+    throttle_first = 0
+    retry_after = "0.2"
+    error_status = None
+
+    def do_POST(self):
+        cls = type(self)
+        with cls.state_lock:
+            cls.in_flight += 1
+            cls.peak = max(cls.peak, cls.in_flight)
+            cls.arrivals.append(time.monotonic())
+            status = 429 if len(cls.arrivals) <= cls.throttle_first else cls.error_status
+        try:
+            if status is None:
+                super().do_POST()
+            else:
+                self.send_error_body(status)
+        finally:
+            with cls.state_lock:
+                cls.in_flight -= 1
+
+    def send_error_body(self, status):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        data = json.dumps({"error": {"message": "stub error", "type": "stub"}}).encode()
+        self.send_response(status)
+        if status == 429:
+            self.send_header("retry-after", type(self).retry_after)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def counting_server():
+    CountingHandler.latency = 0.0
+    CountingHandler.rng = random.Random(0)
+    CountingHandler.in_flight = CountingHandler.peak = 0
+    CountingHandler.arrivals = []
+    CountingHandler.throttle_first = 0
+    CountingHandler.retry_after = "0.2"
+    CountingHandler.error_status = None
+    server = StubChatServer(("127.0.0.1", 0), CountingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+    server.server_close()
+
+
+def message_lists(n):
+    return [[{"role": "system", "content": "sys"}, {"role": "user", "content": f"prompt {i}"}] for i in range(n)]
+
+
+def test_results_in_input_order_with_bounded_concurrency(counting_server):
+    # Random per-request latency finishes requests out of order; results still follow the input
+    CountingHandler.latency = 0.02
+    client = AsyncChatClient("key", counting_server, concurrency=4)
+    results = client.generate("gpt-4o", message_lists(24), max_tokens=8)
+    assert results == [f"echo: prompt {i}" for i in range(24)]
+    assert 1 < CountingHandler.peak <= 4
+
+
+def test_retry_after_is_honoured(counting_server):
+    CountingHandler.throttle_first = 2
+    client = AsyncChatClient("key", counting_server, concurrency=1, max_retries=3, backoff_base=0.01)
+    assert client.generate("gpt-4o", message_lists(1), max_tokens=8) == ["echo: prompt 0"]
+    arrivals = CountingHandler.arrivals
+    assert len(arrivals) == 3
+    assert all(later - earlier >= 0.2 for earlier, later in zip(arrivals, arrivals[1:]))
+
+
+@pytest.mark.parametrize("retry_after", ["soon", "Mon, 99 Foo 2024 25:61:00 GMT", "inf", "-5"])
+def test_malformed_retry_after_falls_back_to_backoff(counting_server, retry_after):
+    CountingHandler.throttle_first = 1
+    CountingHandler.retry_after = retry_after
+    client = AsyncChatClient("key", counting_server, concurrency=2, max_retries=3, backoff_base=0.01)
+    assert client.generate("gpt-4o", message_lists(2), max_tokens=8) == ["echo: prompt 0", "echo: prompt 1"]
+    assert len(CountingHandler.arrivals) == 3
+
+
+def test_parse_retry_after():
+    class Error:
+        def __init__(self, headers):
+            self.response = type("Response", (), {"headers": headers})()
+
+    assert parse_retry_after(Error({"retry-after-ms": "1500", "retry-after": "9"})) == 1.5
+    assert parse_retry_after(Error({"retry-after-ms": "nan", "retry-after": "9"})) == 9.0
+    assert parse_retry_after(Error({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0.0
+    assert parse_retry_after(Error({"retry-after": "garbage"})) is None
+    assert parse_retry_after(Error({})) is None
+
+
+def test_client_errors_are_not_retried(counting_server):
+    CountingHandler.error_status = 400
+    client = AsyncChatClient("key", counting_server, concurrency=2, max_retries=3, backoff_base=0.01)
+    assert client.generate("gpt-4o", message_lists(3), max_tokens=8) == ["", "", ""]
+    assert len(CountingHandler.arrivals) == 3
+
+
+def test_request_rate_limit(counting_server):
+    # 120 requests per minute refill one request every 0.5 s; with one left, the third waits 1 s
+    client = AsyncChatClient("key", counting_server, concurrency=16, requests_per_minute=120)
+    client.request_bucket.tokens = 1
+    start = time.monotonic()
+    assert client.generate("gpt-4o", message_lists(3), max_tokens=8) == [f"echo: prompt {i}" for i in range(3)]
+    assert time.monotonic() - start >= 0.9
+
+
+def test_token_bucket_debt():
+    bucket = TokenBucket(60)
+    assert bucket.reserve(60) == 0.0
+    # One unit per second: the next 30 units are owed for about 30 seconds
+    assert bucket.reserve(30) == pytest.approx(30.0, abs=0.1)
+    assert TokenBucket(None).reserve(10 ** 6) == 0.0
@@ -0,0 +1,34 @@
+from strategy_agent import Agent
+
+SYSTEM_PROMPT = "You are a helpful, respectful and honest assistant."
+PROMPTS = [
+    "The capital of France is",
+    "Please continue chatting with others in a complete and long paragraph based on the topic the river city is known",
+    "Tokyo",
+    "the famous people of the north speak a language known for its history and the capital is located near the river",
+]
+
+
+def test_batched_generation_matches_per_prompt_calls(tiny_config):
+    agent = Agent(tiny_config, "Listener")
+    model, tokenizer = agent.get_model_and_tokenizer("llama3")
+    system_prompts = [SYSTEM_PROMPT] * len(PROMPTS)
+    batched = agent.generate_with_models(model, "llama3", tokenizer, PROMPTS, system_prompts, max_new_tokens=12)
+    serial = [agent.generate_with_models(model, "llama3", tokenizer, [prompt], [SYSTEM_PROMPT], max_new_tokens=12)[0] for prompt in PROMPTS]
+    assert batched == serial
+    # One left-padded generate call for the whole batch
+    assert agent.padding_stats["llama3"].batches == 1 + len(PROMPTS)
+    agent.close()
+
+
+def test_budgeted_batches_match_one_batch(tiny_config):
+    # Splitting the batch under max_batch_tokens changes the calls, not the responses
+    agent = Agent(tiny_config, "Listener")
+    budgeted = Agent({**tiny_config, "batching": {"max_batch_tokens": 200}}, "Listener")
+    model, tokenizer = agent.get_model_and_tokenizer("llama3")
+    system_prompts = [SYSTEM_PROMPT] * len(PROMPTS)
+    expected = agent.generate_with_models(model, "llama3", tokenizer, PROMPTS, system_prompts, max_new_tokens=12)
+    assert budgeted.generate_with_models(model, "llama3", tokenizer, PROMPTS, system_prompts, max_new_tokens=12) == expected
+    assert budgeted.padding_stats["llama3"].batches > 1
+    agent.close()
+    budgeted.close()
@@ -0,0 +1,39 @@
+import json
+import random
+
+import pytest
+
+from columnar_results import ResultStore, ingest
+
+
+def write_run(results_dir, strategy, rng, p_correct, n):
+    records = [{"prompt": f"p{i}", "is_correct": rng.random() < p_correct, "is_robust": rng.random() < 0.5,
+                "is_locality": rng.random() < 0.5} for i in range(n)]
+    with open(results_dir / f"Listener_llama3+Persuader_qwen+Strategy_{strategy}.json", "w") as f:
+        json.dump(records, f)
+
+
+@pytest.fixture
+def store(tmp_path):
+    rng = random.Random(0)
+    results_dir = tmp_path / "results"
+    results_dir.mkdir()
+    write_run(results_dir, "NoneStrategy", rng, 0.6, 400)
+    write_run(results_dir, "authority_effect", rng, 0.4, 400)
+    write_run(results_dir, "logical_appeal", rng, 0.6, 250)
+    ingest(str(results_dir), str(tmp_path / "store"), workers=1)
+    return ResultStore(str(tmp_path / "store"))
+
+
+def test_chunked_resamples_give_the_same_intervals(store, monkeypatch):
+    expected = store.paired_bootstrap("accuracy", n_resamples=2000)
+    # A few resamples per chunk: the weight matrix never holds all 2000, the draws stay the same
+    monkeypatch.setattr(store, "bootstrap_weights", lambda n, n_resamples, seed: ResultStore.bootstrap_weights(store, n, n_resamples, seed, max_cells=n * 7))
+    assert store.paired_bootstrap("accuracy", n_resamples=2000) == expected
+
+    rows = {row["strategy"]: row for row in expected}
+    assert rows["authority_effect"]["items"] == 400
+    assert rows["logical_appeal"]["items"] == 250
+    for row in rows.values():
+        assert row["ci_low"] <= row["difference"] <= row["ci_high"]
+    assert rows["authority_effect"]["ci_high"] < 0
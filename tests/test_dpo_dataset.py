@@ -0,0 +1,110 @@
+import json
+import os
+
+import pytest
+import torch
+from datasets import load_dataset
+from peft import LoraConfig, get_peft_model
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from trl import DPOConfig, DPOTrainer
+
+from dpo_dataset import PretokenizedDPOTrainer, load_tokenized_dataset
+
+WORDS = "the capital river north city famous language people history known located".split()
+
+
+def text(i, n):
+    return " ".join(WORDS[(i * 7 + j) % len(WORDS)] for j in range(n))
+
+
+@pytest.fixture
+def dpo_setup(tiny_model_dir, tmp_path):
+    # Preference pairs shaped like strategy_generate_dataset's output, with varied lengths
+    data_path = str(tmp_path / "dpo.jsonl")
+    with open(data_path, "w", encoding="utf-8") as f:
+        for i in range(10):
+            f.write(json.dumps({"prompt": text(i, 4 + i), "chosen": text(i + 1, 2 + 3 * (i % 4)), "rejected": text(i + 2, 1 + 2 * (i % 5))}) + "\n")
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_dir)
+    tokenizer.pad_token = tokenizer.eos_token
+    args = DPOConfig(output_dir=str(tmp_path / "out"), per_device_train_batch_size=4, report_to="none",
+                     max_length=64, max_prompt_length=48, max_completion_length=32)
+    return data_path, tokenizer, args
+
+
+def tiny_model(tiny_model_dir):
+    return AutoModelForCausalLM.from_pretrained(tiny_model_dir, torch_dtype=torch.float32)
+
+
+def test_pretokenized_batches_match_on_the_fly_tokenization(tiny_model_dir, tmp_path, dpo_setup):
+    data_path, tokenizer, args = dpo_setup
+    tokenized_dir = str(tmp_path / "dpo.tokenized")
+    pretokenized = load_tokenized_dataset(data_path, tokenizer, args, tokenized_dir)
+    on_the_fly = DPOTrainer(model=tiny_model(tiny_model_dir), args=args, processing_class=tokenizer,
+                            train_dataset=load_dataset("json", data_files=data_path, split="train"))
+    trainer = PretokenizedDPOTrainer(model=tiny_model(tiny_model_dir), args=args, processing_class=tokenizer,
+                                     train_dataset=pretokenized)
+    # The stored shards are used as they are, not tokenized again
+    assert trainer.train_dataset is pretokenized
+
+    expected = on_the_fly.train_dataset
+    assert len(pretokenized) == len(expected)
+    for row, expected_row in zip(pretokenized, expected):
+        for column in ["prompt_input_ids", "chosen_input_ids", "rejected_input_ids"]:
+            assert row[column] == expected_row[column]
+        assert row["length"] == len(row["prompt_input_ids"]) + max(len(row["chosen_input_ids"]), len(row["rejected_input_ids"]))
+        assert row["length"] <= args.max_length
+
+    columns = ["prompt_input_ids", "chosen_input_ids", "rejected_input_ids"]
+    for start in range(0, len(expected), args.per_device_train_batch_size):
+        rows = range(start, min(start + args.per_device_train_batch_size, len(expected)))
+        batch = trainer.data_collator([{c: pretokenized[i][c] for c in columns} for i in rows])
+        expected_batch = on_the_fly.data_collator([{c: expected[i][c] for c in columns} for i in rows])
+        assert batch.keys() == expected_batch.keys()
+        for key in batch:
+            assert torch.equal(batch[key], expected_batch[key])
+
+
+def test_tokenized_shards_are_reused_until_settings_change(tmp_path, dpo_setup):
+    data_path, tokenizer, args = dpo_setup
+    tokenized_dir = str(tmp_path / "dpo.tokenized")
+    full = load_tokenized_dataset(data_path, tokenizer, args, tokenized_dir)
+    built = os.stat(os.path.join(tokenized_dir, "preprocess.json")).st_mtime_ns
+    load_tokenized_dataset(data_path, tokenizer, args, tokenized_dir)
+    assert os.stat(os.path.join(tokenized_dir, "preprocess.json")).st_mtime_ns == built
+
+    # A tighter length limit rebuilds the shards, cutting the rows that no longer fit
+    assert max(full["length"]) > 12
+    args.max_length = 12
+    rebuilt = load_tokenized_dataset(data_path, tokenizer, args, tokenized_dir)
+    assert max(rebuilt["length"]) <= 12
+    assert all(len(p) + max(len(c), len(r)) <= 12 for p, c, r in
+               zip(rebuilt["prompt_input_ids"], rebuilt["chosen_input_ids"], rebuilt["rejected_input_ids"]))
+
+
+def test_cached_reference_logps_give_the_same_loss(tiny_model_dir, tmp_path, dpo_setup):
+    data_path, tokenizer, args = dpo_setup
+    tokenized_dir = str(tmp_path / "dpo.tokenized")
+    dataset = load_tokenized_dataset(data_path, tokenizer, args, tokenized_dir)
+    # Non-zero LoRA weights, so the policy differs from the reference (the adapter disabled)
+    lora_config = LoraConfig(r=4, lora_alpha=8, target_modules=["q_proj", "v_proj"], init_lora_weights=False, task_type="CAUSAL_LM")
+    model = get_peft_model(tiny_model(tiny_model_dir), lora_config)
+    cached = PretokenizedDPOTrainer(model=model, args=args, processing_class=tokenizer, train_dataset=dataset, ref_logps_dir=tokenized_dir)
+    on_the_fly = PretokenizedDPOTrainer(model=model, args=args, processing_class=tokenizer, train_dataset=dataset)
+
+    batches = list(cached.get_train_dataloader())
+    assert os.path.exists(os.path.join(tokenized_dir, "ref_logps.npy"))
+    assert sum(len(batch["ref_chosen_logps"]) for batch in batches) == len(dataset)
+    with torch.no_grad():
+        for batch in batches:
+            loss, metrics = cached.get_batch_loss_metrics(model, batch, "train")
+            recomputed = {key: value for key, value in batch.items() if not key.startswith("ref_")}
+            expected_loss, expected_metrics = on_the_fly.get_batch_loss_metrics(model, recomputed, "train")
+            assert loss.item() == pytest.approx(expected_loss.item(), abs=1e-5)
+            assert metrics["rewards/margins"] == pytest.approx(expected_metrics["rewards/margins"], abs=1e-5)
+            assert abs(metrics["rewards/margins"]) > 0
+
+    # A second trainer on the same shards loads the stored log-probs instead of recomputing them
+    stored = os.stat(os.path.join(tokenized_dir, "ref_logps.npy")).st_mtime_ns
+    again = PretokenizedDPOTrainer(model=model, args=args, processing_class=tokenizer, train_dataset=dataset, ref_logps_dir=tokenized_dir)
+    again.get_train_dataloader()
+    assert os.stat(os.path.join(tokenized_dir, "ref_logps.npy")).st_mtime_ns == stored
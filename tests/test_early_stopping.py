@@ -0,0 +1,40 @@
+import json
+import os
+import random
+
+from benchmark import build_dataset_items
+from early_stopping import EarlyStopping
+from result_stream import ResultStream
+from strategy_agent import ListenerAgent, PersuaderAgent
+from strategy_test import get_output_path, run_strategy
+
+
+def test_stop_decision_is_stored_with_the_results(tiny_model_dir, tmp_path):
+    config = {
+        "model_paths": {"llama3": tiny_model_dir, "qwen": tiny_model_dir},
+        "model_params": {"torch_dtype": "float32"},
+        # Every interval is narrower than 1, so the first look after min_items stops the run
+        "early_stopping": {"enabled": True, "max_width": 1.0, "min_items": 4, "seed": 0},
+    }
+    dataset = build_dataset_items(12, random.Random(0))
+    output_path = get_output_path(str(tmp_path / "results"), "llama3", "qwen", "authority_effect")
+    early_stopping = EarlyStopping.from_config(config, output_path, len(dataset))
+    persuader = PersuaderAgent(config, "Persuader")
+    listener = ListenerAgent(config, "Listener")
+    run_strategy(dataset, persuader, listener, "authority_effect", "llama3", "qwen", 4, output_path,
+                 ResultStream(str(tmp_path / "evidence.jsonl")), early_stopping=early_stopping)
+    persuader.close()
+    listener.close()
+
+    with open(output_path) as f:
+        results = json.load(f)
+    assert len(results) == 4
+    stops = [r["early_stopping"] for r in results if "early_stopping" in r]
+    assert stops == [early_stopping.records[-1]]
+    assert stops[0]["status"] == "stopped"
+    assert stops[0]["items_used"] == len(results)
+    assert set(stops[0]["bounds"]) == {"accuracy", "rephrase_accuracy", "locality_accuracy"}
+    # The annotated record is the last item of the seeded order that was run
+    stream_records = ResultStream(os.path.splitext(output_path)[0] + ".jsonl").load()
+    last = early_stopping.order(list(stream_records))[-1]
+    assert stream_records[last]["early_stopping"] == stops[0]
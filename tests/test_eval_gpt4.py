@@ -0,0 +1,118 @@
+import csv
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+import eval_gpt4
+from benchmark import StubChatServer
+
+LABELS = {
+    "Who wrote Hamlet?": "person",
+    "Where is Paris?": " Geo\n",
+    "What is jazz?": "culture",
+    "How do I bake bread?": "life",
+    "Is this even a question?": "unsure",
+}
+
+
+class LabelHandler(BaseHTTPRequestHandler):
+    # Chat endpoint answering the classifier prompt with a fixed label and counting requests per prompt
+    lock = threading.Lock()
+    seen = Counter()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        assert body["messages"][0]["content"] == eval_gpt4.CLASSIFY_SYSTEM_PROMPT
+        assert body["temperature"] == 0
+        prompt = body["messages"][-1]["content"][len("Prompt: "):]
+        with self.lock:
+            self.seen[prompt] += 1
+        data = json.dumps({
+            "id": "stub", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": LABELS[prompt]}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def classifier(tmp_path, monkeypatch):
+    LabelHandler.seen = Counter()
+    server = StubChatServer(("127.0.0.1", 0), LabelHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(eval_gpt4, "API_KEY", "key")
+    monkeypatch.setattr(eval_gpt4, "BASE_URL", f"http://127.0.0.1:{server.server_address[1]}/v1")
+    monkeypatch.setattr(eval_gpt4, "CACHE_PATH", str(tmp_path / "cache" / "labels.sqlite"))
+    monkeypatch.setattr(eval_gpt4, "LEGACY_CACHE_PATH", str(tmp_path / "cache" / "labels.json"))
+    monkeypatch.setattr(eval_gpt4, "CLASSIFY_BATCH_SIZE", 2)
+    yield
+    server.shutdown()
+    server.server_close()
+
+
+def write_results(results_dir):
+    (results_dir / "a").mkdir(parents=True)
+    records_a = [
+        {"prompt": "Who wrote Hamlet?", "is_correct": True},
+        {"prompt": "Where is Paris?", "is_correct": False},
+        {"prompt": "Where is Paris?", "is_correct": True},
+        {"prompt": "Is this even a question?", "is_correct": True},
+    ]
+    records_b = [
+        {"prompt": "Who wrote Hamlet?", "is_correct": False},
+        {"prompt": "What is jazz?", "is_correct": True},
+        {"prompt": "How do I bake bread?", "is_correct": True},
+    ]
+    (results_dir / "a" / "run_a.json").write_text(json.dumps(records_a))
+    (results_dir / "run_b.json").write_text(json.dumps(records_b))
+
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return {row["file"]: row for row in csv.DictReader(f)}
+
+
+def test_each_prompt_is_classified_once_and_cached(tmp_path, classifier):
+    results_dir = tmp_path / "results"
+    write_results(results_dir)
+    eval_gpt4.run_full_evaluation(str(results_dir))
+    # Shared prompts across files are sent once; labels are normalized before caching
+    assert LabelHandler.seen == Counter({prompt: 1 for prompt in LABELS})
+    assert eval_gpt4.PromptLabelCache(eval_gpt4.CACHE_PATH).load() == {
+        "Who wrote Hamlet?": "person", "Where is Paris?": "geo", "What is jazz?": "culture", "How do I bake bread?": "life",
+    }
+
+    rows = read_csv(results_dir / "results_eval_with_categories.csv")
+    assert rows["run_a.json"]["total"] == "4"
+    assert rows["run_a.json"]["geo_total"] == "2"
+    assert float(rows["run_a.json"]["geo_accuracy"]) == 0.5
+    assert rows["run_b.json"]["person_total"] == "1"
+    assert float(rows["run_b.json"]["person_accuracy"]) == 0.0
+
+    # A second run asks again only for the prompt whose label was invalid
+    eval_gpt4.run_full_evaluation(str(results_dir))
+    assert LabelHandler.seen["Is this even a question?"] == 2
+    assert sum(LabelHandler.seen.values()) == len(LABELS) + 1
+
+
+def test_legacy_json_cache_is_imported(tmp_path, classifier):
+    results_dir = tmp_path / "results"
+    write_results(results_dir)
+    legacy = {prompt: "person" for prompt in LABELS}
+    legacy["Is this even a question?"] = "unsure"
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "cache" / "labels.json").write_text(json.dumps(legacy))
+    cache = eval_gpt4.load_or_create_cache(str(results_dir))
+    # Valid legacy labels are reused; the invalid one is classified again
+    assert LabelHandler.seen == Counter({"Is this even a question?": 1})
+    assert cache["Where is Paris?"] == "person"
@@ -0,0 +1,21 @@
+from strategy_agent import ListenerAgent
+
+EVIDENCE = [
+    "the famous city is located north of the river and its people speak a language known for its history " * 3,
+    "Tokyo is the capital",
+    "people know the capital country city history " * 6,
+]
+QUESTION_LISTS = [
+    ["The capital of country 0 is", "The capital of country 1 is", "The capital of country 2 is"],
+    ["Country 0's capital city is", "Country 1's capital city is", "Country 2's capital city is"],
+    ["The capital of France is"] * 3,
+]
+
+
+def test_fused_pass_matches_three_separate_calls(tiny_config):
+    listener = ListenerAgent(tiny_config, "Listener")
+    fused = listener.batch_generate_answers(QUESTION_LISTS, EVIDENCE, "llama3")
+    separate = [listener.batch_generate_answer(questions, EVIDENCE, "llama3") for questions in QUESTION_LISTS]
+    assert fused == separate
+    listener.close()
+
@@ -0,0 +1,34 @@
+import json
+
+from strategy_generate_dataset import build_dataset
+
+
+def records(prompts):
+    return [
+        {"prompt": prompt, "target_new": "Paris", "evidence": f"evidence {prompt} {i}", "is_correct": i % 2 == 0}
+        for prompt in prompts for i in range(4)
+    ]
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_partially_read_file_contributes_no_pairs(tmp_path):
+    good_dir = tmp_path / "good"
+    good_dir.mkdir()
+    (good_dir / "a.json").write_text(json.dumps(records(["The capital of France is", "Tokyo is in"])))
+    build_dataset(str(good_dir), str(tmp_path / "expected.jsonl"), num_buckets=4, workers=1)
+
+    # The broken file parses for a while before it fails: none of its rows may reach the pairs
+    mixed_dir = tmp_path / "mixed"
+    mixed_dir.mkdir()
+    (mixed_dir / "a.json").write_text(json.dumps(records(["The capital of France is", "Tokyo is in"])))
+    broken = json.dumps(records(["The capital of France is", "Berlin lies on"]))
+    (mixed_dir / "b.json").write_text(broken[:len(broken) // 2 + 1] + "}{")
+    count = build_dataset(str(mixed_dir), str(tmp_path / "output.jsonl"), num_buckets=4, workers=1)
+
+    expected = read_jsonl(tmp_path / "expected.jsonl")
+    assert count == len(expected) > 0
+    assert read_jsonl(tmp_path / "output.jsonl") == expected
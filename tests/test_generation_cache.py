@@ -0,0 +1,22 @@
+from generation_cache import GenerationCache
+
+
+def test_replaced_keys_are_not_counted_twice(tmp_path):
+    cache = GenerationCache(str(tmp_path / "cache.sqlite"), max_entries=4)
+    cache.put_many([(f"k{i}", "x" * 10) for i in range(4)])
+    evictions = []
+    cache.evict = lambda: evictions.append(1)
+    # Rewriting the same keys neither grows the totals nor triggers an eviction
+    cache.put_many([(f"k{i}", "y" * 20) for i in range(4)])
+    assert (cache.entries, cache.total_bytes) == (4, 80)
+    assert evictions == []
+    assert len(cache.get_many([f"k{i}" for i in range(4)])) == 4
+
+
+def test_byte_limit_evicts_only_down_to_the_headroom(tmp_path):
+    cache = GenerationCache(str(tmp_path / "cache.sqlite"), max_bytes=1000)
+    cache.put_many([(f"old{i}", "x" * 100) for i in range(9)])
+    cache.put_many([(f"new{i}", "x" * 100) for i in range(2)])
+    # 1100 bytes: two rows go to get under 900, not the whole batch that shares their timestamp
+    assert (cache.entries, cache.total_bytes) == (9, 900)
+    assert len(cache.get_many([f"new{i}" for i in range(2)])) == 2
@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+import torch
+
+from inference_server import ContinuousBatcher
+
+
+class PrefillFailsOnce(torch.nn.Module):
+    # Wraps the tiny model; the first multi-token (prefill) forward pass raises
+    def __init__(self, model):
+        super().__init__()
+        self.inner = model
+        self.generation_config = model.generation_config
+        self.device = model.device
+        self.failures = 1
+        self.prefill_started = threading.Event()
+
+    def forward(self, input_ids, **kwargs):
+        if input_ids.shape[1] > 1:
+            self.prefill_started.set()
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("prefill failed")
+        return self.inner(input_ids=input_ids, **kwargs)
+
+
+def encode(tokenizer, text):
+    return tokenizer.apply_chat_template([{"role": "user", "content": text}], add_generation_prompt=True)
+
+
+def test_prefill_failure_fails_admitted_requests(tiny_model_and_tokenizer):
+    model, tokenizer = tiny_model_and_tokenizer
+    batcher = ContinuousBatcher("llama3", PrefillFailsOnce(model), tokenizer)
+    future = batcher.submit(encode(tokenizer, "The capital of France is"), 4, {})
+    # Admitted but not yet active when its prefill raises: the client must get the error, not time out
+    with pytest.raises(RuntimeError, match="prefill failed"):
+        future.result(timeout=30)
+
+    # The batcher keeps serving afterwards
+    result = batcher.submit(encode(tokenizer, "The capital of France is"), 4, {}).result(timeout=30)
+    assert result["completion_tokens"] > 0
+
+
+def test_prefill_failure_while_batch_is_running(tiny_model_and_tokenizer):
+    model, tokenizer = tiny_model_and_tokenizer
+    wrapped = PrefillFailsOnce(model)
+    wrapped.failures = 0
+    batcher = ContinuousBatcher("llama3", wrapped, tokenizer)
+    running = batcher.submit(encode(tokenizer, "The capital of France is"), 64, {})
+    wrapped.prefill_started.wait(timeout=30)
+    # The next prefill joins a running batch and fails; both the running and the joining request are failed
+    wrapped.failures = 1
+    joining = batcher.submit(encode(tokenizer, "The capital of Spain is"), 4, {})
+    with pytest.raises(RuntimeError, match="prefill failed"):
+        joining.result(timeout=30)
+    # The running request either finished before the failing step or was failed with it; it never hangs
+    try:
+        running.result(timeout=30)
+    except RuntimeError as e:
+        assert "prefill failed" in str(e)
@@ -0,0 +1,62 @@
+import json
+import os
+
+import pytest
+import torch
+from peft import LoraConfig, get_peft_model
+from safetensors import safe_open
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from merge_dpo_to_base import merge_in_memory, merge_streaming
+
+TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"]
+
+
+def load_tensors(model_dir):
+    index_path = os.path.join(model_dir, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            shard_names = sorted(set(json.load(f)["weight_map"].values()))
+    else:
+        shard_names = ["model.safetensors"]
+    tensors = {}
+    for shard_name in shard_names:
+        with safe_open(os.path.join(model_dir, shard_name), framework="pt") as f:
+            tensors.update((key, f.get_tensor(key)) for key in f.keys())
+    return tensors
+
+
+@pytest.mark.parametrize("dtype, lora_options, max_shard_size", [
+    (torch.float32, {}, None),
+    (torch.bfloat16, {}, None),
+    (torch.float16, {}, None),
+    # Per-module rank and alpha, rsLoRA scaling and a sharded base checkpoint
+    (torch.float32, {"rank_pattern": {"down_proj": 2}, "alpha_pattern": {"q_proj": 32}, "use_rslora": True}, "100KB"),
+])
+def test_streaming_merge_matches_merge_and_unload(tiny_model_dir, tmp_path, dtype, lora_options, max_shard_size):
+    base_dir = str(tmp_path / "base")
+    adapter_dir = str(tmp_path / "adapter")
+    model = AutoModelForCausalLM.from_pretrained(tiny_model_dir, torch_dtype=dtype)
+    model.save_pretrained(base_dir, **({"max_shard_size": max_shard_size} if max_shard_size else {}))
+    AutoTokenizer.from_pretrained(tiny_model_dir).save_pretrained(base_dir)
+    # Random A and B (init_lora_weights=False), so every targeted weight actually changes
+    torch.manual_seed(0)
+    lora_config = LoraConfig(r=8, lora_alpha=16, target_modules=TARGET_MODULES, init_lora_weights=False,
+                             task_type="CAUSAL_LM", **lora_options)
+    get_peft_model(model, lora_config).save_pretrained(adapter_dir)
+
+    merge_in_memory(base_dir, adapter_dir, str(tmp_path / "memory"))
+    merge_streaming(base_dir, adapter_dir, str(tmp_path / "streaming"))
+
+    base = load_tensors(base_dir)
+    expected = load_tensors(str(tmp_path / "memory"))
+    merged = load_tensors(str(tmp_path / "streaming"))
+    assert merged.keys() == expected.keys()
+    for key, tensor in merged.items():
+        assert tensor.dtype == expected[key].dtype == dtype
+        assert torch.equal(tensor, expected[key]), key
+    assert sum(not torch.equal(merged[key], base[key]) for key in base) == 2 * len(TARGET_MODULES)
+    if max_shard_size:
+        assert os.path.exists(str(tmp_path / "streaming" / "model.safetensors.index.json"))
+    # The merged checkpoint loads as a plain model
+    AutoModelForCausalLM.from_pretrained(str(tmp_path / "streaming"))
@@ -0,0 +1,12 @@
+import json
+
+from metrics_aggregator import aggregate
+
+
+def test_file_removed_after_listing_is_skipped(tmp_path):
+    present = tmp_path / "present.json"
+    present.write_text(json.dumps([{"prompt": "p", "is_correct": True}, {"prompt": "q", "is_correct": False}]))
+    paths = [str(present), str(tmp_path / "rotated.json")]
+    summaries = aggregate(paths, str(tmp_path / "manifest.sqlite"), workers=1)
+    assert list(summaries) == [str(present)]
+    assert (summaries[str(present)]["total"], summaries[str(present)]["correct"]) == (2, 1)
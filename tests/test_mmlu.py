@@ -0,0 +1,79 @@
+import json
+import shutil
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+import MMLU
+from result_stream import ResultStream
+
+SUBJECTS = ["geography", "history", "chemistry"]
+WORDS = "the capital river north city famous language people history known located".split()
+
+
+def mmlu_items(n):
+    # MMLU-shaped rows with varied question lengths, so the loglik batches are left-padded
+    return [
+        {
+            "question": f"Question {i}: " + " ".join(WORDS[(i + j) % len(WORDS)] for j in range(3 + 5 * (i % 4))),
+            "choices": [f"{WORDS[(i + k) % len(WORDS)]} {k}" for k in range(4)],
+            "subject": SUBJECTS[i % len(SUBJECTS)],
+            "answer": i % 4,
+        }
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def option_constrained_model(tiny_model_dir, tmp_path):
+    # Copy of the tiny model whose first generated token is restricted to the option letters, so
+    # greedy decoding answers with the letter that has the highest next-token logit. Every prompt
+    # ends alike, so the last hidden states share a dominant direction; the option rows of the
+    # output layer are redrawn orthogonal to it, or every question would get the same answer
+    model_dir = tmp_path / "model"
+    shutil.copytree(tiny_model_dir, model_dir)
+    tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+    rows = sorted({i for ids in MMLU.option_token_ids(tokenizer) for i in ids})
+    model = AutoModelForCausalLM.from_pretrained(str(model_dir), torch_dtype=torch.float32)
+    with torch.no_grad():
+        # One dominant direction per prompt format (plain and chat template)
+        common = torch.stack([
+            torch.stack([
+                model(torch.tensor([MMLU.encode_prompt(tokenizer, MMLU.build_prompt(item), instruct)]),
+                      output_hidden_states=True).hidden_states[-1][0, -1]
+                for item in mmlu_items(12)
+            ]).mean(dim=0)
+            for instruct in [False, True]
+        ], dim=1)
+        basis, _ = torch.linalg.qr(common)
+        weights = torch.randn(len(rows), model.config.hidden_size, generator=torch.Generator().manual_seed(0))
+        model.lm_head.weight[rows] = 100 * (weights - weights @ basis @ basis.T)
+    model.save_pretrained(str(model_dir))
+    config_path = model_dir / "generation_config.json"
+    generation_config = json.loads(config_path.read_text())
+    generation_config["begin_suppress_tokens"] = [i for i in range(len(tokenizer)) if i not in rows]
+    config_path.write_text(json.dumps(generation_config))
+    return str(model_dir)
+
+
+def test_option_tokens_are_single_letters(tiny_model_and_tokenizer):
+    _, tokenizer = tiny_model_and_tokenizer
+    option_ids = MMLU.option_token_ids(tokenizer)
+    # " A" is two tokens for this tokenizer, so only the bare letter is scored
+    assert [[tokenizer.decode([i]) for i in ids] for ids in option_ids] == [[label] for label in MMLU.option_labels]
+
+
+@pytest.mark.parametrize("model_name", ["Tiny", "Tiny Instruct"])
+def test_loglik_agrees_with_generate(option_constrained_model, tmp_path, model_name):
+    mmlu = mmlu_items(12)
+    cache_dir = str(tmp_path / "cache")
+    loglik = MMLU.evaluate_model(model_name, option_constrained_model, mmlu, "loglik", 5, cache_dir)
+    generate = MMLU.evaluate_model(model_name, option_constrained_model, mmlu, "generate", 5, cache_dir)
+    assert loglik == generate
+
+    loglik_preds = ResultStream(MMLU.get_cache_path(cache_dir, option_constrained_model, "loglik")).load()
+    generate_preds = ResultStream(MMLU.get_cache_path(cache_dir, option_constrained_model, "generate")).load()
+    assert sorted(loglik_preds) == list(range(len(mmlu)))
+    assert {i: r["pred"] for i, r in loglik_preds.items()} == {i: r["pred"] for i, r in generate_preds.items()}
+    assert len({r["pred"] for r in loglik_preds.values()}) > 1
@@ -0,0 +1,29 @@
+import pytest
+import torch
+
+from strategy_agent import Agent, build_messages
+
+SYSTEM_PROMPT = "You are a helpful, respectful and honest assistant."
+PROMPTS = ["The capital of France is", "Tokyo is the capital of which country? Answer briefly"]
+CANDIDATES = [["Paris", "the famous river city of Lyon"], ["Japan", "China"]]
+
+
+def reference_score(model, tokenizer, prompt, candidate):
+    # One unpadded pass: the generation prompt encoding, the assistant header, then the candidate
+    messages = build_messages("llama3", SYSTEM_PROMPT, prompt)
+    generation_ids = tokenizer.apply_chat_template(messages)
+    context_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+    assert context_ids[:len(generation_ids)] == generation_ids
+    answer_ids = tokenizer(candidate, add_special_tokens=False)["input_ids"]
+    with torch.no_grad():
+        log_probs = torch.log_softmax(model(torch.tensor([context_ids + answer_ids])).logits[0].float(), dim=-1)
+    return sum(log_probs[len(context_ids) + j - 1, token].item() for j, token in enumerate(answer_ids)) / len(answer_ids)
+
+
+def test_scores_are_mean_token_log_probs(tiny_config):
+    agent = Agent({**tiny_config, "batching": {"max_batch_tokens": 150}}, "Listener")
+    model, tokenizer = agent.get_model_and_tokenizer("llama3")
+    scores = agent.score_text_batch(PROMPTS, "llama3", CANDIDATES, system_prompts=[SYSTEM_PROMPT] * len(PROMPTS))
+    expected = [[reference_score(model, tokenizer, prompt, c) for c in candidates] for prompt, candidates in zip(PROMPTS, CANDIDATES)]
+    assert scores == [pytest.approx(row, abs=1e-4) for row in expected]
+    agent.close()
@@ -0,0 +1,200 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import pytest
+
+import strategy_test
+import work_queue
+from benchmark import build_dataset_items
+from result_stream import ResultStream
+from strategy_agent import ListenerAgent, PersuaderAgent
+from work_queue import WorkQueue
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_initialize_is_idempotent_and_skips_completed_ranges(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    queue = WorkQueue(path)
+    queue.initialize(10, 4, completed=range(4))
+    # A second worker arriving later does not add ranges again
+    WorkQueue(path).initialize(10, 4, completed=range(4))
+    assert queue.remaining() == 2
+    assert [queue.lease("a"), queue.lease("b"), queue.lease("c")] == [(4, 8), (8, 10), None]
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    first = WorkQueue(path, lease_seconds=0.2)
+    second = WorkQueue(path, lease_seconds=0.2)
+    first.initialize(4, 4)
+    assert first.lease("first") == (0, 4)
+    assert second.lease("second") is None
+    assert first.heartbeat("first", 0)
+
+    time.sleep(0.3)
+    # The first worker stopped renewing; the range goes to the second one
+    assert second.lease("second") == (0, 4)
+    assert not first.heartbeat("first", 0)
+    first.complete("first", 0)
+    assert second.remaining() == 1
+    second.complete("second", 0)
+    assert second.remaining() == 0
+    assert first.conn.execute("SELECT attempts FROM ranges").fetchone()[0] == 2
+
+
+def test_claim_elects_one_worker(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    first = WorkQueue(path)
+    second = WorkQueue(path)
+    assert first.claim("merge", "first", ttl=0.2)
+    assert not second.claim("merge", "second", ttl=0.2)
+    time.sleep(0.3)
+    # A stale claim is taken over; a finished one never is
+    assert second.claim("merge", "second", ttl=0.2)
+    second.mark_done("merge")
+    time.sleep(0.3)
+    assert not first.claim("merge", "first", ttl=0.2)
+
+
+def test_queue_is_bound_to_one_host(tmp_path, monkeypatch):
+    path = str(tmp_path / "queue.sqlite")
+    WorkQueue(path).initialize(4, 2)
+    monkeypatch.setattr(work_queue.socket, "gethostname", lambda: "other-host")
+    with pytest.raises(ValueError, match="one host"):
+        WorkQueue(path).initialize(4, 2)
+
+
+def test_stale_queue_is_validated_against_the_results(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    queue = WorkQueue(path)
+    queue.initialize(8, 4)
+    for worker_id in ["a", "b"]:
+        start, _ = queue.lease(worker_id)
+        queue.complete(worker_id, start)
+    assert queue.claim("merge", "a", ttl=60)
+    queue.mark_done("merge")
+
+    # The output was deleted for a rerun: the finished ranges without results are handed out again
+    rerun = WorkQueue(path)
+    rerun.initialize(8, 4, completed=range(4))
+    assert rerun.remaining() == 1
+    assert rerun.lease("c") == (4, 8)
+    assert rerun.claim("merge", "c", ttl=60)
+
+    with pytest.raises(ValueError, match="delete it to start over"):
+        WorkQueue(path).initialize(12, 4)
+
+
+@pytest.fixture
+def queue_run(tiny_model_dir, tmp_path):
+    # A strategy_test.py setup on the tiny model: both roles load it, evidence is generated on the fly
+    dataset = build_dataset_items(24, random.Random(0))
+    with open(tmp_path / "data.json", "w") as f:
+        json.dump(dataset, f)
+    config = {
+        "model_paths": {"llama3": tiny_model_dir, "qwen": tiny_model_dir},
+        "model_params": {"torch_dtype": "float32"},
+        "dataset_path": str(tmp_path / "data.json"),
+        "output_path": str(tmp_path / "results"),
+        "evidence_path": str(tmp_path / "evidence"),
+        "metrics_path": str(tmp_path / "metrics"),
+    }
+    with open(tmp_path / "config.yaml", "w") as f:
+        json.dump(config, f)
+    output_path = strategy_test.get_output_path(config["output_path"], "llama3", "qwen", "authority_effect")
+    return dataset, config, str(tmp_path / "config.yaml"), output_path
+
+
+def merged_indices(output_path):
+    # Raw lines, not ResultStream.load(), which would hide duplicates
+    with open(os.path.splitext(output_path)[0] + ".jsonl") as f:
+        return sorted(json.loads(line)["index"] for line in f)
+
+
+def worker_command(config_path, worker_id):
+    return [sys.executable, os.path.join(REPO_DIR, "strategy_test.py"), "--config_path", config_path,
+            "--strategy", "authority_effect", "--listener", "llama3", "--persuader", "qwen", "--queue",
+            "--worker_id", worker_id, "--range_size", "8", "--batch_size", "1", "--lease_seconds", "3"]
+
+
+def test_killed_worker_range_is_reclaimed_by_other_processes(queue_run):
+    dataset, _, config_path, output_path = queue_run
+    stem = os.path.splitext(output_path)[0]
+    doomed_stream = ResultStream(stem + ".worker-doomed.jsonl")
+    doomed = subprocess.Popen(worker_command(config_path, "doomed"), cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # Killed after its first item, with the rest of the range still to run
+        deadline = time.monotonic() + 300
+        while not (os.path.exists(doomed_stream.path) and doomed_stream.load()):
+            assert doomed.poll() is None and time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        doomed.kill()
+        doomed.wait()
+    partial = set(doomed_stream.load())
+    queue = WorkQueue(stem + ".queue.sqlite")
+    start, end, expires = queue.conn.execute("SELECT start, end, lease_expires FROM ranges WHERE worker = 'doomed' AND status = 'leased'").fetchone()
+    assert partial < set(range(start, end))
+    time.sleep(max(0.0, expires - time.time()) + 0.1)
+
+    workers = [subprocess.Popen(worker_command(config_path, f"w{i}"), cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+               for i in range(2)]
+    outputs = [worker.communicate(timeout=600)[0] for worker in workers]
+    assert [worker.returncode for worker in workers] == [0, 0], outputs
+
+    # The reclaimed range ran only the items the killed worker had not written
+    assert f"leased items [{start}, {end}), {end - start - len(partial)} to run" in "".join(outputs)
+    assert merged_indices(output_path) == list(range(len(dataset)))
+    assert strategy_test.get_worker_stream_paths(output_path) == []
+    with open(output_path) as f:
+        assert len(json.load(f)) == len(dataset)
+    assert queue.conn.execute("SELECT attempts FROM ranges WHERE start = ?", (start,)).fetchone()[0] == 2
+    assert queue.remaining() == 0
+
+
+def test_stale_heartbeat_raises_lease_lost(queue_run, monkeypatch):
+    dataset, config, _, output_path = queue_run
+    dataset = dataset[:4]
+    stem = os.path.splitext(output_path)[0]
+    queue = WorkQueue(stem + ".queue.sqlite", lease_seconds=60)
+    persuader = PersuaderAgent(config, "Persuader")
+    listener = ListenerAgent(config, "Listener")
+    evidence_stream = ResultStream(os.path.join(config["evidence_path"], "evidence.jsonl"))
+    process_items = strategy_test.process_items
+    lost = []
+
+    def process_items_losing_lease(indices, *args, after_batch=None, **kwargs):
+        def stale_heartbeat():
+            # The lease expired and another worker took the range before this heartbeat
+            queue.conn.execute("UPDATE ranges SET worker = 'other' WHERE status = 'leased'")
+            try:
+                after_batch()
+            except strategy_test.LeaseLost:
+                lost.append(indices)
+                raise
+        return process_items(indices, *args, after_batch=stale_heartbeat, **kwargs)
+
+    def run_worker(worker_id):
+        strategy_test.run_queue_worker(dataset, persuader, listener, "authority_effect", "llama3", "qwen", 1, output_path,
+                                       evidence_stream, "generate", worker_id, range_size=4, lease_seconds=60)
+
+    monkeypatch.setattr(strategy_test, "process_items", process_items_losing_lease)
+    run_worker("first")
+    # The worker stopped after its first batch and left the range to its new owner without merging
+    assert lost == [[0, 1, 2, 3]]
+    assert list(ResultStream(stem + ".worker-first.jsonl").load()) == [0]
+    assert queue.conn.execute("SELECT worker, status FROM ranges").fetchall() == [("other", "leased")]
+    assert not os.path.exists(stem + ".jsonl")
+
+    # Once that lease expires, another worker finishes the range and merges each item once
+    monkeypatch.setattr(strategy_test, "process_items", process_items)
+    queue.conn.execute("UPDATE ranges SET lease_expires = 0")
+    run_worker("second")
+    assert merged_indices(output_path) == [0, 1, 2, 3]
+    persuader.close()
+    listener.close()
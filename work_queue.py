@@ -0,0 +1,130 @@
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue:
+    # Lease-based queue of dataset index ranges shared through a SQLite file. A worker leases a
+    # range, renews the lease while it works and marks the range done; a range whose lease has
+    # expired (the worker died or was preempted) is handed out again.
+    # Workers must run on one host: WAL mode needs shared memory between the processes, the O_APPEND
+    # writes of the result streams are only atomic on a local filesystem, and lease expiry compares
+    # time.time() values, which only agree within one machine's clock.
+    def __init__(self, path, lease_seconds=600):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ranges ("
+            "start INTEGER PRIMARY KEY, end INTEGER NOT NULL, status TEXT NOT NULL, "
+            "worker TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never lease the same range
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+    def initialize(self, num_items, range_size, completed=()):
+        # Idempotent: only the first worker to get here creates the ranges
+        completed = set(completed)
+        host = socket.gethostname()
+        with self._transaction():
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'host'").fetchone()
+            if row is None:
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('host', ?)", (host,))
+            elif row[0] != host:
+                raise ValueError(f"Queue {self.path} belongs to workers on {row[0]}; queue workers must all run on one host")
+            if self.conn.execute("SELECT COUNT(*) FROM ranges").fetchone()[0] > 0:
+                self._validate(num_items, range_size, completed)
+                return
+            self.conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                  [("num_items", str(num_items)), ("range_size", str(range_size))])
+            rows = []
+            for start in range(0, num_items, range_size):
+                end = min(start + range_size, num_items)
+                status = "done" if all(i in completed for i in range(start, end)) else "pending"
+                rows.append((start, end, status))
+            self.conn.executemany("INSERT INTO ranges (start, end, status) VALUES (?, ?, ?)", rows)
+
+    def _validate(self, num_items, range_size, completed):
+        # A queue left from an earlier run: it must describe the same dataset, and ranges marked done
+        # whose results are gone (the output was deleted to rerun) are handed out again
+        stored = dict(self.conn.execute("SELECT key, value FROM meta WHERE key IN ('num_items', 'range_size')"))
+        if stored and (int(stored["num_items"]), int(stored["range_size"])) != (num_items, range_size):
+            raise ValueError(f"Queue {self.path} was created for {stored['num_items']} items in ranges of {stored['range_size']}, "
+                             f"not {num_items} in ranges of {range_size}; delete it to start over")
+        missing = [
+            start for start, end in self.conn.execute("SELECT start, end FROM ranges WHERE status = 'done'").fetchall()
+            if not all(i in completed for i in range(start, end))
+        ]
+        if missing:
+            logger.warning("Reopening %d finished ranges of %s whose results are missing", len(missing), self.path)
+            self.conn.executemany("UPDATE ranges SET status = 'pending', worker = NULL, lease_expires = NULL WHERE start = ?",
+                                  [(start,) for start in missing])
+            self.conn.execute("DELETE FROM meta WHERE key = 'merge'")
+
+    def lease(self, worker_id):
+        now = time.time()
+        with self._transaction():
+            row = self.conn.execute(
+                "SELECT start, end, status FROM ranges WHERE status = 'pending' "
+                "OR (status = 'leased' AND lease_expires < ?) ORDER BY status DESC, start LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            start, end, status = row
+            if status == "leased":
+                logger.warning("Reclaiming expired lease on items [%d, %d)", start, end)
+            self.conn.execute(
+                "UPDATE ranges SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE start = ?",
+                (worker_id, now + self.lease_seconds, start)
+            )
+        return start, end
+
+    def heartbeat(self, worker_id, start):
+        # Returns False when the lease was lost, e.g. it expired and another worker took the range
+        with self._transaction():
+            cursor = self.conn.execute(
+                "UPDATE ranges SET lease_expires = ? WHERE start = ? AND worker = ? AND status = 'leased'",
+                (time.time() + self.lease_seconds, start, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, worker_id, start):
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE ranges SET status = 'done', lease_expires = NULL WHERE start = ? AND worker = ?",
+                (start, worker_id)
+            )
+
+    def remaining(self):
+        return self.conn.execute("SELECT COUNT(*) FROM ranges WHERE status != 'done'").fetchone()[0]
+
+    def claim(self, key, worker_id, ttl):
+        # True for exactly one caller per key, e.g. to elect the worker that merges results; a claim
+        # that was neither marked done nor renewed within `ttl` seconds can be taken over
+        now = time.time()
+        with self._transaction():
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            if row is not None and (row[0] == "done" or now - float(row[0].split("@")[-1]) < ttl):
+                return False
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, f"{worker_id}@{now}"))
+        return True
+
+    def mark_done(self, key):
+        with self._transaction():
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, 'done')", (key,))